@@ -1,12 +1,14 @@
 __all__ = [
     'default_app_config',
     'get_system_variables',
+    'reload_system_variables',
     'SYSTEM_VARIABLES_FILE',
 ]
 
 import os
+import threading
 from importlib import util as import_util
-from typing import Any, Dict, List, Tuple
+from typing import Any, Dict, List, Optional, Tuple
 
 from django.conf import settings
 
@@ -17,12 +19,54 @@ default_app_config = 'cimbolic.apps.CimbolicConfig'
 SYSTEM_VARIABLES_FILE = 'cimbolic_vars.py'
 
 
-def get_system_variables() -> Dict[str, Tuple[Any, List[str]]]:
-    """Read the file in which system-sourced variables are stored and return them."""
-    file_path = os.path.join(settings.BASE_DIR, SYSTEM_VARIABLES_FILE)
+# The loaded system variables and the modification time of their file
+_system_variables: Optional[Dict[str, Tuple[Any, List[str]]]] = None
+_system_variables_mtime: Optional[int] = None
+_system_variables_lock = threading.Lock()
+
+
+def _get_system_variables_file_path() -> str:
+    return os.path.join(settings.BASE_DIR, SYSTEM_VARIABLES_FILE)
+
+
+def _load_system_variables(file_path: str) -> Dict[str, Tuple[Any, List[str]]]:
+    """Execute the file in which system-sourced variables are stored.
+
+    Callables declared cacheable (with a dict of cache options as a third
+    item, see cimbolic.caching) are wrapped in a CachedCallable, so that every
+    variable maps to an (action, argument names) pair.
+    """
+    from .caching import CachedCallable
     module_name = ''.join(SYSTEM_VARIABLES_FILE.split('.')[:-1])
     spec = import_util.spec_from_file_location(module_name, file_path)
     module = import_util.module_from_spec(spec)
     spec.loader.exec_module(module)
-    return module.system_variables
+    system_variables = {}
+    for name, (action, action_args, *options) in module.system_variables.items():
+        if options and callable(action):
+            action = CachedCallable(action, **options[0])
+        system_variables[name] = (action, action_args)
+    return system_variables
+
+
+def get_system_variables() -> Dict[str, Tuple[Any, List[str]]]:
+    """Return the system-sourced variables, reading their file only if it changed."""
+    global _system_variables, _system_variables_mtime
+    file_path = _get_system_variables_file_path()
+    mtime = os.stat(file_path).st_mtime_ns
+    if _system_variables is None or mtime != _system_variables_mtime:
+        with _system_variables_lock:
+            if _system_variables is None or mtime != _system_variables_mtime:
+                _system_variables = _load_system_variables(file_path)
+                _system_variables_mtime = mtime
+    return _system_variables
+
 
+def reload_system_variables() -> Dict[str, Tuple[Any, List[str]]]:
+    """Read the file in which system-sourced variables are stored again."""
+    global _system_variables, _system_variables_mtime
+    file_path = _get_system_variables_file_path()
+    with _system_variables_lock:
+        _system_variables_mtime = os.stat(file_path).st_mtime_ns
+        _system_variables = _load_system_variables(file_path)
+    return _system_variables
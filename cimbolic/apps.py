@@ -10,3 +10,4 @@ class CimbolicConfig(AppConfig):
 
     def ready(self):
         register(check_for_system_variables_file)
+        from . import signals  # noqa: F401
@@ -0,0 +1,226 @@
+"""Vectorized evaluation of variables over many contexts (requires NumPy).
+
+Evaluating the same variable for many contexts (eg: once per employee) with
+Variable.to_value repeats the whole evaluation for every context. A
+BatchEvaluator instead evaluates each variable once per batch, as a column
+holding one value per context:
+
+- every referenced variable becomes a column, computed at most once per
+  batch, and only for the contexts whose evaluation needs it;
+- a condition evaluates to a boolean mask over the contexts, the right-hand
+  side of 'and' and 'or' being evaluated only where the left-hand side
+  doesn't decide the result;
+- a rule evaluates to an array operation over the columns it references;
+- the formula of the highest priority is selected with masked assignment,
+  each formula being evaluated only for the contexts no earlier one matched.
+
+Two modes are available. The exact mode keeps native Python numbers in
+object arrays, so its results are identical to those of Variable.to_value.
+The float mode uses float64 arrays, which is much faster but subject to
+floating-point rounding; a division by zero raises a FloatingPointError
+rather than a ZeroDivisionError. In the exact mode, values are computed with
+the numeric backend (see cimbolic.numeric) given to the evaluator, or else
+the current one, so that with a Decimal backend the columns hold Decimals;
+the float mode always computes with float64.
+
+System-sourced callables are still called once per context (that needs
+them), with their arguments taken from the contexts. Contexts for which no
+formula matched get None (exact mode) or NaN (float mode).
+"""
+
+# So that one may import * from this module.
+__all__ = ['BatchEvaluator', 'EXACT_MODE', 'FLOAT_MODE']
+
+from typing import Any, Dict, List, Mapping, Optional, Sequence, Union
+
+try:
+    import numpy as np
+except ImportError as exc:
+    raise ImportError('Batch evaluation requires NumPy (pip install Cimbolic[batch])') from exc
+
+from . import get_system_variables
+from .exceptions import VariableNotDefinedError
+from .expressions import (
+    AggregateMacro,
+    BinaryOperation,
+    Constant,
+    LogicalOperation,
+    NamedVariable,
+    Negation,
+    Node,
+    _BINARY_OPERATORS,
+    _to_decimal,
+    _to_native,
+    _xor,
+)
+from .numeric import FLOAT, NUMERIC_BACKENDS, get_numeric_backend, is_entered, numeric_backend
+from .parsing import compile_condition, compile_decimal_condition, compile_decimal_rule, compile_rule
+from .registry import registry
+
+
+# Native Python numbers in object arrays (identical to Variable.to_value).
+EXACT_MODE = 'exact'
+# Native float64 arrays (fast, subject to floating-point rounding).
+FLOAT_MODE = 'float'
+MODES = (EXACT_MODE, FLOAT_MODE)
+
+# A column of values or a scalar that broadcasts against columns.
+Operand = Union[np.ndarray, Any]
+
+
+class BatchEvaluator:
+    """Evaluator of variables over a batch of contexts, one column at a time."""
+    def __init__(
+            self,
+            contexts: Sequence[Mapping[str, Any]],
+            mode: str = EXACT_MODE,
+            numeric: Optional[str] = None,
+    ):
+        if mode not in MODES:
+            raise ValueError(f'Unknown batch evaluation mode {mode!r} (choose from {MODES})')
+        numeric = numeric or get_numeric_backend()
+        if numeric not in NUMERIC_BACKENDS:
+            raise ValueError(f'Unknown numeric backend {numeric!r} (choose from {NUMERIC_BACKENDS})')
+        self.contexts: List[Mapping[str, Any]] = [context or {} for context in contexts]
+        self.size = len(self.contexts)
+        self.mode = mode
+        self.numeric = numeric if mode == EXACT_MODE else FLOAT
+        self.dtype = object if mode == EXACT_MODE else np.float64
+        self.columns: Dict[str, np.ndarray] = {}
+        # Which contexts the values of each column were evaluated for.
+        self._evaluated: Dict[str, np.ndarray] = {}
+
+    def evaluate(self, variable, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        """Return the values of the variable, in the order of the contexts.
+
+        If rows (indices of contexts) are given, only the values for those
+        contexts are evaluated (unless they already were) and returned.
+        """
+        if not is_entered(self.numeric):
+            with numeric_backend(self.numeric):
+                return self.evaluate(variable, rows)
+        column = self.columns.get(variable.name)
+        if column is None:
+            column = np.full(self.size, None if self.mode == EXACT_MODE else np.nan, dtype=self.dtype)
+            self.columns[variable.name] = column
+            self._evaluated[variable.name] = np.zeros(self.size, dtype=bool)
+        evaluated = self._evaluated[variable.name]
+        missing = np.flatnonzero(~evaluated) if rows is None else rows[~evaluated[rows]]
+        if missing.size:
+            if variable.source == variable.SYSTEM:
+                column[missing] = self._evaluate_system_variable(variable, missing)
+            else:
+                self._evaluate_user_variable(variable, missing, column)
+            evaluated[missing] = True
+        return column if rows is None else column[rows]
+
+    def column(self, name: str, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        """Return the values of the named variable, in the order of the contexts (or rows)."""
+        from .models import Variable
+        column = self.columns.get(name)
+        if column is not None and self._evaluated[name].all():
+            return column if rows is None else column[rows]
+        try:
+            var = registry.get_variable(name)
+        except Variable.DoesNotExist:
+            raise LookupError(f'Variable {name} not found in the database')
+        return self.evaluate(var, rows)
+
+    def _to_column(self, values: List[Any]) -> np.ndarray:
+        column = np.empty(len(values), dtype=self.dtype)
+        if self.numeric != FLOAT:
+            column[:] = [_to_decimal(value) for value in values]
+        elif self.mode == EXACT_MODE:
+            column[:] = [_to_native(value) for value in values]
+        else:
+            column[:] = [np.nan if value is None else float(value) for value in values]
+        return column
+
+    def _evaluate_system_variable(self, variable, rows: np.ndarray) -> np.ndarray:
+        try:
+            result, result_args = get_system_variables()[variable.name]
+        except KeyError:
+            raise VariableNotDefinedError(f'System variable {variable} undefined')
+        if not callable(result):
+            return self._to_column([result] * rows.size)
+        values = []
+        for row in rows:
+            context = self.contexts[row]
+            result_kwargs = {}
+            for key in result_args:
+                if key in context.keys():
+                    result_kwargs[key] = context[key]
+                else:
+                    raise KeyError(f'Missing argument {key} to callable {result.__name__}')
+            values.append(result(**result_kwargs))
+        return self._to_column(values)
+
+    def _evaluate_user_variable(self, variable, rows: np.ndarray, column: np.ndarray):
+        formulae = registry.get_formulae(variable)
+        if not formulae:
+            raise VariableNotDefinedError(f'No formula defined for variable {variable.name}')
+        if self.numeric == FLOAT:
+            get_condition, get_rule = compile_condition, compile_rule
+        else:
+            get_condition, get_rule = compile_decimal_condition, compile_decimal_rule
+        pending = rows
+        for formula in formulae:
+            if not pending.size:
+                break
+            condition = self._evaluate_node(get_condition(formula.condition), pending)
+            mask = self._to_mask(condition, pending.size)
+            selected = pending[mask]
+            if selected.size:
+                column[selected] = self._evaluate_node(get_rule(formula.rule), selected)
+            pending = pending[~mask]
+
+    @staticmethod
+    def _to_mask(operand: Operand, size: int) -> np.ndarray:
+        if isinstance(operand, np.ndarray):
+            return operand.astype(bool)
+        return np.full(size, bool(operand))
+
+    def _evaluate_node(self, node: Node, rows: np.ndarray) -> Operand:
+        """Evaluate an expression tree for the contexts at the given rows."""
+        if isinstance(node, Constant):
+            return node.value
+        if isinstance(node, NamedVariable):
+            return self.column(node.name, rows)
+        if isinstance(node, BinaryOperation):
+            left = self._evaluate_node(node.left, rows)
+            right = self._evaluate_node(node.right, rows)
+            if node.operator == '^' and self.numeric != FLOAT:
+                # Decimals have no xor of their own, so it's applied to each row.
+                return np.frompyfunc(_xor, 2, 1)(left, right)
+            with np.errstate(divide='raise', invalid='raise'):
+                return _BINARY_OPERATORS[node.operator](left, right)
+        if isinstance(node, LogicalOperation):
+            # Like 'and' and 'or' do, only evaluate the right-hand side (and
+            # the variables it references) for the contexts that need it.
+            result = self._to_mask(self._evaluate_node(node.left, rows), rows.size)
+            needed = result if node.operator == 'and' else ~result
+            if needed.any():
+                right = self._evaluate_node(node.right, rows[needed])
+                result = result.copy()
+                result[needed] = self._to_mask(right, int(needed.sum()))
+            return result
+        if isinstance(node, Negation):
+            return np.logical_not(self._to_mask(self._evaluate_node(node.operand, rows), rows.size))
+        if isinstance(node, AggregateMacro):
+            return self._evaluate_aggregate_macro(node, rows)
+        raise TypeError(f'Unknown expression tree node: {node!r}')
+
+    def _evaluate_aggregate_macro(self, node: AggregateMacro, rows: np.ndarray) -> Operand:
+        args = [self._evaluate_node(arg, rows) for arg in node.args]
+        if not any(isinstance(arg, np.ndarray) for arg in args):
+            return max(args) if node.name == 'max' else min(args)
+        if self.mode == EXACT_MODE:
+            # Apply the builtin to each row so that ties resolve the same way.
+            function = max if node.name == 'max' else min
+            ufunc = np.frompyfunc(lambda *values: function(values), len(args), 1)
+            return ufunc(*args)
+        ufunc = np.maximum if node.name == 'max' else np.minimum
+        result = args[0]
+        for arg in args[1:]:
+            result = ufunc(result, arg)
+        return result
@@ -0,0 +1,413 @@
+"""Reproducible benchmarks of parsing, evaluation and dependency resolution.
+
+run_benchmarks() creates its own variables and formulae (all named BENCH_*)
+in a transaction that's rolled back once it's done, so it can run against
+any database, and times a fixed set of benchmarks:
+
+- parsing conditions and rules, small and large, without any caching;
+- parsing and evaluating them (cold), and evaluating them through the
+  compile caches (warm), including nested min/max macros;
+- evaluating a large rule and a deep chain with each numeric backend;
+- Variable.to_value over deep and wide dependency chains, and over
+  system-sourced callables, with and without caching;
+- collecting the context keys of the same chains (unmemoized);
+- a scenario sweep of variables over contexts differing in one key, with an
+  IncrementalEvaluator and with full re-evaluation, reporting the number of
+  variables recomputed and reused;
+- loading the registry.
+
+Every benchmark is timed like timeit does: each of several rounds calls it
+as many times as it takes to last a minimum time, and the per-call time of
+each round is kept. The results are a JSON-serializable dict, which
+compare_results() compares against those of an earlier run to flag
+regressions (see the benchmark management command).
+"""
+
+# So that one may import * from this module.
+__all__ = [
+    'BENCHMARKS',
+    'RESULTS_FORMAT_VERSION',
+    'compare_results',
+    'run_benchmarks',
+]
+
+import datetime
+import platform
+import statistics
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple, Optional, Sequence
+
+import django
+from django.db import connection, transaction
+
+from . import _system_variables_lock, get_system_variables, reload_system_variables
+from .caching import CachedCallable
+from .numeric import DECIMAL, FIXED, FLOAT
+from .parsing import Condition, Rule, get_default_backend, parse_condition, parse_rule
+from .registry import registry
+
+
+# Version of the format of the results.
+RESULTS_FORMAT_VERSION = 1
+
+# Sizes of the generated formulae and dependency chains.
+LARGE_FORMULA_TERMS = 200
+MACRO_DEPTH = 20
+DEEP_CHAIN_DEPTH = 50
+WIDE_CHAIN_WIDTH = 200
+
+# Context passed to the system-sourced callables.
+CONTEXT = {'employee_id': 7, 'month': 3}
+
+# Contexts of the scenario sweep, which differ only in the month.
+SWEEP_CONTEXTS = [{**CONTEXT, 'month': month} for month in range(1, 13)]
+
+
+class Benchmark(NamedTuple):
+    """A named, timed callable, and optionally counts it reports along with its timing."""
+    name: str
+    description: str
+    function: Callable[[], Any]
+    counts: Optional[Callable[[], Dict[str, int]]] = None
+
+
+# The following create the formulae and variables that are benchmarked.
+# ---------------------------------------------------------------------
+
+
+SMALL_RULE = '($BENCH_A + $BENCH_B) * 12 / 100 - 3'
+LARGE_RULE = ' + '.join(f'$BENCH_A * {k} - $BENCH_B / {k + 1}' for k in range(LARGE_FORMULA_TERMS))
+SMALL_CONDITION = '$BENCH_A > 10 and not ($BENCH_B == 0 or $BENCH_A < $BENCH_B)'
+LARGE_CONDITION = ' and '.join(f'($BENCH_A + {k} > $BENCH_B or $BENCH_B != {k})' for k in range(LARGE_FORMULA_TERMS))
+MACRO_RULE = 'max(' * MACRO_DEPTH + '$BENCH_A' + ''.join(
+    f', min($BENCH_B, {k}))' for k in range(MACRO_DEPTH)
+)
+
+# Values of the variables referenced by the formulae above.
+VALUES = {'BENCH_A': 150, 'BENCH_B': 40}
+
+
+def _resolve(name: str) -> Any:
+    return VALUES[name]
+
+
+def _lookup(employee_id: int, month: int) -> int:
+    """Stand-in for a pure but costly lookup, like that of a tax table."""
+    return sum(range(1000)) % (employee_id + month)
+
+
+# System-sourced variables added while the benchmarks run.
+SYSTEM_VARIABLES = {
+    'BENCH_SYS_ID': (lambda employee_id: employee_id * 3, ['employee_id']),
+    'BENCH_SYS_PERIOD': (lambda employee_id, month: employee_id + month, ['employee_id', 'month']),
+    'BENCH_SYS_RATE': (12, []),
+    'BENCH_SYS_LOOKUP': (_lookup, ['employee_id', 'month']),
+    'BENCH_SYS_LOOKUP_CACHED': (CachedCallable(_lookup), ['employee_id', 'month']),
+}
+
+
+@contextmanager
+def _system_variables(extra: Dict[str, Any]) -> Iterator[None]:
+    """Temporarily add system-sourced variables to those of cimbolic_vars.py."""
+    import cimbolic
+    get_system_variables()
+    with _system_variables_lock:
+        cimbolic._system_variables = {**cimbolic._system_variables, **extra}
+    try:
+        yield
+    finally:
+        reload_system_variables()
+
+
+def _create_fixture():
+    """Create the variables and formulae of the benchmarks (in bulk)."""
+    from .models import Formula, Variable
+
+    variables = [Variable(name=name, source=Variable.SYSTEM) for name in SYSTEM_VARIABLES]
+    variables += [Variable(name=f'BENCH_DEEP_{k}') for k in range(DEEP_CHAIN_DEPTH)]
+    variables += [Variable(name=f'BENCH_WIDE_{k}') for k in range(WIDE_CHAIN_WIDTH)]
+    variables += [Variable(name=name) for name in ('BENCH_WIDE', 'BENCH_SYSTEM', 'BENCH_LOOKUP', 'BENCH_LOOKUP_CACHED')]
+    Variable.objects.bulk_create(variables)
+    pks = dict(Variable.objects.filter(name__startswith='BENCH_').values_list('name', 'pk'))
+
+    rules = {'BENCH_DEEP_0': '$BENCH_SYS_ID + 1'}
+    rules.update({f'BENCH_DEEP_{k}': f'$BENCH_DEEP_{k - 1} + 1' for k in range(1, DEEP_CHAIN_DEPTH)})
+    rules.update({f'BENCH_WIDE_{k}': f'$BENCH_SYS_RATE * {k}' for k in range(WIDE_CHAIN_WIDTH)})
+    rules['BENCH_WIDE'] = ' + '.join(f'$BENCH_WIDE_{k}' for k in range(WIDE_CHAIN_WIDTH))
+    rules['BENCH_SYSTEM'] = 'max($BENCH_SYS_ID, $BENCH_SYS_PERIOD) * $BENCH_SYS_RATE / 100'
+    rules['BENCH_LOOKUP'] = ' + '.join(['$BENCH_SYS_LOOKUP'] * 10)
+    rules['BENCH_LOOKUP_CACHED'] = ' + '.join(['$BENCH_SYS_LOOKUP_CACHED'] * 10)
+    formulae = []
+    for name, rule in rules.items():
+        formulae.append(Formula(variable_id=pks[name], condition='$BENCH_SYS_RATE > 100', rule='0', priority=1))
+        formulae.append(Formula(variable_id=pks[name], condition='NULL', rule=rule, priority=2))
+    for formula in formulae:
+        formula.compile()
+    Formula.objects.bulk_create(formulae)
+    # Bulk creation doesn't send the signals that invalidate the registry.
+    registry.invalidate()
+
+
+# The following are the benchmarks.
+# ---------------------------------
+
+
+def _context_keys(name: str) -> Callable[[], Any]:
+    from .graph import DependencyGraph, get_dependency_graph
+
+    def function():
+        # A new graph every time, so that the keys aren't memoized.
+        return DependencyGraph(get_dependency_graph().dependencies).required_context_keys(name)
+    return function
+
+
+def _to_value(name: str, numeric: Optional[str] = None) -> Callable[[], Any]:
+    def function():
+        return registry.get_variable(name).to_value(CONTEXT, numeric)
+    return function
+
+
+class _ScenarioSweep:
+    """Evaluation of variables over the sweep's contexts, counting the variables recomputed and reused."""
+    def __init__(self, names: Sequence[str], incremental: bool):
+        self.names = names
+        self.incremental = incremental
+        self.recomputed = 0
+        self.reused = 0
+
+    def __call__(self):
+        from .incremental import IncrementalEvaluator
+        evaluator = IncrementalEvaluator(self.names)
+        self.recomputed = self.reused = 0
+        for context in SWEEP_CONTEXTS:
+            if not self.incremental:
+                evaluator.reset()
+            evaluator.evaluate(context)
+            self.recomputed += evaluator.recomputed
+            self.reused += evaluator.reused
+
+    def counts(self) -> Dict[str, int]:
+        return {'recomputed': self.recomputed, 'reused': self.reused}
+
+
+# Variables of the scenario sweep: the month only affects the last two.
+SWEEP_NAMES = [f'BENCH_DEEP_{DEEP_CHAIN_DEPTH - 1}', 'BENCH_WIDE', 'BENCH_SYSTEM', 'BENCH_LOOKUP']
+_INCREMENTAL_SWEEP = _ScenarioSweep(SWEEP_NAMES, incremental=True)
+_FULL_SWEEP = _ScenarioSweep(SWEEP_NAMES, incremental=False)
+
+
+def _parse_and_evaluate(parse: Callable, text: str) -> Callable[[], Any]:
+    def function():
+        return parse(text).evaluate(_resolve)
+    return function
+
+
+BENCHMARKS: List[Benchmark] = [
+    Benchmark('parse_rule_small', 'Parse a small rule', lambda: parse_rule(SMALL_RULE)),
+    Benchmark('parse_rule_large', f'Parse a rule of {LARGE_FORMULA_TERMS * 2} terms', lambda: parse_rule(LARGE_RULE)),
+    Benchmark('parse_condition_small', 'Parse a small condition', lambda: parse_condition(SMALL_CONDITION)),
+    Benchmark(
+        'parse_condition_large', f'Parse a condition of {LARGE_FORMULA_TERMS * 2} comparisons',
+        lambda: parse_condition(LARGE_CONDITION),
+    ),
+    Benchmark('rule_small_cold', 'Parse and evaluate a small rule', _parse_and_evaluate(parse_rule, SMALL_RULE)),
+    Benchmark('rule_large_cold', 'Parse and evaluate a large rule', _parse_and_evaluate(parse_rule, LARGE_RULE)),
+    Benchmark(
+        'condition_small_cold', 'Parse and evaluate a small condition',
+        _parse_and_evaluate(parse_condition, SMALL_CONDITION),
+    ),
+    Benchmark(
+        'condition_large_cold', 'Parse and evaluate a large condition',
+        _parse_and_evaluate(parse_condition, LARGE_CONDITION),
+    ),
+    Benchmark(
+        'macros_cold', f'Parse and evaluate {MACRO_DEPTH * 2} nested min/max macros',
+        _parse_and_evaluate(parse_rule, MACRO_RULE),
+    ),
+    Benchmark('rule_small_warm', 'Evaluate a cached small rule', lambda: Rule(SMALL_RULE).evaluate(_resolve)),
+    Benchmark('rule_large_warm', 'Evaluate a cached large rule', lambda: Rule(LARGE_RULE).evaluate(_resolve)),
+    Benchmark(
+        'condition_small_warm', 'Evaluate a cached small condition',
+        lambda: Condition(SMALL_CONDITION).evaluate(_resolve),
+    ),
+    Benchmark(
+        'condition_large_warm', 'Evaluate a cached large condition',
+        lambda: Condition(LARGE_CONDITION).evaluate(_resolve),
+    ),
+    Benchmark(
+        'macros_warm', f'Evaluate {MACRO_DEPTH * 2} cached nested min/max macros',
+        lambda: Rule(MACRO_RULE).evaluate(_resolve),
+    ),
+    *(
+        Benchmark(
+            f'rule_large_warm_{numeric}', f'Evaluate a cached large rule with the {numeric} numeric backend',
+            lambda numeric=numeric: Rule(LARGE_RULE, numeric=numeric).evaluate(_resolve),
+        )
+        for numeric in (FLOAT, DECIMAL, FIXED)
+    ),
+    Benchmark(
+        'to_value_deep_chain', f'Evaluate a chain of {DEEP_CHAIN_DEPTH} dependent variables',
+        _to_value(f'BENCH_DEEP_{DEEP_CHAIN_DEPTH - 1}'),
+    ),
+    *(
+        Benchmark(
+            f'to_value_deep_chain_{numeric}',
+            f'Evaluate a chain of {DEEP_CHAIN_DEPTH} dependent variables with the {numeric} numeric backend',
+            _to_value(f'BENCH_DEEP_{DEEP_CHAIN_DEPTH - 1}', numeric),
+        )
+        for numeric in (FLOAT, DECIMAL, FIXED)
+    ),
+    Benchmark(
+        'to_value_wide_chain', f'Evaluate a variable depending on {WIDE_CHAIN_WIDTH} variables',
+        _to_value('BENCH_WIDE'),
+    ),
+    Benchmark(
+        'to_value_system_callables', 'Evaluate a variable over system-sourced callables',
+        _to_value('BENCH_SYSTEM'),
+    ),
+    Benchmark(
+        'to_value_system_lookup', 'Evaluate a variable referencing a costly system-sourced callable 10 times',
+        _to_value('BENCH_LOOKUP'),
+    ),
+    Benchmark(
+        'to_value_system_lookup_cached', 'Evaluate a variable referencing a cached costly callable 10 times',
+        _to_value('BENCH_LOOKUP_CACHED'),
+    ),
+    Benchmark(
+        'context_keys_deep_chain', f'Collect the context keys of a chain of {DEEP_CHAIN_DEPTH} variables',
+        _context_keys(f'BENCH_DEEP_{DEEP_CHAIN_DEPTH - 1}'),
+    ),
+    Benchmark(
+        'context_keys_wide_chain', f'Collect the context keys of a variable depending on {WIDE_CHAIN_WIDTH} variables',
+        _context_keys('BENCH_WIDE'),
+    ),
+    Benchmark(
+        'sweep_incremental',
+        f'Evaluate variables over {len(SWEEP_CONTEXTS)} contexts differing in one key, incrementally',
+        _INCREMENTAL_SWEEP, _INCREMENTAL_SWEEP.counts,
+    ),
+    Benchmark(
+        'sweep_full',
+        f'Evaluate variables over {len(SWEEP_CONTEXTS)} contexts differing in one key, from scratch',
+        _FULL_SWEEP, _FULL_SWEEP.counts,
+    ),
+    Benchmark('registry_load', 'Load the registry of active variables and formulae', registry.load),
+]
+
+
+# The following run the benchmarks and compare their results.
+# -----------------------------------------------------------
+
+
+def measure(function: Callable[[], Any], repeat: int = 5, min_time: float = 0.1) -> Dict[str, Any]:
+    """Time a callable, returning statistics of its per-call time (in seconds)."""
+    # Find how many calls last at least the minimum time, like timeit does.
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for __ in range(number):
+            function()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        number *= 2 if elapsed == 0 else max(2, min(10, int(min_time / elapsed) + 1))
+    timings = [elapsed / number]
+    for __ in range(repeat - 1):
+        start = time.perf_counter()
+        for __ in range(number):
+            function()
+        timings.append((time.perf_counter() - start) / number)
+    return {
+        'min': min(timings),
+        'median': statistics.median(timings),
+        'mean': statistics.mean(timings),
+        'stdev': statistics.stdev(timings) if len(timings) > 1 else 0.0,
+        'number': number,
+        'repeat': len(timings),
+    }
+
+
+def _environment() -> Dict[str, Any]:
+    try:
+        from pkg_resources import get_distribution
+        version = get_distribution('Cimbolic').version
+    except Exception:
+        version = None
+    return {
+        'cimbolic': version,
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'django': django.get_version(),
+        'platform': platform.platform(),
+        'database': connection.vendor,
+        'backend': get_default_backend(),
+    }
+
+
+def run_benchmarks(
+        names: Optional[Sequence[str]] = None,
+        repeat: int = 5,
+        min_time: float = 0.1,
+        progress: Optional[Callable[[str, Dict[str, Any]], None]] = None,
+) -> Dict[str, Any]:
+    """Run the (named) benchmarks and return their results.
+
+    The progress callable, if any, is called with the name and the result of
+    every benchmark as soon as it's done.
+    """
+    benchmarks = [benchmark for benchmark in BENCHMARKS if not names or benchmark.name in names]
+    unknown = set(names or ()) - {benchmark.name for benchmark in BENCHMARKS}
+    if unknown:
+        raise ValueError(f'Unknown benchmarks: {", ".join(sorted(unknown))}')
+
+    results: Dict[str, Any] = {}
+    with _system_variables(SYSTEM_VARIABLES):
+        try:
+            with transaction.atomic():
+                _create_fixture()
+                registry.load()
+                for benchmark in benchmarks:
+                    result = measure(benchmark.function, repeat, min_time)
+                    result['description'] = benchmark.description
+                    if benchmark.counts is not None:
+                        result.update(benchmark.counts())
+                    results[benchmark.name] = result
+                    if progress is not None:
+                        progress(benchmark.name, result)
+                transaction.set_rollback(True)
+        finally:
+            registry.invalidate()
+    return {
+        'format_version': RESULTS_FORMAT_VERSION,
+        'created': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'environment': _environment(),
+        'settings': {'repeat': repeat, 'min_time': min_time},
+        'benchmarks': results,
+    }
+
+
+class Comparison(NamedTuple):
+    """The per-call times of a benchmark in two runs."""
+    name: str
+    baseline: float
+    current: float
+    ratio: float
+    is_regression: bool
+
+
+def compare_results(results: Dict[str, Any], baseline: Dict[str, Any], threshold: float = 0.2) -> List[Comparison]:
+    """Compare the fastest per-call times of the benchmarks common to two runs.
+
+    A benchmark regressed if it got slower by more than the threshold (a
+    fraction of the baseline time).
+    """
+    comparisons = []
+    for name, result in results['benchmarks'].items():
+        try:
+            baseline_time = baseline['benchmarks'][name]['min']
+        except KeyError:
+            continue
+        ratio = result['min'] / baseline_time
+        comparisons.append(Comparison(name, baseline_time, result['min'], ratio, ratio > 1 + threshold))
+    return comparisons
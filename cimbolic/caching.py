@@ -0,0 +1,151 @@
+"""Memoization of the callables of system-sourced variables.
+
+The callable of a system-sourced variable is called with the arguments it
+takes from the context every time the variable is evaluated. Callables that
+are pure lookups (eg: of a tax table or of currency rates) can be declared
+cacheable in the system_variables mapping of cimbolic_vars.py, with a third
+item holding the options of their cache:
+
+    system_variables = {
+        'TAX_RATE': (get_tax_rate, ['income'], {'maxsize': 1024, 'ttl': 3600}),
+    }
+
+Their results are then cached by their arguments, keeping the maxsize most
+recently used ones (128 by default, or every one if None) for up to ttl
+seconds (forever by default). Arguments that can't be hashed bypass the
+cache. The caches are discarded along with the callables whenever the file
+is read again; cache_info() and cache_clear() report on and clear them
+otherwise.
+"""
+
+# So that one may import * from this module.
+__all__ = [
+    'CacheInfo',
+    'CachedCallable',
+    'cache_clear',
+    'cache_info',
+]
+
+import functools
+import inspect
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, NamedTuple, Optional, Tuple
+
+# Default number of results kept per callable.
+DEFAULT_MAXSIZE = 128
+
+
+class CacheInfo(NamedTuple):
+    """Statistics of the cache of a callable."""
+    hits: int
+    misses: int
+    maxsize: Optional[int]
+    ttl: Optional[float]
+    currsize: int
+
+
+def _to_key(args: Tuple, kwargs: Dict[str, Any]) -> Tuple:
+    return args + tuple(sorted(kwargs.items()))
+
+
+class CachedCallable:
+    """Wrapper of a pure callable that caches its results by its arguments."""
+    def __init__(
+            self,
+            function: Callable[..., Any],
+            maxsize: Optional[int] = DEFAULT_MAXSIZE,
+            ttl: Optional[float] = None,
+            clock: Callable[[], float] = time.monotonic,
+    ):
+        if inspect.iscoroutinefunction(function):
+            raise TypeError(f'Asynchronous callable {function.__name__} can\'t be cached')
+        if maxsize is not None and maxsize < 0:
+            raise ValueError(f'Negative maxsize for callable {function.__name__}')
+        functools.update_wrapper(self, function)
+        self.function = function
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # Source of the current time (in seconds) that results expire by.
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        # Results (and when they expire) by arguments, least recently used first.
+        self._results: 'OrderedDict[Tuple, Tuple[float, Any]]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f'<CachedCallable: {self.function.__name__}, {self.hits} hits, {self.misses} misses>'
+
+    def __call__(self, *args, **kwargs) -> Any:
+        key = _to_key(args, kwargs)
+        try:
+            with self._lock:
+                expires, result = self._results[key]
+                if self.ttl is None or expires >= self.clock():
+                    self._results.move_to_end(key)
+                    self.hits += 1
+                    return result
+                del self._results[key]
+        except KeyError:
+            pass
+        except TypeError:
+            # Unhashable arguments aren't cached.
+            return self.function(*args, **kwargs)
+
+        result = self.function(*args, **kwargs)
+        expires = float('inf') if self.ttl is None else self.clock() + self.ttl
+        with self._lock:
+            self.misses += 1
+            if self.maxsize != 0:
+                self._results[key] = (expires, result)
+                self._results.move_to_end(key)
+                if self.maxsize is not None and len(self._results) > self.maxsize:
+                    self._results.popitem(last=False)
+        return result
+
+    def cache_info(self) -> CacheInfo:
+        """Return the statistics of the cache."""
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.maxsize, self.ttl, len(self._results))
+
+    def cache_clear(self, arguments: Optional[Dict[str, Any]] = None):
+        """Discard the cached results and statistics, or only the result of the given (keyword) arguments."""
+        with self._lock:
+            if arguments is not None:
+                self._results.pop(_to_key((), arguments), None)
+                return
+            self._results.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+def cache_info() -> Dict[str, CacheInfo]:
+    """Return the cache statistics of the cacheable system-sourced variables, by name."""
+    from . import get_system_variables
+    return {
+        name: action.cache_info()
+        for name, (action, action_args) in get_system_variables().items()
+        if isinstance(action, CachedCallable)
+    }
+
+
+def cache_clear(name: Optional[str] = None, arguments: Optional[Dict[str, Any]] = None):
+    """Clear the caches of the cacheable system-sourced variables (or of the named one).
+
+    Given a dict of arguments, only the result cached for those arguments is
+    discarded.
+    """
+    from . import get_system_variables
+    from .exceptions import VariableNotDefinedError
+    sys_vars = get_system_variables()
+    if name is None:
+        actions = [action for action, action_args in sys_vars.values()]
+    elif name in sys_vars:
+        actions = [sys_vars[name][0]]
+    else:
+        raise VariableNotDefinedError(f'System variable ${name} undefined')
+    for action in actions:
+        if isinstance(action, CachedCallable):
+            action.cache_clear(arguments)
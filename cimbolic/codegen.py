@@ -0,0 +1,114 @@
+"""Code generation backend for compiled Cimbolic formulae.
+
+An expression tree (see cimbolic.expressions) is translated into the source
+of a single Python lambda that takes a resolver, and the source is built once
+with compile(). Evaluating a formula is then one call of a pre-built function
+rather than a walk over the tree's nodes.
+
+The generated code keeps the semantics of the tree: operators map one-to-one
+onto Python's (but for '^', which calls the tree's xor function, since
+Decimals have none), and every named variable becomes a call to the resolver
+(whose result is converted to a Decimal for the trees of the Decimal numeric
+backends). Operators and macros are looked up in tables of the known ones,
+and constants must be plain literals, so that no tree (say, one loaded from
+the database) can inject code into the source.
+"""
+
+# So that one may import * from this module.
+__all__ = [
+    'CompiledExpression',
+    'to_function',
+    'to_source',
+]
+
+from decimal import Decimal
+from typing import Any, Callable, Dict, NamedTuple
+
+from .expressions import (
+    _AGGREGATE_FUNCTIONS,
+    _BINARY_OPERATORS,
+    AggregateMacro,
+    BinaryOperation,
+    Constant,
+    DecimalVariable,
+    LogicalOperation,
+    NamedVariable,
+    Negation,
+    Node,
+    Resolver,
+    _to_decimal,
+    _to_native,
+    _xor,
+)
+
+
+# Names available to generated code. Nothing else (not even builtins) is.
+_NAMESPACE = {
+    '__builtins__': {},
+    'Decimal': Decimal,
+    '_to_decimal': _to_decimal,
+    '_to_native': _to_native,
+    '_xor': _xor,
+    'max': max,
+    'min': min,
+}
+
+
+# Python operators of the trees' operators ('^' calls _xor instead).
+_OPERATORS = {
+    **{operator: operator for operator in _BINARY_OPERATORS if operator != '^'},
+    'and': 'and',
+    'or': 'or',
+}
+
+# Python names of the aggregate macros.
+_MACROS = {name: name for name in _AGGREGATE_FUNCTIONS}
+
+_CONSTANT_TYPES = (type(None), bool, int, float, str, Decimal)
+
+
+class CompiledExpression(NamedTuple):
+    """A formula compiled into a native Python function, and its source."""
+    source: str
+    evaluate: Callable[[Resolver], Any]
+
+
+def to_source(node: Node) -> str:
+    """Translate an expression tree into a Python expression's source.
+
+    Raise a ValueError if the tree holds an unknown operator or macro, or a
+    constant that isn't a plain literal.
+    """
+    if isinstance(node, Constant):
+        if not isinstance(node.value, _CONSTANT_TYPES):
+            raise ValueError(f'Invalid constant: {node.value!r}')
+        return repr(node.value)
+    if isinstance(node, DecimalVariable):
+        return f'_to_decimal(resolve({str(node.name)!r}))'
+    if isinstance(node, NamedVariable):
+        return f'_to_native(resolve({str(node.name)!r}))'
+    if isinstance(node, AggregateMacro):
+        args = ', '.join(to_source(arg) for arg in node.args)
+        return f'{_lookup(_MACROS, node.name)}([{args}])'
+    if isinstance(node, BinaryOperation) and node.operator == '^':
+        return f'_xor({to_source(node.left)}, {to_source(node.right)})'
+    if isinstance(node, (BinaryOperation, LogicalOperation)):
+        return f'({to_source(node.left)} {_lookup(_OPERATORS, node.operator)} {to_source(node.right)})'
+    if isinstance(node, Negation):
+        return f'(not {to_source(node.operand)})'
+    raise TypeError(f'Unknown expression tree node: {node!r}')
+
+
+def _lookup(table: Dict[str, str], key: Any) -> str:
+    try:
+        return table[key]
+    except (KeyError, TypeError):
+        raise ValueError(f'Unknown operator or macro: {key!r}')
+
+
+def to_function(node: Node) -> CompiledExpression:
+    """Compile an expression tree into a function that takes a resolver."""
+    source = f'lambda resolve: {to_source(node)}'
+    code = compile(source, '<cimbolic>', 'eval')
+    function = eval(code, dict(_NAMESPACE))
+    return CompiledExpression(source, function)
@@ -1,8 +1,20 @@
+class CircularDependencyError(Exception):
+    """Raised when variables depend on each other in a cycle."""
+    pass
+
+
 class DefaultFormulaMissingError(Exception):
     """Raised when a 'NULL' formula is missing for a Variable."""
     pass
 
 
+class FormulaSyntaxError(Exception):
+    """Raised when a condition or a rule doesn't conform to the Cimbolic grammar."""
+    def __init__(self, message: str, position: int):
+        super().__init__(f'{message} (at position {position})')
+        self.position = position
+
+
 class VariableNotFoundError(Exception):
     """Raised when a variable is not found to exist."""
     pass
@@ -0,0 +1,191 @@
+"""Immutable expression trees for compiled Cimbolic formulae.
+
+A condition or a rule is parsed once into a tree of the node classes defined
+here (see cimbolic.parsing). Evaluating a tree is a plain recursive walk that
+asks a resolver callable for the value of every named variable it meets, so
+the same tree can be evaluated any number of times against different
+contexts without touching the grammar again.
+
+The evaluation semantics are those of the original implementation, which
+joined the parsed tokens into a string and passed it to eval(): arithmetic is
+carried out on native Python numbers and operator precedence is Python's.
+"""
+
+# So that one may import * from this module.
+__all__ = [
+    'AggregateMacro',
+    'BinaryOperation',
+    'Constant',
+    'DecimalVariable',
+    'LogicalOperation',
+    'NamedVariable',
+    'Negation',
+    'Node',
+    'Resolver',
+    'named_variables',
+]
+
+import ast
+import operator
+from decimal import Decimal
+from typing import Any, Callable, Dict, List, NamedTuple, Tuple, Union
+
+
+# The following are custom type hints used in this module.
+# --------------------------------------------------------
+
+
+# A callable that takes a variable's name and returns the variable's value.
+Resolver = Callable[[str], Any]
+
+
+# The following are common functions and mappings used in this module.
+# --------------------------------------------------------------------
+
+
+def _to_native(value: Any) -> Any:
+    """Convert a variable's value to what eval() would've made of its string."""
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    if isinstance(value, Decimal):
+        text = str(value)
+        return int(text) if text.lstrip('-').isdigit() else float(text)
+    return ast.literal_eval(str(value))
+
+
+def _to_decimal(value: Any) -> Any:
+    """Convert a variable's value to a Decimal, like its decimal literal would be."""
+    if isinstance(value, Decimal) or value is None or isinstance(value, bool):
+        return value
+    if isinstance(value, int):
+        return Decimal(value)
+    if isinstance(value, float):
+        # The shortest repr of a float is the literal that it was parsed from.
+        return Decimal(repr(value))
+    return _to_decimal(_to_native(value))
+
+
+def _to_xor_operand(value: Any) -> Any:
+    if isinstance(value, Decimal):
+        if not value.is_finite() or value != value.to_integral_value():
+            raise TypeError(f"unsupported operand for ^: {value} isn't an integer")
+        return int(value)
+    return value
+
+
+def _xor(left: Any, right: Any) -> Any:
+    """Return the bitwise xor of two values, which may be integral Decimals (of the Decimal numeric backends)."""
+    if isinstance(left, Decimal) or isinstance(right, Decimal):
+        return Decimal(_to_xor_operand(left) ^ _to_xor_operand(right))
+    return left ^ right
+
+
+_BINARY_OPERATORS: Dict[str, Callable[[Any, Any], Any]] = {
+    '^': _xor,
+    '*': operator.mul,
+    '/': operator.truediv,
+    '%': operator.mod,
+    '+': operator.add,
+    '-': operator.sub,
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '>': operator.gt,
+    '<=': operator.le,
+    '>=': operator.ge,
+}
+
+_AGGREGATE_FUNCTIONS: Dict[str, Callable[[list], Any]] = {
+    'max': max,
+    'min': min,
+}
+
+
+# The following classes are the nodes of an expression tree.
+# ----------------------------------------------------------
+
+
+class Constant(NamedTuple):
+    """A literal number, string, boolean or null value."""
+    value: Any
+
+    def evaluate(self, resolve: Resolver) -> Any:
+        return self.value
+
+
+class NamedVariable(NamedTuple):
+    """A reference to a named variable (eg: $BASIC)."""
+    name: str
+
+    def evaluate(self, resolve: Resolver) -> Any:
+        return _to_native(resolve(self.name))
+
+
+class DecimalVariable(NamedVariable):
+    """A reference to a named variable whose value is converted to a Decimal."""
+    __slots__ = ()
+
+    def evaluate(self, resolve: Resolver) -> Any:
+        return _to_decimal(resolve(self.name))
+
+
+class AggregateMacro(NamedTuple):
+    """An aggregate macro (max or min) applied to its arguments."""
+    name: str
+    args: Tuple['Node', ...]
+
+    def evaluate(self, resolve: Resolver) -> Any:
+        values = [arg.evaluate(resolve) for arg in self.args]
+        return _AGGREGATE_FUNCTIONS[self.name](values)
+
+
+class BinaryOperation(NamedTuple):
+    """An arithmetic operation or a comparison between two operands."""
+    operator: str
+    left: 'Node'
+    right: 'Node'
+
+    def evaluate(self, resolve: Resolver) -> Any:
+        function = _BINARY_OPERATORS[self.operator]
+        return function(self.left.evaluate(resolve), self.right.evaluate(resolve))
+
+
+class LogicalOperation(NamedTuple):
+    """A logical combination ('and' or 'or') of two conditions."""
+    operator: str
+    left: 'Node'
+    right: 'Node'
+
+    def evaluate(self, resolve: Resolver) -> Any:
+        if self.operator == 'and':
+            return self.left.evaluate(resolve) and self.right.evaluate(resolve)
+        return self.left.evaluate(resolve) or self.right.evaluate(resolve)
+
+
+class Negation(NamedTuple):
+    """A logical negation ('not') of a condition."""
+    operand: 'Node'
+
+    def evaluate(self, resolve: Resolver) -> bool:
+        return not self.operand.evaluate(resolve)
+
+
+Node = Union[AggregateMacro, BinaryOperation, Constant, LogicalOperation, NamedVariable, Negation]
+
+
+def named_variables(node: Node) -> List[str]:
+    """Return the names of the variables referenced in a tree, in order and without duplicates."""
+    if isinstance(node, NamedVariable):
+        return [node.name]
+    if isinstance(node, AggregateMacro):
+        children = node.args
+    elif isinstance(node, (BinaryOperation, LogicalOperation)):
+        children = (node.left, node.right)
+    elif isinstance(node, Negation):
+        children = (node.operand,)
+    else:
+        children = ()
+    names: List[str] = []
+    for child in children:
+        names.extend(name for name in named_variables(child) if name not in names)
+    return names
@@ -0,0 +1,334 @@
+"""Dependency graph of variables, with cycle detection and evaluation plans.
+
+A user-sourced variable depends on every variable referenced (as $NAME) in
+the conditions and rules of its formulae. The DependencyGraph makes those
+dependencies explicit:
+
+- find_cycle_with() detects a formula that would make a variable depend on
+  itself (see Formula.save), querying only the formulae it (transitively)
+  references rather than loading the whole graph;
+- evaluation_plan() orders the variables needed for a set of variables so
+  that every variable comes after its dependencies;
+- evaluate() computes variables for a context, each at most once, in a flat
+  loop over an explicit stack instead of recursing from variable to
+  variable, after checking their plan for cycles.
+- context_keys() and all_context_keys() collect the context keys needed by
+  variables (those of the system-sourced callables they depend on), in a
+  single pass memoized by the graph.
+
+Like Variable.to_value, evaluate() resolves dependencies lazily: only the
+variables that the selected formulae (and the operands of 'and' and 'or'
+that get evaluated) use are computed, so a variable that only a branch not
+taken references is neither computed nor raises. A variable whose formula
+needs a dependency that isn't computed yet is suspended: the dependency is
+pushed onto the stack, and the variable evaluated again once it's done.
+"""
+
+# So that one may import * from this module.
+__all__ = ['DependencyGraph', 'find_cycle_with', 'get_dependency_graph']
+
+from typing import TYPE_CHECKING, Any, Dict, FrozenSet, Iterable, List, Mapping, Optional, Set, Tuple
+
+from .exceptions import CircularDependencyError
+from .registry import registry
+
+if TYPE_CHECKING:
+    from .models import Formula
+
+
+def formula_references(formula: 'Formula') -> Set[str]:
+    """Return the names of the variables referenced in a formula."""
+    from .models import named_variable_regex
+    return set(named_variable_regex.findall(formula.condition)) | set(named_variable_regex.findall(formula.rule))
+
+
+class _Unresolved(BaseException):
+    """Signal that evaluating a variable needs a dependency that isn't computed yet.
+
+    It isn't an Exception, so that formulae can't mistake it for an error.
+    """
+    def __init__(self, name: str):
+        super().__init__(name)
+        self.name = name
+
+
+class _Failure:
+    """Wrapper of an exception raised while computing a variable of a plan."""
+    def __init__(self, exception: Exception):
+        self.exception = exception
+
+
+def _get_value(values: Dict[str, Any], name: str) -> Any:
+    """Return a computed value, raising the exception that computing it raised."""
+    value = values[name]
+    if isinstance(value, _Failure):
+        raise value.exception
+    return value
+
+
+class DependencyGraph:
+    """Graph of variables (by name) and the variables they depend on."""
+    def __init__(self, dependencies: Mapping[str, Set[str]]):
+        self.dependencies: Dict[str, Set[str]] = dict(dependencies)
+        # Memoized context keys and missing variables of each variable, valid
+        # for the system-sourced variables they were collected with.
+        self._system_variables: Optional[Dict[str, Tuple[Any, List[str]]]] = None
+        self._context_keys: Dict[str, FrozenSet[str]] = {}
+        self._missing: Dict[str, FrozenSet[str]] = {}
+
+    @classmethod
+    def from_formulae(cls, variable_names: Iterable[str], formulae: Iterable['Formula']) -> 'DependencyGraph':
+        dependencies: Dict[str, Set[str]] = {name: set() for name in variable_names}
+        for formula in formulae:
+            dependencies.setdefault(formula.variable.name, set()).update(formula_references(formula))
+        return cls(dependencies)
+
+    def _find_cycle(self, dependencies: Mapping[str, Set[str]], start: str) -> Optional[List[str]]:
+        """Return a cycle through the start variable, if any (iteratively)."""
+        path = [start]
+        stack = [iter(sorted(dependencies.get(start, ())))]
+        visited = {start}
+        while stack:
+            name = next(stack[-1], None)
+            if name is None:
+                stack.pop()
+                path.pop()
+            elif name == start:
+                return path + [start]
+            elif name not in visited:
+                visited.add(name)
+                path.append(name)
+                stack.append(iter(sorted(dependencies.get(name, ()))))
+        return None
+
+    def find_cycle(self) -> Optional[List[str]]:
+        """Return a cycle (as a list of names, first and last equal), if any."""
+        for name in sorted(self.dependencies):
+            cycle = self._find_cycle(self.dependencies, name)
+            if cycle:
+                return cycle
+        return None
+
+    def find_cycle_with_references(self, references: Mapping[str, Set[str]]) -> Optional[List[str]]:
+        """Return a cycle that replacing the references of variables would create, if any."""
+        dependencies = dict(self.dependencies)
+        dependencies.update(references)
+        for name in sorted(references):
+            cycle = self._find_cycle(dependencies, name)
+            if cycle:
+                return cycle
+        return None
+
+    def _post_order(self, names: Iterable[str], done: Set[str]) -> List[str]:
+        """Return the named variables and their dependencies that aren't done, dependencies first."""
+        plan: List[str] = []
+        for root in names:
+            if root in done:
+                continue
+            # Iterative depth-first search, appending variables in post-order.
+            path: List[str] = [root]
+            stack: List[Tuple[str, Any]] = [(root, iter(sorted(self.dependencies.get(root, ()))))]
+            while stack:
+                name, children = stack[-1]
+                child = next(children, None)
+                if child is None:
+                    stack.pop()
+                    path.pop()
+                    done.add(name)
+                    plan.append(name)
+                elif child in path:
+                    cycle = path[path.index(child):] + [child]
+                    raise CircularDependencyError(
+                        f'Circular dependency: {" -> ".join(f"${name}" for name in cycle)}'
+                    )
+                elif child not in done:
+                    path.append(child)
+                    stack.append((child, iter(sorted(self.dependencies.get(child, ())))))
+        return plan
+
+    def evaluation_plan(self, names: Iterable[str]) -> List[str]:
+        """Return the named variables and their dependencies, dependencies first.
+
+        Raise a CircularDependencyError if any of them depend on themselves.
+        """
+        return self._post_order(names, set())
+
+    def _collect_context_keys(self, names: Iterable[str]):
+        """Memoize the context keys and missing variables of the named variables."""
+        from . import get_system_variables
+        from .models import Variable
+        names = list(names)
+        sys_vars = get_system_variables()
+        if sys_vars is self._system_variables and all(name in self._context_keys for name in names):
+            return
+        if sys_vars is not self._system_variables:
+            # The system-sourced variables file was read again.
+            self._system_variables = sys_vars
+            self._context_keys = {}
+            self._missing = {}
+        context_keys = self._context_keys
+        missing = self._missing
+        for name in self._post_order(names, set(context_keys)):
+            if name not in self.dependencies:
+                # Referenced, but not an (active) variable.
+                context_keys[name] = frozenset()
+                missing[name] = frozenset([name])
+                continue
+            keys: Set[str] = set()
+            names_missing: Set[str] = set()
+            try:
+                var = registry.get_variable(name)
+            except Variable.DoesNotExist:
+                var = None
+            if var is not None and var.source == var.SYSTEM and name in sys_vars:
+                action, action_args = sys_vars[name]
+                if callable(action):
+                    keys.update(action_args)
+            for dependency in self.dependencies[name]:
+                keys |= context_keys[dependency]
+                names_missing |= missing[dependency]
+            context_keys[name] = frozenset(keys)
+            missing[name] = frozenset(names_missing)
+
+    def context_keys(self, names: Iterable[str]) -> Dict[str, FrozenSet[str]]:
+        """Return the context keys needed by each of the variables of a plan.
+
+        The plan is that of the named variables, so the returned dict has an
+        entry for every dependency as well.
+        """
+        plan = self.evaluation_plan(names)
+        self._collect_context_keys(plan)
+        return {name: self._context_keys[name] for name in plan}
+
+    def all_context_keys(self) -> Dict[str, FrozenSet[str]]:
+        """Return the context keys needed by every variable of the graph, by name."""
+        names = sorted(self.dependencies)
+        self._collect_context_keys(names)
+        return {name: self._context_keys[name] for name in names}
+
+    def required_context_keys(self, name: str) -> FrozenSet[str]:
+        """Return the context keys needed by the named variable."""
+        self._collect_context_keys([name])
+        return self._context_keys[name]
+
+    def missing_variables(self, name: str) -> FrozenSet[str]:
+        """Return the names referenced by the named variable (or its dependencies) that aren't variables."""
+        self._collect_context_keys([name])
+        return self._missing[name]
+
+    def compute(
+            self,
+            names: Iterable[str],
+            stale: Iterable[str],
+            context: Optional[Dict[str, Any]],
+            values: Dict[str, Any],
+    ) -> int:
+        """Compute the named variables into the values dict, resolving their dependencies lazily.
+
+        The values of stale variables are discarded first; those of other
+        variables are read from the values dict as they are, and only
+        computed if they're missing (and needed). Return the number of
+        variables computed.
+        """
+        from .models import Variable
+        for name in stale:
+            values.pop(name, None)
+
+        def resolve(var_name: str) -> Any:
+            if var_name not in values:
+                raise _Unresolved(var_name)
+            return _get_value(values, var_name)
+
+        computed = 0
+        stack = [name for name in reversed(list(names)) if name not in values]
+        on_stack = set(stack)
+        while stack:
+            name = stack[-1]
+            if name in values:
+                stack.pop()
+                on_stack.discard(name)
+                continue
+            try:
+                try:
+                    var = registry.get_variable(name)
+                except Variable.DoesNotExist:
+                    raise LookupError(f'Variable {name} not found in the database')
+                value = var._evaluate(context, resolve)
+            except _Unresolved as unresolved:
+                dependency = unresolved.name
+                if dependency not in on_stack:
+                    stack.append(dependency)
+                    on_stack.add(dependency)
+                    continue
+                cycle = stack[stack.index(dependency):] + [dependency]
+                value = _Failure(CircularDependencyError(
+                    f'Circular dependency: {" -> ".join(f"${name}" for name in cycle)}'
+                ))
+            except Exception as exc:
+                value = _Failure(exc)
+            values[name] = value
+            computed += 1
+            stack.pop()
+            on_stack.discard(name)
+        return computed
+
+    def evaluate(self, names: Iterable[str], context: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Compute the named variables for a context.
+
+        Return a {variable name: value} dict of the named variables. Raise a
+        CircularDependencyError if any of them depend on themselves.
+        """
+        names = list(names)
+        values: Dict[str, Any] = {}
+        self.compute(names, self.evaluation_plan(names), context, values)
+        return {name: _get_value(values, name) for name in names}
+
+
+# Number of variables whose formulae find_cycle_with() queries at once.
+CYCLE_QUERY_BATCH_SIZE = 500
+
+
+def find_cycle_with(formula: 'Formula') -> Optional[List[str]]:
+    """Return the cycle that saving the formula would create, if any.
+
+    Any such cycle goes from the formula's variable back to itself through
+    the variables the formula references, so only the formulae of those
+    variables (and of the variables they reference, and so on) are queried,
+    one query per level of references.
+    """
+    from .models import Formula, named_variable_regex
+    name = formula.variable.name
+    dependencies: Dict[str, Set[str]] = {name: formula_references(formula)}
+    queried = {name}
+    level = dependencies[name] - queried
+    while level:
+        queried |= level
+        found: Set[str] = set()
+        names = sorted(level)
+        for start in range(0, len(names), CYCLE_QUERY_BATCH_SIZE):
+            rows = Formula.objects.filter(
+                variable__name__in=names[start:start + CYCLE_QUERY_BATCH_SIZE],
+                variable__is_active=True,
+            ).values_list('variable__name', 'condition', 'rule')
+            for var_name, condition, rule in rows:
+                references = set(named_variable_regex.findall(condition)) | set(named_variable_regex.findall(rule))
+                dependencies.setdefault(var_name, set()).update(references)
+                found |= references
+        level = found - queried
+    return DependencyGraph(dependencies)._find_cycle(dependencies, name)
+
+
+# The graph built from the registry's current snapshot.
+_cached_graph: Optional[Tuple[Any, DependencyGraph]] = None
+
+
+def get_dependency_graph() -> DependencyGraph:
+    """Return the dependency graph of the active variables."""
+    global _cached_graph
+    snapshot = registry.snapshot()
+    cached_graph = _cached_graph
+    if cached_graph is None or cached_graph[0] is not snapshot:
+        formulae = [formula for var_formulae in snapshot.formulae.values() for formula in var_formulae]
+        cached_graph = (snapshot, DependencyGraph.from_formulae(snapshot.variables, formulae))
+        _cached_graph = cached_graph
+    return cached_graph[1]
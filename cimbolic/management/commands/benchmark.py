@@ -0,0 +1,99 @@
+import json
+import sys
+from argparse import ArgumentParser
+
+from django.core.management.base import BaseCommand, CommandError
+
+from cimbolic.benchmarks import BENCHMARKS, compare_results, run_benchmarks
+
+
+class Command(BaseCommand):
+    """Management command to run the benchmarks of parsing, evaluation and dependency resolution."""
+    help = (
+        'Times parsing, evaluation and dependency resolution on generated variables '
+        '(rolled back afterwards), writes the results as JSON and optionally flags regressions'
+    )
+
+    def add_arguments(self, parser: ArgumentParser):
+        parser.add_argument(
+            '-o', '--output',
+            help='file to write the results to as JSON (default: standard output)',
+        )
+        parser.add_argument(
+            '--repeat',
+            help='number of timed rounds per benchmark (default: 5)',
+            type=int,
+            default=5,
+        )
+        parser.add_argument(
+            '--min-time',
+            help='minimum duration of a round in seconds (default: 0.1)',
+            type=float,
+            default=0.1,
+        )
+        parser.add_argument(
+            '--only',
+            help=f'run only the given benchmarks (any of: {", ".join(b.name for b in BENCHMARKS)})',
+            nargs='+',
+            metavar='NAME',
+        )
+        parser.add_argument(
+            '--compare',
+            help='JSON file of earlier results to compare with',
+            metavar='BASELINE',
+        )
+        parser.add_argument(
+            '--threshold',
+            help='slow-down (as a fraction of the baseline time) flagged as a regression (default: 0.2)',
+            type=float,
+            default=0.2,
+        )
+
+    def handle(self, *args, **options):
+        if options['repeat'] < 1:
+            raise CommandError('The number of rounds must be positive')
+        baseline = None
+        if options['compare']:
+            try:
+                with open(options['compare'], encoding='utf-8') as f:
+                    baseline = json.load(f)
+            except (OSError, ValueError) as exc:
+                raise CommandError(f'Cannot read the baseline: {exc}')
+
+        # Progress goes to stderr when the results go to stdout.
+        progress = self.stderr if options['output'] is None else self.stdout
+
+        def report(name, result):
+            line = f'{name:<28}{result["min"] * 1e6:>14.1f} us/call  ({result["number"]} calls/round)'
+            if 'recomputed' in result:
+                line += f'  {result["recomputed"]} recomputed, {result["reused"]} reused'
+            progress.write(line)
+
+        try:
+            results = run_benchmarks(options['only'], options['repeat'], options['min_time'], report)
+        except ValueError as exc:
+            raise CommandError(str(exc))
+
+        if options['output'] is None:
+            json.dump(results, sys.stdout, indent=2)
+            sys.stdout.write('\n')
+        else:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                json.dump(results, f, indent=2)
+            self.stdout.write(self.style.SUCCESS(f'Wrote the results to {options["output"]}'))
+
+        if baseline is not None:
+            comparisons = compare_results(results, baseline, options['threshold'])
+            regressions = [comparison for comparison in comparisons if comparison.is_regression]
+            for comparison in comparisons:
+                line = (
+                    f'{comparison.name:<28}{comparison.baseline * 1e6:>14.1f} -> '
+                    f'{comparison.current * 1e6:.1f} us/call ({comparison.ratio:.2f}x)'
+                )
+                progress.write(self.style.ERROR(line) if comparison.is_regression else line)
+            if regressions:
+                raise CommandError(
+                    f'{len(regressions)} benchmarks regressed by more than {options["threshold"]:.0%}: '
+                    + ', '.join(comparison.name for comparison in regressions)
+                )
+            progress.write(self.style.SUCCESS(f'No regressions among {len(comparisons)} benchmarks'))
@@ -0,0 +1,231 @@
+import random
+import time
+from argparse import ArgumentParser
+from typing import Callable, List, Tuple
+
+import pyparsing as pp
+from django.core.management.base import BaseCommand, CommandError
+
+from cimbolic.exceptions import FormulaSyntaxError
+from cimbolic.models import Formula
+from cimbolic.parsing import _pyparsing_parse_condition, _pyparsing_parse_rule, parse_condition, parse_rule
+
+
+CONDITION = 'condition'
+RULE = 'rule'
+
+_PARSERS = {
+    CONDITION: (_pyparsing_parse_condition, parse_condition),
+    RULE: (_pyparsing_parse_rule, parse_rule),
+}
+
+# Fragments inserted into generated formulae to make them (mostly) invalid.
+_MUTATIONS = [
+    '(', ')', '$', '-', '+', '*', ' ', '\t', ',', '.', '"', '==', '<', '=',
+    '1', 'x', '\\', 'and ', ' or', 'not ', 'true', 'NULL', 'max(', 'Min(',
+]
+
+
+def _outcome(parse: Callable, text: str) -> Tuple:
+    """Return what parsing the text results in, in comparable terms."""
+    try:
+        return 'tree', repr(parse(text))
+    except (pp.ParseException, FormulaSyntaxError) as exc:
+        return 'syntax error', exc.loc if isinstance(exc, pp.ParseException) else exc.position
+    except RecursionError:
+        return 'recursion error',
+    except Exception as exc:
+        return 'error', type(exc).__name__
+
+
+def _agree(expected: Tuple, actual: Tuple) -> bool:
+    """Return whether the outcomes of the PyParsing grammar and the hand-written parser agree."""
+    # The hand-written parser reports formulae that the grammar recurses
+    # endlessly on as syntax errors.
+    return expected == actual or (expected[0] == 'recursion error' and actual[0] == 'syntax error')
+
+
+class _FormulaGenerator:
+    """Generator of random conditions and rules, valid or not."""
+    def __init__(self, seed: int, max_depth: int):
+        self.random = random.Random(seed)
+        self.max_depth = max_depth
+
+    def space(self) -> str:
+        return self.random.choice(['', ' ', ' ', ' ', '  ', '\t', '\n'])
+
+    def case(self, word: str) -> str:
+        return self.random.choice([word, word.upper(), word.capitalize()])
+
+    def number(self) -> str:
+        sign = self.random.choice(['', '', '', '-', '+'])
+        return sign + self.random.choice([
+            str(self.random.randint(0, 99)),
+            f'{self.random.randint(0, 99)}.{self.random.randint(0, 99)}',
+            f'.{self.random.randint(0, 9)}',
+        ])
+
+    def rule(self, depth: int = 0) -> str:
+        choice = self.random.random()
+        if depth >= self.max_depth or choice < 0.35:
+            if self.random.random() < 0.5:
+                return self.number()
+            return '$' + self.random.choice(['A', 'B', 'basic', 'X_1', '_y'])
+        if choice < 0.5:
+            args = [self.rule(depth + 1) for __ in range(self.random.randint(1, 3))]
+            return self.case(self.random.choice(['max', 'min'])) + '(' + f',{self.space()}'.join(args) + ')'
+        if choice < 0.65:
+            return '(' + self.space() + self.rule(depth + 1) + self.space() + ')'
+        operator = self.random.choice(['+', '-', '*', '/', '%', '^'])
+        return self.rule(depth + 1) + self.space() + operator + self.space() + self.rule(depth + 1)
+
+    def literal(self) -> str:
+        return self.random.choice([
+            self.case('true'), self.case('false'), self.case('null'), '"some text"', '"x"',
+        ])
+
+    def condition(self, depth: int = 0) -> str:
+        choice = self.random.random()
+        if depth >= self.max_depth or choice < 0.4:
+            if self.random.random() < 0.3:
+                operator, right = self.random.choice(['==', '!=']), self.literal()
+            else:
+                operator = self.random.choice(['==', '!=', '<', '>', '<=', '>='])
+                right = self.rule(depth + 1)
+            return self.rule(depth + 1) + self.space() + operator + self.space() + right
+        if choice < 0.55:
+            return '(' + self.space() + self.condition(depth + 1) + self.space() + ')'
+        if choice < 0.65:
+            return self.case('not') + ' ' + self.condition(depth + 1)
+        operator = self.case(self.random.choice(['and', 'or']))
+        return self.condition(depth + 1) + ' ' + operator + ' ' + self.condition(depth + 1)
+
+    def mutate(self, text: str) -> str:
+        for __ in range(self.random.randint(1, 3)):
+            position = self.random.randint(0, len(text))
+            mutation = self.random.random()
+            if mutation < 0.4:
+                text = text[:position] + text[position + 1:]
+            elif mutation < 0.9:
+                text = text[:position] + self.random.choice(_MUTATIONS) + text[position:]
+            else:
+                text = text[:position]
+        return text
+
+    def generate(self, kind: str) -> str:
+        text = self.condition() if kind == CONDITION else self.rule()
+        if self.random.random() < 0.5:
+            text = self.mutate(text)
+        return text
+
+
+def _time_per_parse(parse: Callable, text: str, budget: float = 0.2) -> float:
+    """Return the time a parse takes (in seconds), repeated for about the budget."""
+    count = 0
+    start = time.perf_counter()
+    elapsed = 0.0
+    while elapsed < budget or not count:
+        parse(text)
+        count += 1
+        elapsed = time.perf_counter() - start
+    return elapsed / count
+
+
+class Command(BaseCommand):
+    """Management command to check the hand-written parser against the PyParsing grammar."""
+    help = (
+        'Checks that the hand-written parser parses random and stored formulae '
+        'like the PyParsing grammar does, and optionally benchmarks both'
+    )
+
+    def add_arguments(self, parser: ArgumentParser):
+        parser.add_argument(
+            '-n', '--cases',
+            help='number of random conditions and rules (each) to check (default: 2000)',
+            type=int,
+            default=2000,
+        )
+        parser.add_argument(
+            '--seed',
+            help='seed of the random formulae (default: 0)',
+            type=int,
+            default=0,
+        )
+        parser.add_argument(
+            '--max-depth',
+            help='maximum nesting depth of the random formulae (default: 4)',
+            type=int,
+            default=4,
+        )
+        parser.add_argument(
+            '--benchmark',
+            help='measure the parse time of long and deeply nested formulae with both parsers',
+            action='store_true',
+        )
+
+    def handle(self, *args, **options):
+        generator = _FormulaGenerator(options['seed'], options['max_depth'])
+        cases: List[Tuple[str, str]] = []
+        for formula in Formula.objects.all():
+            cases.append((CONDITION, formula.condition))
+            cases.append((RULE, formula.rule))
+        for __ in range(options['cases']):
+            cases.append((CONDITION, generator.generate(CONDITION)))
+            cases.append((RULE, generator.generate(RULE)))
+
+        counts = {'tree': 0, 'syntax error': 0, 'recursion error': 0, 'error': 0}
+        mismatches = []
+        for kind, text in cases:
+            reference_parse, parse = _PARSERS[kind]
+            expected = _outcome(reference_parse, text)
+            actual = _outcome(parse, text)
+            if _agree(expected, actual):
+                counts[expected[0]] += 1
+            else:
+                mismatches.append((kind, text, expected, actual))
+
+        self.stdout.write(
+            f'Checked {len(cases)} formulae: {counts["tree"]} identical trees, '
+            f'{counts["syntax error"]} syntax errors at the same positions, '
+            f'{counts["recursion error"]} endless recursions reported as syntax errors, '
+            f'{counts["error"]} identical errors'
+        )
+        for kind, text, expected, actual in mismatches[:20]:
+            self.stderr.write(f'- {kind} {text!r}: expected {expected}, got {actual}')
+
+        if options['benchmark']:
+            self.benchmark()
+
+        if mismatches:
+            raise CommandError(f'{len(mismatches)} formulae are parsed differently')
+        self.stdout.write(self.style.SUCCESS('The parsers agree'))
+
+    def benchmark(self):
+        families = [
+            ('long rule', RULE, (10, 100, 1000), lambda n: ' + '.join(f'$V{k} * {k}' for k in range(n))),
+            ('nested rule', RULE, (5, 10, 20, 40), lambda n: '(' * n + '$A + 1' + ')' * n),
+            ('nested macros', RULE, (5, 10, 20, 40), lambda n: 'max(' * n + '$A' + ', 1)' * n),
+            ('long condition', CONDITION, (10, 100, 1000), lambda n: ' and '.join(f'$V{k} > {k}' for k in range(n))),
+            ('nested condition', CONDITION, (4, 8, 12, 16, 40), lambda n: '(' * n + '$A + 1' + ')' * n + ' > 2'),
+        ]
+        self.stdout.write(f'{"formulae":<18}{"size":>6}{"pyparsing (ms)":>18}{"hand-written (ms)":>20}{"speed-up":>10}')
+        for name, kind, sizes, make_formula in families:
+            reference_parse, parse = _PARSERS[kind]
+            reference_too_slow = False
+            for size in sizes:
+                text = make_formula(size)
+                duration = _time_per_parse(parse, text)
+                if reference_too_slow:
+                    reference = 'skipped'
+                    speed_up = ''
+                else:
+                    try:
+                        reference_duration = _time_per_parse(reference_parse, text)
+                    except RecursionError:
+                        reference = 'recursion error'
+                        speed_up = ''
+                    else:
+                        reference = f'{reference_duration * 1000:.2f}'
+                        speed_up = f'{reference_duration / duration:.0f}x'
+                        reference_too_slow = reference_duration > 2
+                self.stdout.write(f'{name:<18}{size:>6}{reference:>18}{duration * 1000:>20.3f}{speed_up:>10}')
@@ -0,0 +1,55 @@
+import json
+from argparse import ArgumentParser
+
+from django.core.management.base import BaseCommand, CommandError
+
+from cimbolic.models import Variable
+from cimbolic.numeric import DECIMAL, compare_numeric_backends
+
+
+class Command(BaseCommand):
+    """Management command to compare the speed and accuracy of the numeric backends."""
+    help = (
+        'Evaluates variables for a list of contexts with each numeric backend (float, decimal and fixed), '
+        'and reports the time per context and the deviation of the values from those of the decimal backend'
+    )
+
+    def add_arguments(self, parser: ArgumentParser):
+        parser.add_argument(
+            'vars',
+            nargs='+',
+            help='The name of the variable',
+            metavar='variable',
+        )
+        parser.add_argument(
+            '-c', '--contexts',
+            help='path to a JSON file containing a list of contexts (default: a single empty context)',
+        )
+
+    def handle(self, *args, **options):
+        var_names = [var.lstrip('$') for var in options['vars']]
+        for var_name in var_names:
+            # Only active variables are evaluated.
+            if not Variable.objects.filter(name=var_name, is_active=True).exists():
+                raise CommandError(f'Nonexistent or inactive variable ${var_name}')
+
+        contexts = [{}]
+        if options['contexts']:
+            try:
+                with open(options['contexts'], encoding='utf-8') as f:
+                    contexts = json.load(f)
+            except (OSError, ValueError) as exc:
+                raise CommandError(f"Can't read contexts from {options['contexts']}: {exc}")
+            if not isinstance(contexts, list):
+                raise CommandError('The contexts file must contain a JSON list of objects')
+
+        values = len(var_names) * len(contexts)
+        for comparison in compare_numeric_backends(var_names, contexts):
+            accuracy = 'reference' if comparison.backend == DECIMAL else (
+                f'{comparison.differences} of {values} values differ'
+                + (f' (max deviation {comparison.max_deviation:E})' if comparison.max_deviation is not None else '')
+            )
+            self.stdout.write(self.style.SUCCESS(
+                f'- {comparison.backend}: {comparison.seconds * 1e6:.1f}us per context, {accuracy}, '
+                f'{comparison.failures} failures'
+            ))
@@ -0,0 +1,54 @@
+from argparse import ArgumentParser
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from cimbolic.models import Formula
+from cimbolic.registry import registry
+from cimbolic.serialization import FORMAT_VERSION
+
+
+class Command(BaseCommand):
+    """Management command to rebuild the stored compiled form of Formula objects."""
+    help = 'Rebuilds the serialized expression trees stored with the formulae (eg: after an upgrade)'
+
+    def add_arguments(self, parser: ArgumentParser):
+        parser.add_argument(
+            '--all',
+            help='rebuild every formula, not just those without an up-to-date compiled form',
+            action='store_true',
+        )
+        parser.add_argument(
+            '--batch-size',
+            help='number of formulae updated per query (default: 500)',
+            type=int,
+            default=500,
+        )
+
+    def handle(self, *args, **options):
+        formulae = Formula.objects.select_related('variable').order_by('pk')
+        if not options['all']:
+            formulae = formulae.exclude(compiled_format_version=FORMAT_VERSION)
+
+        compiled = []
+        failed = []
+        for formula in formulae.iterator():
+            formula.compile()
+            compiled.append(formula)
+            if formula.compiled_format_version != FORMAT_VERSION:
+                failed.append(formula)
+
+        with transaction.atomic():
+            Formula.objects.bulk_update(
+                compiled,
+                ['compiled_condition', 'compiled_rule', 'compiled_format_version'],
+                batch_size=options['batch_size'],
+            )
+        # Bulk updates don't send the signals that invalidate the registry.
+        registry.invalidate()
+
+        for formula in failed:
+            self.stderr.write(self.style.WARNING(f"Formula {formula} (pk {formula.pk}) doesn't parse"))
+        self.stdout.write(self.style.SUCCESS(
+            f'Compiled {len(compiled) - len(failed)} formulae (format version {FORMAT_VERSION})'
+        ))
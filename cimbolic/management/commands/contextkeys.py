@@ -2,20 +2,27 @@ from argparse import ArgumentParser
 
 from django.core.management.base import BaseCommand, CommandError
 
+from cimbolic.exceptions import CircularDependencyError
+from cimbolic.graph import get_dependency_graph
 from cimbolic.models import get_all_context_keys, Variable
 
 
 class Command(BaseCommand):
     """Management command to list all the context keys for a Variable."""
-    help = 'Displays a set of context keys for each specified variable'
+    help = 'Displays a set of context keys for each specified variable (or every active variable)'
 
     def add_arguments(self, parser: ArgumentParser):
         parser.add_argument(
             'vars',
-            nargs='+',
+            nargs='*',
             help='The name of the variable',
             metavar='variable',
         )
+        parser.add_argument(
+            '-a', '--all',
+            help='display the context keys of every active variable',
+            action='store_true',
+        )
         parser.add_argument(
             '-u', '--union',
             help='display the collective list of context keys',
@@ -23,27 +30,40 @@ class Command(BaseCommand):
         )
 
     def handle(self, *args, **options):
-        variables = []
-        for var in options['vars']:
-            var_name = var.lstrip('$')
+        if options['all'] == bool(options['vars']):
+            raise CommandError('Specify either the variables or --all')
+
+        if options['all']:
+            # Every variable is analysed in a single pass over the graph.
             try:
-                variables.append(Variable.objects.get(name=var_name))
-            except Variable.DoesNotExist:
-                raise CommandError(f'Variable ${var_name} not found in the database')
+                context_key_dict = {
+                    name: set(context_keys)
+                    for name, context_keys in get_dependency_graph().all_context_keys().items()
+                }
+            except CircularDependencyError as exc:
+                raise CommandError(str(exc))
+
+        else:
+            variables = []
+            for var in options['vars']:
+                var_name = var.lstrip('$')
+                try:
+                    variables.append(Variable.objects.get(name=var_name))
+                except Variable.DoesNotExist:
+                    raise CommandError(f'Variable ${var_name} not found in the database')
 
-        get_all_context_keys.cache_clear()
-        context_key_dict = dict([
-            (variable.name, set(get_all_context_keys(variable)))
-            for variable in variables
-        ])
+            context_key_dict = dict([
+                (variable.name, set(get_all_context_keys(variable)))
+                for variable in variables
+            ])
 
         if options['union']:
             context_keys = set()
             for ck_set in context_key_dict.values():
                 context_keys |= ck_set
-            self.stdout.write(self.style.SUCCESS(f'- {list(context_keys)}'))
+            self.stdout.write(self.style.SUCCESS(f'- {sorted(context_keys)}'))
 
         else:
             for var in context_key_dict:
                 self.stdout.write(self.style.SUCCESS(f'- ${var}'), ending=': ')
-                self.stdout.write(self.style.SUCCESS(f'{list(context_key_dict[var])}'))
+                self.stdout.write(self.style.SUCCESS(f'{sorted(context_key_dict[var])}'))
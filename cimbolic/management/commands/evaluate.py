@@ -0,0 +1,207 @@
+import csv
+import json
+import re
+import sys
+import time
+from argparse import ArgumentParser
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Iterator, List, TextIO, Tuple
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.serializers.json import DjangoJSONEncoder
+
+from cimbolic.models import Variable
+from cimbolic.numeric import NUMERIC_BACKENDS
+from cimbolic.parallel import DEFAULT_CHUNK_SIZE, evaluate_stream
+
+
+# Formats of the contexts and results.
+CSV_FORMAT = 'csv'
+JSONL_FORMAT = 'jsonl'
+
+# Name of the column (or key) holding the error raised for a context.
+ERROR_COLUMN = 'error'
+
+
+# A plain decimal number, without leading zeros (which identifiers may have),
+# exponents or special values like 'nan' and 'inf'.
+number_regex = re.compile(r'-?(0|[1-9][0-9]*)(\.[0-9]+)?')
+
+
+def _parse_cell(value: str) -> Any:
+    """Return the number a CSV cell holds, if it's a plain decimal number, or else its text."""
+    match = number_regex.fullmatch(value)
+    if match is None:
+        return value
+    return float(value) if match.group(2) else int(value)
+
+
+def read_csv(file: TextIO) -> Tuple[List[str], Iterator[Dict[str, Any]]]:
+    """Return the columns of a CSV file with a header row, and an iterator over its rows as contexts.
+
+    Cells holding plain decimal numbers (eg: -12 or 0.5, but not 007 or 1e5)
+    become numbers, and empty cells are left out of the context.
+    """
+    reader = csv.DictReader(file)
+    fields = list(reader.fieldnames or [])
+
+    def rows():
+        for row in reader:
+            yield {key: _parse_cell(value) for key, value in row.items() if key is not None and value != ''}
+    return fields, rows()
+
+
+def read_jsonl(file: TextIO) -> Iterator[Dict[str, Any]]:
+    """Yield the contexts of a JSON Lines file (one object per line)."""
+    for line_number, line in enumerate(file, 1):
+        if not line.strip():
+            continue
+        try:
+            context = json.loads(line)
+        except ValueError as exc:
+            raise CommandError(f'Line {line_number}: invalid JSON ({exc})')
+        if not isinstance(context, dict):
+            raise CommandError(f'Line {line_number}: expected an object')
+        yield context
+
+
+class Command(BaseCommand):
+    """Management command to evaluate variables for contexts streamed from a CSV or JSON Lines file."""
+    help = (
+        'Evaluates variables for every context of a CSV or JSON Lines file (or standard input), '
+        'writing each context along with the values as they are computed, in the same format'
+    )
+
+    def add_arguments(self, parser: ArgumentParser):
+        parser.add_argument(
+            'vars',
+            nargs='+',
+            help='The name of the variable',
+            metavar='variable',
+        )
+        parser.add_argument(
+            '-i', '--input',
+            help="file to read the contexts from ('-' or default: standard input)",
+            default='-',
+        )
+        parser.add_argument(
+            '-o', '--output',
+            help='file to write the results to (default: standard output)',
+        )
+        parser.add_argument(
+            '-f', '--format',
+            help='format of the contexts and results (default: csv for a .csv input file, else jsonl)',
+            choices=[CSV_FORMAT, JSONL_FORMAT],
+        )
+        parser.add_argument(
+            '-w', '--workers',
+            help='number of worker processes (default: 1, evaluating in this process)',
+            type=int,
+            default=1,
+        )
+        parser.add_argument(
+            '--chunk-size',
+            help=f'number of contexts evaluated at a time (default: {DEFAULT_CHUNK_SIZE})',
+            type=int,
+            default=DEFAULT_CHUNK_SIZE,
+        )
+        parser.add_argument(
+            '--numeric',
+            help='numeric backend to compute with (default: the CIMBOLIC_NUMERIC_BACKEND setting)',
+            choices=NUMERIC_BACKENDS,
+        )
+        parser.add_argument(
+            '--error-column',
+            help=f'write the error raised for a context in an {ERROR_COLUMN!r} column instead of aborting',
+            action='store_true',
+        )
+
+    def handle(self, *args, **options):
+        if options['workers'] < 1 or options['chunk_size'] < 1:
+            raise CommandError('The number of workers and the chunk size must be positive')
+        var_names = [var.lstrip('$') for var in options['vars']]
+        for var_name in var_names:
+            if not Variable.objects.filter(name=var_name, is_active=True).exists():
+                raise CommandError(f'Nonexistent or inactive variable ${var_name}')
+
+        file_format = options['format'] or (
+            CSV_FORMAT if options['input'] != '-' and options['input'].lower().endswith('.csv') else JSONL_FORMAT
+        )
+        start = time.perf_counter()
+        try:
+            input_file = sys.stdin if options['input'] == '-' else open(options['input'], encoding='utf-8', newline='')
+        except OSError as exc:
+            raise CommandError(f"Can't read contexts from {options['input']}: {exc}")
+        try:
+            try:
+                output = (
+                    open(options['output'], 'w', encoding='utf-8', newline='') if options['output'] else self.stdout
+                )
+            except OSError as exc:
+                raise CommandError(f"Can't write the results to {options['output']}: {exc}")
+            try:
+                rows, errors = self.evaluate(input_file, output, file_format, var_names, options)
+            finally:
+                if output is not self.stdout:
+                    output.close()
+        finally:
+            if input_file is not sys.stdin:
+                input_file.close()
+
+        if options['verbosity'] > 0:
+            self.stderr.write(
+                f'Evaluated {len(var_names)} variables for {rows} contexts ({errors} failed) '
+                f'in {time.perf_counter() - start:.2f}s',
+                style_func=self.style.SUCCESS,
+            )
+
+    def evaluate(
+            self,
+            input_file: TextIO,
+            output: TextIO,
+            file_format: str,
+            var_names: List[str],
+            options: Dict[str, Any],
+    ) -> Tuple[int, int]:
+        """Evaluate the variables for every context of the input, writing the results as they come.
+
+        Return the number of contexts and of those whose evaluation failed.
+        """
+        write_row: Callable[[Dict[str, Any]], Any]
+        if file_format == CSV_FORMAT:
+            fields, contexts = read_csv(input_file)
+            fields += [name for name in var_names if name not in fields]
+            if options['error_column']:
+                fields.append(ERROR_COLUMN)
+            writer = csv.DictWriter(output, fields, extrasaction='ignore', lineterminator='\n')
+            writer.writeheader()
+            write_row = writer.writerow
+        else:
+            contexts = read_jsonl(input_file)
+
+            def write_row(row: Dict[str, Any]):
+                output.write(json.dumps(row, cls=DjangoJSONEncoder) + '\n')
+
+        # The contexts are written along with their results, so they're kept
+        # until their chunk has been evaluated, and no longer.
+        pending: Deque[Dict[str, Any]] = deque()
+
+        def stream():
+            for context in contexts:
+                pending.append(context)
+                yield context
+
+        rows = errors = 0
+        results = evaluate_stream(var_names, stream(), options['workers'], options['chunk_size'], options['numeric'])
+        for result in results:
+            context = pending.popleft()
+            rows += 1
+            if result.error is not None:
+                errors += 1
+                if not options['error_column']:
+                    raise CommandError(f'Context {rows}: {result.error}')
+            row = {**context, **result.values}
+            if options['error_column']:
+                row[ERROR_COLUMN] = result.error or ''
+            write_row(row)
+        return rows, errors
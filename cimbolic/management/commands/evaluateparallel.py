@@ -0,0 +1,92 @@
+import json
+import time
+from argparse import ArgumentParser
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.serializers.json import DjangoJSONEncoder
+
+from cimbolic.models import Variable
+from cimbolic.numeric import NUMERIC_BACKENDS
+from cimbolic.parallel import DEFAULT_CHUNK_SIZE, evaluate_parallel
+
+
+class Command(BaseCommand):
+    """Management command to evaluate variables for many contexts in parallel."""
+    help = 'Evaluates variables for a list of contexts using a pool of worker processes'
+
+    def add_arguments(self, parser: ArgumentParser):
+        parser.add_argument(
+            'vars',
+            nargs='+',
+            help='The name of the variable',
+            metavar='variable',
+        )
+        parser.add_argument(
+            '-c', '--contexts',
+            help='path to a JSON file containing a list of contexts',
+            required=True,
+        )
+        parser.add_argument(
+            '-o', '--output',
+            help='path to the JSON file to write the results to (default: stdout)',
+        )
+        parser.add_argument(
+            '-w', '--workers',
+            help='number of worker processes (default: number of CPUs)',
+            type=int,
+        )
+        parser.add_argument(
+            '--chunk-size',
+            help=f'number of contexts sent to a worker at a time (default: {DEFAULT_CHUNK_SIZE})',
+            type=int,
+            default=DEFAULT_CHUNK_SIZE,
+        )
+        parser.add_argument(
+            '--numeric',
+            help='numeric backend to compute with (default: the CIMBOLIC_NUMERIC_BACKEND setting)',
+            choices=NUMERIC_BACKENDS,
+        )
+        parser.add_argument(
+            '--benchmark',
+            help='comma-separated worker counts to measure the throughput with, instead of writing results',
+            metavar='WORKERS',
+        )
+
+    def handle(self, *args, **options):
+        var_names = [var.lstrip('$') for var in options['vars']]
+        for var_name in var_names:
+            # Workers only load active variables.
+            if not Variable.objects.filter(name=var_name, is_active=True).exists():
+                raise CommandError(f'Nonexistent or inactive variable ${var_name}')
+
+        try:
+            with open(options['contexts'], encoding='utf-8') as f:
+                contexts = json.load(f)
+        except (OSError, ValueError) as exc:
+            raise CommandError(f"Can't read contexts from {options['contexts']}: {exc}")
+        if not isinstance(contexts, list):
+            raise CommandError('The contexts file must contain a JSON list of objects')
+
+        if options['benchmark']:
+            try:
+                worker_counts = [int(count) for count in options['benchmark'].split(',')]
+            except ValueError:
+                raise CommandError('--benchmark takes comma-separated integers (eg: 1,2,4,8)')
+            for workers in worker_counts:
+                start = time.perf_counter()
+                evaluate_parallel(var_names, contexts, workers, options['chunk_size'], options['numeric'])
+                elapsed = time.perf_counter() - start
+                self.stdout.write(self.style.SUCCESS(
+                    f'- {workers} workers: {len(contexts)} contexts in {elapsed:.3f}s '
+                    f'({len(contexts) / elapsed:.0f} contexts/s)'
+                ))
+            return
+
+        results = evaluate_parallel(
+            var_names, contexts, options['workers'], options['chunk_size'], options['numeric'],
+        )
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                json.dump(results, f, cls=DjangoJSONEncoder)
+        else:
+            self.stdout.write(json.dumps(results, cls=DjangoJSONEncoder))
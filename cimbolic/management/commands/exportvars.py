@@ -0,0 +1,67 @@
+import json
+from argparse import ArgumentParser
+from typing import Iterator, List
+
+from django.core.management.base import BaseCommand
+
+from cimbolic.models import Formula, Variable
+
+
+# Fields of a variable written along with its formulae.
+VARIABLE_FIELDS = ['name', 'description', 'source', 'related_data_type', 'related_data_path', 'is_active']
+
+
+def iter_variables(queryset) -> Iterator[dict]:
+    """Yield the variables of the queryset with their formulae, as JSON-serializable dicts.
+
+    Variables and formulae are streamed from two queries, so memory use stays
+    bounded by a single variable's formulae.
+    """
+    formulae = Formula.objects.filter(variable__in=queryset).order_by('variable_id', 'priority').values_list(
+        'variable_id', 'condition', 'rule', 'priority',
+    ).iterator()
+    pending = next(formulae, None)
+    for variable in queryset.order_by('pk').values('pk', *VARIABLE_FIELDS).iterator():
+        pk = variable.pop('pk')
+        variable_formulae: List[dict] = []
+        while pending is not None and pending[0] <= pk:
+            if pending[0] == pk:
+                __, condition, rule, priority = pending
+                variable_formulae.append({'condition': condition, 'rule': rule, 'priority': priority})
+            pending = next(formulae, None)
+        variable['formulae'] = variable_formulae
+        yield variable
+
+
+class Command(BaseCommand):
+    """Management command to export Variable objects and their formulae as JSON Lines."""
+    help = 'Exports variables and their formulae as JSON Lines (one variable per line), eg: for importvars'
+
+    def add_arguments(self, parser: ArgumentParser):
+        parser.add_argument(
+            'vars',
+            nargs='*',
+            help='The name of the variable (default: every variable)',
+            metavar='variable',
+        )
+        parser.add_argument(
+            '-o', '--output',
+            help='file to write to (default: standard output)',
+        )
+
+    def handle(self, *args, **options):
+        queryset = Variable.objects.all()
+        if options['vars']:
+            queryset = queryset.filter(name__in=[var.lstrip('$') for var in options['vars']])
+
+        output = open(options['output'], 'w', encoding='utf-8') if options['output'] else self.stdout
+        count = 0
+        try:
+            for variable in iter_variables(queryset):
+                output.write(json.dumps(variable, ensure_ascii=False) + '\n')
+                count += 1
+        finally:
+            if options['output']:
+                output.close()
+        if options['output']:
+            self.stdout.write(self.style.SUCCESS(f'Exported {count} variables to {options["output"]}'))
@@ -0,0 +1,120 @@
+import json
+import sys
+import time
+from argparse import ArgumentParser
+from typing import Dict, Iterator, List, Tuple
+
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from cimbolic.exceptions import DefaultFormulaMissingError
+from cimbolic.graph import get_dependency_graph
+from cimbolic.models import Variable, replace_formulae
+from cimbolic.registry import registry
+
+from .exportvars import VARIABLE_FIELDS
+
+
+def _read_lines(file) -> Iterator[Tuple[int, dict]]:
+    for line_number, line in enumerate(file, 1):
+        if not line.strip():
+            continue
+        try:
+            data = json.loads(line)
+        except ValueError as exc:
+            raise CommandError(f'Line {line_number}: invalid JSON ({exc})')
+        if not isinstance(data, dict) or 'name' not in data:
+            raise CommandError(f'Line {line_number}: expected an object with a name')
+        yield line_number, data
+
+
+class Command(BaseCommand):
+    """Management command to import Variable objects and their formulae from JSON Lines."""
+    help = (
+        'Imports variables and their formulae from JSON Lines (as written by exportvars), '
+        'creating or updating the variables and replacing their formulae, in a single transaction'
+    )
+
+    def add_arguments(self, parser: ArgumentParser):
+        parser.add_argument(
+            'file',
+            help="file to read from ('-' for standard input)",
+        )
+        parser.add_argument(
+            '--batch-size',
+            help='number of variables written at once (default: 500)',
+            type=int,
+            default=500,
+        )
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('The batch size must be positive')
+        start = time.perf_counter()
+        file = sys.stdin if options['file'] == '-' else open(options['file'], encoding='utf-8')
+        counts = {'variables': 0, 'created': 0, 'formulae': 0}
+        try:
+            with transaction.atomic():
+                batch: List[Tuple[int, dict]] = []
+                for item in _read_lines(file):
+                    batch.append(item)
+                    if len(batch) == options['batch_size']:
+                        self.import_batch(batch, counts)
+                        batch = []
+                if batch:
+                    self.import_batch(batch, counts)
+                # Formulae are checked for circular dependencies once they're
+                # all in (a cycle may span several batches).
+                registry.invalidate()
+                cycle = get_dependency_graph().find_cycle()
+                if cycle:
+                    raise CommandError(
+                        f'The formulae create a circular dependency: {" -> ".join(f"${name}" for name in cycle)}'
+                    )
+        finally:
+            registry.invalidate()
+            if file is not sys.stdin:
+                file.close()
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {counts["variables"]} variables ({counts["created"]} new) and '
+            f'{counts["formulae"]} formulae in {time.perf_counter() - start:.2f}s'
+        ))
+
+    def import_batch(self, batch: List[Tuple[int, dict]], counts: Dict[str, int]):
+        """Create or update a batch of variables and replace their formulae."""
+        existing = Variable.objects.in_bulk([data['name'] for __, data in batch], field_name='name')
+        # A variable listed more than once takes its last line's data.
+        variables: Dict[str, Variable] = {}
+        for line_number, data in batch:
+            variable = variables.get(data['name']) or existing.get(data['name']) or Variable(name=data['name'])
+            for field in VARIABLE_FIELDS[1:]:
+                if field in data:
+                    setattr(variable, field, data[field])
+            try:
+                variable.full_clean(validate_unique=False)
+            except ValidationError as exc:
+                raise CommandError(f'Line {line_number}: invalid variable ${data["name"]}: {exc}')
+            variables[variable.name] = variable
+
+        created = [variable for variable in variables.values() if variable.pk is None]
+        updated = [variable for variable in variables.values() if variable.pk is not None]
+        Variable.objects.bulk_create(created)
+        if updated:
+            Variable.objects.bulk_update(updated, VARIABLE_FIELDS[1:])
+        if created:
+            # Not every database sets the primary keys of bulk-created objects.
+            pks = dict(Variable.objects.filter(name__in=[v.name for v in created]).values_list('name', 'pk'))
+            for variable in created:
+                variable.pk = pks[variable.name]
+
+        formulae_by_variable = {variables[data['name']]: data.get('formulae', []) for __, data in batch}
+        try:
+            new_formulae = replace_formulae(formulae_by_variable, check_cycles=False)
+        except (ValidationError, DefaultFormulaMissingError, KeyError) as exc:
+            raise CommandError(f'Invalid formulae in the batch ending on line {batch[-1][0]}: {exc}')
+
+        counts['variables'] += len(variables)
+        counts['created'] += len(created)
+        counts['formulae'] += sum(len(formulae) for formulae in new_formulae.values())
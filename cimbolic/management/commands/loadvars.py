@@ -1,7 +1,13 @@
+import time
+from argparse import ArgumentParser
+from typing import List
+
 from django.core.management.base import BaseCommand
+from django.db import transaction
 
 from cimbolic import get_system_variables
 from cimbolic.models import Variable
+from cimbolic.registry import registry
 
 
 class Command(BaseCommand):
@@ -17,43 +23,62 @@ class Command(BaseCommand):
     It also marks Variable objects not referenced in cimbolic_vars.py anymore
     as inactive (is_active = False). This means that the mentioned file is the
     only way for a developer to add system-sourced variables.
+
+    The existing variables are read in a single query, and the changes are
+    written in bulk (one query per batch the database allows), within a single
+    transaction, so the table is never left half-synced, nor synced with
+    what another writer changed meanwhile.
     """
     help = 'Loads system-sourced variables from cimbolic_vars.py into the Variable model'
 
+    def add_arguments(self, parser: ArgumentParser):
+        parser.add_argument(
+            '--dry-run',
+            help='only display the changes that would be made',
+            action='store_true',
+        )
+
     def handle(self, *args, **options):
+        start = time.perf_counter()
         sys_vars = get_system_variables()
 
-        vars_added = []
-        for var in sys_vars:
-            if not Variable.objects.filter(name=var).exists():
-                Variable.objects.create(name=var, source=Variable.SYSTEM, is_active=True)
-                vars_added.append(var)
-            else:
-                v = Variable.objects.get(name=var)
-                if not v.is_active:
-                    vars_added.append(v)
-                    v.is_active = True
-                    v.save(update_fields=['is_active'])
-
-        if vars_added:
-            self.stdout.write(self.style.SUCCESS('The following variables have been loaded or activated: '), ending='')
-            for var in vars_added[:-1]:
-                self.stdout.write(self.style.SUCCESS(f'${var}'), ending=', ')
-            self.stdout.write(self.style.SUCCESS(f'${vars_added[-1]}'))
-
-        vars_marked_inactive = []
-        sys_vars_in_db = Variable.objects.filter(source=Variable.SYSTEM, is_active=True)
-        for var in sys_vars_in_db:
-            if var.name not in sys_vars:
-                vars_marked_inactive.append(var.name)
-                var.is_active = False
-                var.save(update_fields=['is_active'])
-
-        if vars_marked_inactive:
-            self.stdout.write(self.style.SUCCESS('The following variables have been marked as inactive: '), ending='')
-            for var in vars_marked_inactive[:-1]:
-                self.stdout.write(self.style.SUCCESS(f'${var}'), ending=', ')
-            self.stdout.write(self.style.SUCCESS(f'${vars_marked_inactive[-1]}'))
-
-        if not vars_added and not vars_marked_inactive:
-            return self.style.SUCCESS('Done')
+        with transaction.atomic():
+            # The existing variables are locked (where the database allows)
+            # until the changes are written, so that none change meanwhile.
+            existing = {
+                name: (pk, source, is_active)
+                for pk, name, source, is_active in Variable.objects.select_for_update().values_list(
+                    'pk', 'name', 'source', 'is_active',
+                )
+            }
+            vars_created = [var for var in sys_vars if var not in existing]
+            vars_activated = [var for var in sys_vars if var in existing and not existing[var][2]]
+            vars_marked_inactive = sorted(
+                name for name, (pk, source, is_active) in existing.items()
+                if source == Variable.SYSTEM and is_active and name not in sys_vars
+            )
+
+            if not options['dry_run']:
+                Variable.objects.bulk_create([
+                    Variable(name=var, source=Variable.SYSTEM, is_active=True) for var in vars_created
+                ])
+                changed = [Variable(pk=existing[var][0], is_active=True) for var in vars_activated]
+                changed += [Variable(pk=existing[var][0], is_active=False) for var in vars_marked_inactive]
+                if changed:
+                    Variable.objects.bulk_update(changed, ['is_active'])
+                # Bulk changes don't send the signals that invalidate the registry.
+                registry.invalidate()
+
+        verb = 'would be' if options['dry_run'] else 'have been'
+        self.write_names(f'The following variables {verb} loaded or activated: ', vars_created + vars_activated)
+        self.write_names(f'The following variables {verb} marked as inactive: ', vars_marked_inactive)
+        self.stdout.write(self.style.SUCCESS(
+            f'{len(sys_vars)} system-sourced variables: {len(vars_created)} created, '
+            f'{len(vars_activated)} activated, {len(vars_marked_inactive)} marked as inactive'
+            f'{" (dry run)" if options["dry_run"] else ""} in {time.perf_counter() - start:.2f}s'
+        ))
+
+    def write_names(self, message: str, names: List[str]):
+        if names:
+            self.stdout.write(self.style.SUCCESS(message), ending='')
+            self.stdout.write(self.style.SUCCESS(', '.join(f'${name}' for name in names)))
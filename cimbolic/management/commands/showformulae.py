@@ -0,0 +1,44 @@
+from argparse import ArgumentParser
+
+from django.core.management.base import BaseCommand, CommandError
+
+from cimbolic.models import Variable
+from cimbolic.optimization import to_text
+from cimbolic.parsing import compile_condition, compile_rule
+
+
+class Command(BaseCommand):
+    """Management command to display the formulae of Variables as they're evaluated."""
+    help = 'Displays the conditions and rules of each specified variable along with their optimized forms'
+
+    def add_arguments(self, parser: ArgumentParser):
+        parser.add_argument(
+            'vars',
+            nargs='+',
+            help='The name of the variable',
+            metavar='variable',
+        )
+
+    def handle(self, *args, **options):
+        variables = []
+        for var in options['vars']:
+            var_name = var.lstrip('$')
+            try:
+                variables.append(Variable.objects.get(name=var_name))
+            except Variable.DoesNotExist:
+                raise CommandError(f'Variable ${var_name} not found in the database')
+
+        for variable in variables:
+            self.stdout.write(self.style.SUCCESS(f'- ${variable.name}'))
+            for formula in variable.prioritized_formulae():
+                self.stdout.write(f'  priority {formula.priority}')
+                for label, text, compile_text in [
+                    ('condition', formula.condition, compile_condition),
+                    ('rule', formula.rule, compile_rule),
+                ]:
+                    try:
+                        optimized = to_text(compile_text(text))
+                    except Exception as exc:
+                        optimized = self.style.ERROR(f'{type(exc).__name__}: {exc}')
+                    self.stdout.write(f'    {label}: {text}')
+                    self.stdout.write(f'    {"optimized":>{len(label)}}: {optimized}')
@@ -0,0 +1,28 @@
+# Generated by Django 2.2.5 on 2026-10-18 04:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cimbolic', '0008_auto_20191013_2347'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='formula',
+            name='compiled_condition',
+            field=models.TextField(blank=True, editable=False, help_text='Serialized expression tree of the condition (generated on save)'),
+        ),
+        migrations.AddField(
+            model_name='formula',
+            name='compiled_format_version',
+            field=models.PositiveSmallIntegerField(default=0, editable=False, help_text='Format version of the serialized expression trees (0 if there are none)'),
+        ),
+        migrations.AddField(
+            model_name='formula',
+            name='compiled_rule',
+            field=models.TextField(blank=True, editable=False, help_text='Serialized expression tree of the rule (generated on save)'),
+        ),
+    ]
@@ -1,14 +1,25 @@
+import inspect
 import re
 from decimal import Decimal
-from functools import lru_cache
-from typing import Any, Dict, List, Optional, Union
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterable, List, Mapping, Optional, Sequence, Tuple, Union
 
+from django.core.exceptions import ValidationError
 from django.core.validators import MinValueValidator, RegexValidator
-from django.db import models
+from django.db import connection, models, transaction
 
 from . import get_system_variables
 from .exceptions import *
-from .parsing import Condition, Rule
+from .expressions import Node
+from .numeric import is_entered, numeric_backend
+from .parsing import Condition, Rule, compile_condition, compile_rule
+from .registry import registry
+from .selection import select_formula
+from .serialization import FORMAT_VERSION, dump_tree, load_tree
+from .sessions import get_current_session
+from .tracing import CONDITION, RULE, SYSTEM, VARIABLE, annotate, get_current_tracer
+
+if TYPE_CHECKING:
+    import numpy
 
 
 class Variable(models.Model):
@@ -148,38 +159,140 @@ class Variable(models.Model):
         )
         return formula
 
+    def replace_formulae(self, formulae: Iterable[Mapping[str, Any]]) -> List['Formula']:
+        """Replace all of the variable's formulae at once (see replace_formulae)."""
+        return replace_formulae({self: formulae})[self]
+
     def prioritized_formulae(self) -> models.query.QuerySet:
         """Return a queryset of the relevant formulae sorted by priority."""
         formulae = self.formulae.order_by('priority')
         return formulae
 
-    def to_value(self, context: Optional[Dict[str, Any]] = None) -> Union[int, Decimal]:
-        """Parse the variable's formulae and return a value."""
+    def to_value(
+            self,
+            context: Optional[Dict[str, Any]] = None,
+            numeric: Optional[str] = None,
+    ) -> Union[int, Decimal]:
+        """Parse the variable's formulae and return a value.
+
+        The value is memoized if an EvaluationSession for the context is open.
+        It's computed with the given numeric backend (see cimbolic.numeric), if
+        any, or else with the current one.
+        """
+        if numeric is not None and not is_entered(numeric):
+            with numeric_backend(numeric):
+                return self.to_value(context)
+        session = get_current_session()
+        tracer = get_current_tracer()
+        if tracer is not None:
+            with tracer.span(VARIABLE, self.name) as span:
+                if session is not None and session.applies_to(context):
+                    span.attributes['cache_hit'] = self.name in session.values
+                    return session.get_value(self.name, lambda: self._evaluate(context))
+                return self._evaluate(context)
+        if session is not None and session.applies_to(context):
+            return session.get_value(self.name, lambda: self._evaluate(context))
+        return self._evaluate(context)
+
+    def evaluate_batch(
+            self,
+            contexts: Sequence[Dict[str, Any]],
+            mode: str = 'exact',
+            numeric: Optional[str] = None,
+    ) -> 'numpy.ndarray':
+        """Evaluate the variable for many contexts at once (requires NumPy).
+
+        The mode is either 'exact' (identical to to_value, with the given or
+        the current numeric backend) or 'float' (fast float64 arithmetic). See
+        cimbolic.batch for details.
+        """
+        from .batch import BatchEvaluator
+        evaluator = BatchEvaluator(contexts, mode, numeric)
+        return evaluator.evaluate(self)
+
+    async def ato_value(
+            self,
+            context: Optional[Dict[str, Any]] = None,
+            numeric: Optional[str] = None,
+    ) -> Union[int, Decimal]:
+        """Asynchronously parse the variable's formulae and return a value.
+
+        Asynchronous system-sourced callables are awaited, and the variables
+        referenced by a formula are evaluated concurrently. The value is
+        memoized if an EvaluationSession for the context is open. It's
+        computed with the given numeric backend, if any, or else with the
+        current one.
+        """
+        if numeric is not None and not is_entered(numeric):
+            with numeric_backend(numeric):
+                return await self.ato_value(context)
+        session = get_current_session()
+        if session is not None and session.applies_to(context):
+            return await session.aget_value(self.name, lambda: self._aevaluate(context))
+        return await self._aevaluate(context)
+
+    def _get_system_value(self, context: Optional[Dict[str, Any]] = None) -> Any:
+        """Return the system variable's value, calling its callable if needed."""
+        sys_vars = get_system_variables()
+        try:
+            result, result_args = sys_vars[self.name]
+        except KeyError:
+            raise VariableNotDefinedError(f'System variable {self} undefined')
+        if callable(result):
+            result_kwargs = {}
+            context = context or {}
+            for key in result_args:
+                if key in context.keys():
+                    result_kwargs[key] = context[key]
+                else:
+                    raise KeyError(f'Missing argument {key} to callable {result.__name__}')
+            return result(**result_kwargs)
+        else:
+            return result
+
+    def _evaluate(
+            self,
+            context: Optional[Dict[str, Any]] = None,
+            resolve: Optional[Callable[[str], Any]] = None,
+    ) -> Union[int, Decimal]:
+        """Evaluate the variable's value without any memoization.
+
+        Named variables in the formulae are resolved with the given resolver,
+        if any, instead of being evaluated recursively.
+        """
+        tracer = get_current_tracer()
         if self.source == self.SYSTEM:
-            sys_vars = get_system_variables()
-            try:
-                result, result_args = sys_vars[self.name]
-            except KeyError:
-                raise VariableNotDefinedError(f'System variable {self} undefined')
-            if callable(result):
-                result_kwargs = {}
-                context = context or {}
-                for key in result_args:
-                    if key in context.keys():
-                        result_kwargs[key] = context[key]
-                    else:
-                        raise KeyError(f'Missing argument {key} to callable {result.__name__}')
-                return result(**result_kwargs)
-            else:
+            if tracer is not None:
+                with tracer.span(SYSTEM, self.name):
+                    return self._get_system_value(context)
+            return self._get_system_value(context)
+
+        if self.source == self.USER:
+            plan = registry.get_selection_plan(self)
+            if not plan:
+                raise VariableNotDefinedError(f'No formula defined for variable {self.name}')
+            formula = select_formula(plan, context, resolve)
+            if formula is not None:
+                if tracer is not None:
+                    annotate(priority=formula.priority)
+                result = formula.rule_to_value(context, resolve)
                 return result
 
+    async def _aevaluate(self, context: Optional[Dict[str, Any]] = None) -> Union[int, Decimal]:
+        """Asynchronously evaluate the variable's value without any memoization."""
+        if self.source == self.SYSTEM:
+            result = self._get_system_value(context)
+            if inspect.isawaitable(result):
+                result = await result
+            return result
+
         if self.source == self.USER:
-            prioritized_formulae = self.prioritized_formulae()
-            if not prioritized_formulae.exists():
+            prioritized_formulae = await registry.aget_formulae(self)
+            if not prioritized_formulae:
                 raise VariableNotDefinedError(f'No formula defined for variable {self.name}')
             for formula in prioritized_formulae:
-                if formula.condition_to_boolean(context):
-                    result = formula.rule_to_value(context)
+                if await formula.acondition_to_boolean(context):
+                    result = await formula.arule_to_value(context)
                     return result
 
 
@@ -208,6 +321,21 @@ class Formula(models.Model):
             MinValueValidator(1),
         ],
     )
+    compiled_condition = models.TextField(
+        help_text='Serialized expression tree of the condition (generated on save)',
+        blank=True,
+        editable=False,
+    )
+    compiled_rule = models.TextField(
+        help_text='Serialized expression tree of the rule (generated on save)',
+        blank=True,
+        editable=False,
+    )
+    compiled_format_version = models.PositiveSmallIntegerField(
+        help_text='Format version of the serialized expression trees (0 if there are none)',
+        default=0,
+        editable=False,
+    )
 
     class Meta:
         constraints = [
@@ -227,6 +355,14 @@ class Formula(models.Model):
             raise DefaultFormulaMissingError(
                 f'Default formula (with a \'NULL\' condition) is missing for variable {self.variable}'
             )
+        # Disallow saving if the formula makes the variable depend on itself.
+        from .graph import find_cycle_with
+        cycle = find_cycle_with(self)
+        if cycle:
+            raise CircularDependencyError(
+                f'Formula would create a circular dependency: {" -> ".join(f"${name}" for name in cycle)}'
+            )
+        self.compile()
         super().save(*args, **kwargs)
 
         # Update the priority of the formula with the 'NULL' condition to be
@@ -243,45 +379,188 @@ class Formula(models.Model):
     def __str__(self):
         return f'{self.variable} > priority {self.priority}'
 
-    def condition_to_boolean(self, context: Optional[Dict] = None) -> bool:
+    def compile(self):
+        """Set the serialized expression trees of the condition and rule.
+
+        A formula that doesn't parse is stored without them, so that it fails
+        when evaluated, like it always has.
+        """
+        try:
+            compiled_condition = dump_tree(compile_condition(self.condition))
+            compiled_rule = dump_tree(compile_rule(self.rule))
+        except Exception:
+            self.compiled_condition = ''
+            self.compiled_rule = ''
+            self.compiled_format_version = 0
+        else:
+            self.compiled_condition = compiled_condition
+            self.compiled_rule = compiled_rule
+            self.compiled_format_version = FORMAT_VERSION
+
+    def stored_trees(self) -> Optional[Tuple[Node, Node]]:
+        """Return the stored expression trees of the condition and rule, if up to date."""
+        if self.compiled_format_version != FORMAT_VERSION:
+            return None
+        try:
+            return load_tree(self.compiled_condition), load_tree(self.compiled_rule)
+        except (ValueError, LookupError, TypeError):
+            return None
+
+    def condition_to_boolean(self, context: Optional[Dict] = None, resolve: Optional[Callable] = None) -> bool:
         """Parse the condition and return a boolean result."""
         cond = Condition(self.condition, context)
-        result = cond.evaluate()
+        tracer = get_current_tracer()
+        if tracer is not None:
+            with tracer.span(CONDITION, self.variable.name, priority=self.priority) as span:
+                result = span.attributes['result'] = cond.evaluate(resolve)
+                return result
+        result = cond.evaluate(resolve)
         return result
 
-    def rule_to_value(self, context: Optional[Dict] = None) -> Union[int, Decimal]:
+    def rule_to_value(self, context: Optional[Dict] = None, resolve: Optional[Callable] = None) -> Union[int, Decimal]:
         """Parse the rule and evaluate it to give a result."""
         rule = Rule(self.rule, context)
-        result = rule.evaluate()
+        tracer = get_current_tracer()
+        if tracer is not None:
+            with tracer.span(RULE, self.variable.name, priority=self.priority):
+                return rule.evaluate(resolve)
+        result = rule.evaluate(resolve)
+        return result
+
+    async def acondition_to_boolean(self, context: Optional[Dict] = None) -> bool:
+        """Asynchronously parse the condition and return a boolean result."""
+        cond = Condition(self.condition, context)
+        result = await cond.aevaluate()
+        return result
+
+    async def arule_to_value(self, context: Optional[Dict] = None) -> Union[int, Decimal]:
+        """Asynchronously parse the rule and evaluate it to give a result."""
+        rule = Rule(self.rule, context)
+        result = await rule.aevaluate()
         return result
 
 
 named_variable_regex = re.compile(r'\$([a-zA-Z_][a-zA-Z0-9_]*)')
 
 
-@lru_cache(maxsize=64)
 def get_all_context_keys(variable: Variable) -> List[str]:
-    """Get every context key dependency for a particular variable."""
-    context_keys: List[str] = []
+    """Get every context key dependency for a particular variable.
+
+    The keys are those of the system-sourced callables that the variable
+    depends on, through the conditions and rules of its formulae. They are
+    collected from the dependency graph of the active variables, which
+    memoizes them until a variable or a formula changes.
+    """
+    from .graph import formula_references, get_dependency_graph
     if variable.source == variable.SYSTEM:
         try:
             fn, keys = get_system_variables()[variable.name]
         except KeyError:
             raise VariableNotDefinedError(f'System variable {variable} undefined')
-        if callable(fn):
-            context_keys.extend(keys)
+        return sorted(set(keys)) if callable(fn) else []
+
+    graph = get_dependency_graph()
+    if variable.name in graph.dependencies:
+        names = [variable.name]
     else:
-        rules: List[str] = [formula.rule for formula in variable.formulae.all()]
-        for rule in rules:
-            named_variables = named_variable_regex.findall(rule)
-            for named_var in named_variables:
-                try:
-                    var = Variable.objects.get(name=named_var)
-                except Variable.DoesNotExist:
-                    raise VariableNotFoundError(
-                        f'Nonexistent variable ${named_var} referenced in rule: {rule}'
-                    )
-                context_keys.extend(get_all_context_keys(var))
-    # Eliminate duplicates.
-    context_keys = list(set(context_keys))
-    return context_keys
+        # Inactive variables aren't part of the graph, unlike their dependencies.
+        names = sorted(set().union(*(formula_references(formula) for formula in variable.formulae.all())))
+    missing = set().union(*(graph.missing_variables(name) for name in names))
+    if missing:
+        raise VariableNotFoundError(
+            f'Nonexistent or inactive variable ${min(missing)} referenced by {variable}'
+        )
+    return sorted(set().union(*(graph.required_context_keys(name) for name in names)))
+
+
+def _build_formulae(variable: Variable, items: Iterable[Mapping[str, Any]]) -> List[Formula]:
+    """Validate a variable's new formulae in memory, like Formula.save would."""
+    formulae = [
+        Formula(
+            variable=variable,
+            condition=item.get('condition', 'NULL'),
+            rule=item['rule'],
+            priority=item['priority'],
+        )
+        for item in items
+    ]
+    for formula in formulae:
+        formula.clean_fields(exclude=['variable'])
+    priorities = [formula.priority for formula in formulae]
+    if len(set(priorities)) != len(priorities):
+        raise ValidationError(f'Formulae of variable {variable} have duplicate priorities')
+    null_formulae = [formula for formula in formulae if formula.condition == 'NULL']
+    if len(null_formulae) > 1:
+        raise ValidationError(f'Variable {variable} has more than one default formula')
+    if formulae and not null_formulae:
+        raise DefaultFormulaMissingError(
+            f'Default formula (with a \'NULL\' condition) is missing for variable {variable}'
+        )
+    # The formula with the 'NULL' condition comes last, as Formula.save ensures.
+    if null_formulae:
+        null_formula = null_formulae[0]
+        max_priority = max((f.priority for f in formulae if f is not null_formula), default=0)
+        if null_formula.priority <= max_priority:
+            null_formula.priority = max_priority + 1
+    for formula in formulae:
+        formula.compile()
+    return formulae
+
+
+# Number of variables whose formulae _delete_formulae() deletes at once.
+DELETE_BATCH_SIZE = 500
+
+
+def _delete_formulae(variables: Sequence[Variable]):
+    """Delete the formulae of the variables, in one query per batch of variables.
+
+    QuerySet.delete() can't fast-delete formulae, since the registry's signal
+    receivers are connected: it would fetch every formula and send a
+    post_delete signal for each of them.
+    """
+    table = connection.ops.quote_name(Formula._meta.db_table)
+    column = connection.ops.quote_name(Formula._meta.get_field('variable').column)
+    pks = [variable.pk for variable in variables]
+    with connection.cursor() as cursor:
+        for start in range(0, len(pks), DELETE_BATCH_SIZE):
+            batch = pks[start:start + DELETE_BATCH_SIZE]
+            cursor.execute(f'DELETE FROM {table} WHERE {column} IN ({", ".join(["%s"] * len(batch))})', batch)
+
+
+def replace_formulae(
+        formulae_by_variable: Mapping[Variable, Iterable[Mapping[str, Any]]],
+        check_cycles: bool = True,
+) -> Dict[Variable, List[Formula]]:
+    """Replace all the formulae of (saved) variables in bulk.
+
+    The new formulae are given as mappings with a rule, a priority and a
+    condition (NULL by default). They're validated in memory against the
+    same constraints as Formula.save enforces (a single default formula
+    whose priority comes last, unique priorities, no circular dependency
+    unless check_cycles is False), then the old formulae are deleted and the
+    new ones created in a single transaction, in a constant number of
+    queries (but for the deletion being split into batches of
+    DELETE_BATCH_SIZE variables, and the bulk insert into batches on
+    databases that limit the parameters of a query, like SQLite). Neither
+    sends the post_save or post_delete signals of the formulae.
+    """
+    from .graph import formula_references, get_dependency_graph
+    new_formulae = {
+        variable: _build_formulae(variable, items) for variable, items in formulae_by_variable.items()
+    }
+    if check_cycles:
+        references = {
+            variable.name: set().union(*[formula_references(formula) for formula in formulae])
+            for variable, formulae in new_formulae.items()
+        }
+        cycle = get_dependency_graph().find_cycle_with_references(references)
+        if cycle:
+            raise CircularDependencyError(
+                f'Formulae would create a circular dependency: {" -> ".join(f"${name}" for name in cycle)}'
+            )
+    with transaction.atomic():
+        _delete_formulae(list(new_formulae))
+        Formula.objects.bulk_create([formula for formulae in new_formulae.values() for formula in formulae])
+    # Bulk changes don't send the signals that invalidate the registry.
+    registry.invalidate()
+    return new_formulae
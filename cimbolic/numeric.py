@@ -0,0 +1,256 @@
+"""Numeric backends: the kind of numbers that formulae compute with.
+
+Three backends are available:
+
+- float (the default) computes with native Python numbers, like the original
+  eval() did: integer literals are ints and decimal literals are floats, so
+  results are subject to floating-point rounding (0.1 + 0.2 != 0.3);
+- decimal computes with Decimals: literals and the values of variables are
+  converted to Decimals exactly, and arithmetic is carried out in Python's
+  default context (28 significant digits, rounding half to even), which
+  keeps sums and products of amounts exact;
+- fixed computes with Decimals like decimal does, but in the context set by
+  the CIMBOLIC_DECIMAL_PRECISION (significant digits, 28 by default) and
+  CIMBOLIC_DECIMAL_ROUNDING (a decimal module rounding, ROUND_HALF_EVEN by
+  default) settings, or given to numeric_backend().
+
+The backend is chosen by the CIMBOLIC_NUMERIC_BACKEND setting, and can be
+changed for some evaluations by entering numeric_backend() (which also sets
+the decimal context), or by passing the numeric
+argument of the evaluation APIs:
+
+    with numeric_backend(DECIMAL):
+        net_pay = Variable.objects.get(name='NET_PAY').to_value(context)
+
+Like EvaluationSession, the backend is that of the current execution context
+(a context variable, so that concurrent asyncio tasks entering different
+backends don't affect one another), as is the decimal context. With the
+Decimal backends, the values of variables are Decimals, and '%' follows
+Decimal's semantics (the sign of the result is that of the dividend). Since
+Decimals have no xor, '^' converts integral operands (eg: 2 or 2.0) to ints
+and back, and raises a TypeError for any other, like the float backend does
+for floats.
+
+compare_numeric_backends() evaluates variables over a list of contexts with
+each backend, and reports how long an evaluation takes and how far the
+values are from those of the decimal backend (see the comparenumeric
+management command).
+"""
+
+# So that one may import * from this module.
+__all__ = [
+    'BackendComparison',
+    'DECIMAL',
+    'FIXED',
+    'FLOAT',
+    'NUMERIC_BACKENDS',
+    'compare_numeric_backends',
+    'get_decimal_context',
+    'get_default_numeric_backend',
+    'get_numeric_backend',
+    'is_entered',
+    'numeric_backend',
+    'reset_default_numeric_backend',
+    'to_decimal_tree',
+]
+
+import decimal
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from decimal import Decimal
+from typing import Any, Dict, Iterator, List, Mapping, NamedTuple, Optional, Sequence
+
+from .expressions import (
+    AggregateMacro,
+    BinaryOperation,
+    Constant,
+    DecimalVariable,
+    LogicalOperation,
+    NamedVariable,
+    Negation,
+    Node,
+    _to_decimal,
+)
+
+
+# The numeric backends.
+FLOAT = 'float'
+DECIMAL = 'decimal'
+FIXED = 'fixed'
+NUMERIC_BACKENDS = (FLOAT, DECIMAL, FIXED)
+
+
+# The backend entered with numeric_backend(), if any.
+_entered_backend: 'ContextVar[Optional[str]]' = ContextVar('cimbolic_numeric_backend', default=None)
+
+# The backend set by the settings, read once (see reset_default_numeric_backend).
+_default_backend: Optional[str] = None
+
+
+def get_default_numeric_backend() -> str:
+    """Return the backend set by the CIMBOLIC_NUMERIC_BACKEND setting (or the default)."""
+    global _default_backend
+    if _default_backend is None:
+        from django.conf import settings
+        _default_backend = getattr(settings, 'CIMBOLIC_NUMERIC_BACKEND', FLOAT)
+    return _default_backend
+
+
+def reset_default_numeric_backend():
+    """Read the CIMBOLIC_NUMERIC_BACKEND setting again on next use (eg: once it's changed)."""
+    global _default_backend
+    _default_backend = None
+
+
+def get_numeric_backend() -> str:
+    """Return the numeric backend entered in the current execution context (or the default)."""
+    backend = _entered_backend.get()
+    if backend is None:
+        backend = _default_backend or get_default_numeric_backend()
+    return backend
+
+
+def is_entered(backend: str) -> bool:
+    """Return whether evaluating with the backend needs no numeric_backend() to be entered.
+
+    That's the case if it's the backend entered in the current execution
+    context, or if none is entered and it's the float backend and the
+    default one (the Decimal backends set their decimal context on entering).
+    """
+    entered = _entered_backend.get()
+    return backend == entered or (entered is None and backend == FLOAT and get_default_numeric_backend() == FLOAT)
+
+
+def get_decimal_context(backend: str) -> decimal.Context:
+    """Return the decimal context in which the (Decimal) backend computes."""
+    if backend == DECIMAL:
+        return decimal.Context()
+    from django.conf import settings
+    rounding = getattr(settings, 'CIMBOLIC_DECIMAL_ROUNDING', decimal.ROUND_HALF_EVEN)
+    return decimal.Context(prec=getattr(settings, 'CIMBOLIC_DECIMAL_PRECISION', 28), rounding=rounding)
+
+
+@contextmanager
+def numeric_backend(backend: str, context: Optional[decimal.Context] = None) -> Iterator[None]:
+    """Evaluate formulae with the numeric backend (and decimal context) within the block."""
+    if backend not in NUMERIC_BACKENDS:
+        raise ValueError(f'Unknown numeric backend {backend!r} (choose from {NUMERIC_BACKENDS})')
+    token = _entered_backend.set(backend)
+    try:
+        if backend == FLOAT:
+            yield
+        else:
+            with decimal.localcontext(context or get_decimal_context(backend)):
+                yield
+    finally:
+        _entered_backend.reset(token)
+
+
+def to_decimal_tree(node: Node) -> Node:
+    """Return the tree with its numbers, and the values of its variables, as Decimals.
+
+    Trees should be converted before they're optimized, since folding float
+    constants would round them.
+    """
+    if isinstance(node, Constant):
+        if isinstance(node.value, (int, float, Decimal)) and not isinstance(node.value, bool):
+            return Constant(_to_decimal(node.value))
+        return node
+    if isinstance(node, NamedVariable):
+        return DecimalVariable(node.name)
+    if isinstance(node, AggregateMacro):
+        return node._replace(args=tuple(to_decimal_tree(arg) for arg in node.args))
+    if isinstance(node, (BinaryOperation, LogicalOperation)):
+        return node._replace(left=to_decimal_tree(node.left), right=to_decimal_tree(node.right))
+    if isinstance(node, Negation):
+        return node._replace(operand=to_decimal_tree(node.operand))
+    raise TypeError(f'Unknown expression tree node: {node!r}')
+
+
+# The following compare the numeric backends.
+# -------------------------------------------
+
+
+class BackendComparison(NamedTuple):
+    """Speed and accuracy of a numeric backend, relative to the decimal backend."""
+    backend: str
+    evaluations: int
+    # Mean time of an evaluation of every variable for a context, in seconds
+    seconds: float
+    # Number of values that differ from those of the decimal backend
+    differences: int
+    # Largest absolute difference between a value and that of the decimal backend
+    max_deviation: Optional[Decimal]
+    # Number of evaluations that raised an exception
+    failures: int
+
+
+class _Failure:
+    """Stand-in for a value whose evaluation raised an exception."""
+    def __init__(self, exception: Exception):
+        self.exception = exception
+
+    def __eq__(self, other):
+        return isinstance(other, _Failure) and type(other.exception) is type(self.exception)
+
+
+def _evaluate_all(names: Sequence[str], contexts: Sequence[Mapping[str, Any]]) -> List[Dict[str, Any]]:
+    from .registry import registry
+    from .sessions import EvaluationSession
+    results = []
+    for context in contexts:
+        values = {}
+        with EvaluationSession(dict(context)) as session:
+            for name in names:
+                try:
+                    values[name] = registry.get_variable(name).to_value(session.context)
+                except Exception as exc:
+                    values[name] = _Failure(exc)
+        results.append(values)
+    return results
+
+
+def compare_numeric_backends(
+        names: Sequence[str],
+        contexts: Sequence[Mapping[str, Any]],
+) -> List[BackendComparison]:
+    """Evaluate the named variables for each context with each backend, and compare their values.
+
+    Values are compared with those computed by the decimal backend (with
+    Python's default decimal context).
+    """
+    results: Dict[str, List[Dict[str, Any]]] = {}
+    timings: Dict[str, float] = {}
+    for backend in NUMERIC_BACKENDS:
+        with numeric_backend(backend):
+            # Warm the registry and compile caches up.
+            _evaluate_all(names, contexts[:1])
+        start = time.perf_counter()
+        with numeric_backend(backend):
+            results[backend] = _evaluate_all(names, contexts)
+        timings[backend] = (time.perf_counter() - start) / max(len(contexts), 1)
+
+    comparisons = []
+    reference = results[DECIMAL]
+    for backend in NUMERIC_BACKENDS:
+        differences = failures = 0
+        max_deviation: Optional[Decimal] = None
+        for values, reference_values in zip(results[backend], reference):
+            for name in names:
+                value = _to_decimal(values[name]) if not isinstance(values[name], _Failure) else values[name]
+                reference_value = reference_values[name]
+                if isinstance(value, _Failure):
+                    failures += 1
+                if value == reference_value:
+                    continue
+                differences += 1
+                if isinstance(value, Decimal) and isinstance(reference_value, Decimal):
+                    with decimal.localcontext(decimal.Context()):
+                        deviation = abs(value - reference_value)
+                    if max_deviation is None or deviation > max_deviation:
+                        max_deviation = deviation
+        comparisons.append(BackendComparison(
+            backend, len(contexts), timings[backend], differences, max_deviation, failures,
+        ))
+    return comparisons
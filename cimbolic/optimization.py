@@ -0,0 +1,253 @@
+"""Simplification of compiled expression trees.
+
+Formulae often carry constant subexpressions (eg: `$BASIC * (12 / 100)` or
+`(1 == 1) and $X > 5`) that would otherwise be computed on every evaluation.
+optimize() rewrites a tree bottom-up, once, before it's cached (see
+compile_condition and compile_rule in cimbolic.parsing):
+
+- arithmetic and comparisons between constants, and min/max over constants,
+  are folded into constants;
+- identity operations (`x + 0`, `x - 0`, `x * 1`, `x / 1`) are removed where
+  x is known to be a number;
+- logical operations and negations of constants are simplified, and so are
+  always true or always false branches of conditions.
+
+The rewritten tree evaluates to the same value (of the same type) as the
+original one, and raises the same exceptions: nothing that raises (eg: a
+division by zero) or yields a non-finite number is folded, and no operand
+that references a variable is ever dropped unless it's dead code (eg: the
+right-hand side of `false and ...`). The one observable difference is the
+sign of a float zero, which `x + 0` would have made positive.
+
+Trees of the Decimal numeric backends (see cimbolic.numeric) are optimized
+in the decimal context they're evaluated in: Decimal arithmetic is only
+folded where its result is exact at the context's precision (eg: `0.1 * 3`
+but not `1 / 3`), so that no rounding happens before evaluation, and Decimal
+constants are never treated as identity elements.
+
+to_text() renders a tree back into the Cimbolic language, fully
+parenthesized, to view what a formula was optimized into (see the
+showformulae command).
+"""
+
+# So that one may import * from this module.
+__all__ = ['optimize', 'to_text']
+
+import decimal
+import math
+from decimal import Decimal
+from typing import Any, List
+
+from .expressions import (
+    _AGGREGATE_FUNCTIONS,
+    _BINARY_OPERATORS,
+    AggregateMacro,
+    BinaryOperation,
+    Constant,
+    LogicalOperation,
+    NamedVariable,
+    Negation,
+    Node,
+)
+
+
+_COMPARISON_OPERATORS = {'==', '!=', '<', '>', '<=', '>='}
+
+# Sentinel for constant subexpressions that can't be folded.
+_UNFOLDABLE = object()
+
+# Every decimal signal, so that folding Decimals raises on any inexact
+# (or otherwise special) result instead of rounding it.
+_DECIMAL_SIGNALS = [
+    decimal.Clamped,
+    decimal.DivisionByZero,
+    decimal.FloatOperation,
+    decimal.Inexact,
+    decimal.InvalidOperation,
+    decimal.Overflow,
+    decimal.Rounded,
+    decimal.Subnormal,
+    decimal.Underflow,
+]
+
+
+def _is_number_constant(node: Node) -> bool:
+    return isinstance(node, Constant) and type(node.value) in (int, float)
+
+
+def _is_foldable_constant(node: Node) -> bool:
+    return isinstance(node, Constant) and type(node.value) in (int, float, Decimal)
+
+
+def _is_float(node: Node) -> bool:
+    """Return whether the node's value is always a float (if it doesn't raise)."""
+    if isinstance(node, Constant):
+        return type(node.value) is float
+    if isinstance(node, BinaryOperation):
+        # True division of numbers (or booleans) always yields a float, and
+        # so does adding, subtracting or multiplying anything by a float:
+        # other values (None, strings, etc.) raise a TypeError.
+        if node.operator == '/':
+            return True
+        if node.operator in ('+', '-', '*'):
+            return _is_float(node.left) or _is_float(node.right)
+        # A string's % is string formatting, though.
+        if node.operator == '%':
+            return (_is_float(node.left) and _is_number(node.right)) or (
+                _is_number(node.left) and _is_float(node.right)
+            )
+    if isinstance(node, AggregateMacro):
+        return all(_is_float(arg) for arg in node.args)
+    return False
+
+
+def _is_number(node: Node) -> bool:
+    """Return whether the node's value is always an int or a float (if it doesn't raise)."""
+    if _is_number_constant(node) or _is_float(node):
+        return True
+    if isinstance(node, BinaryOperation) and node.operator in ('+', '-', '*', '%', '^'):
+        return _is_number(node.left) and _is_number(node.right)
+    if isinstance(node, AggregateMacro):
+        return all(_is_number(arg) for arg in node.args)
+    return False
+
+
+def _is_boolean(node: Node) -> bool:
+    """Return whether the node's value is always a boolean (if it doesn't raise)."""
+    if isinstance(node, Constant):
+        return type(node.value) is bool
+    if isinstance(node, BinaryOperation):
+        return node.operator in _COMPARISON_OPERATORS
+    if isinstance(node, LogicalOperation):
+        return _is_boolean(node.left) and _is_boolean(node.right)
+    return isinstance(node, Negation)
+
+
+def _fold(function, *args: Any) -> Any:
+    """Apply a function to constant values, unless that raises or yields a non-finite number.
+
+    Decimal arithmetic that would round its result (at the precision of the
+    current decimal context) raises too.
+    """
+    current = decimal.getcontext()
+    exact = decimal.Context(prec=current.prec, Emin=current.Emin, Emax=current.Emax, traps=_DECIMAL_SIGNALS)
+    try:
+        with decimal.localcontext(exact):
+            value = function(*args)
+    except Exception:
+        return _UNFOLDABLE
+    if isinstance(value, float) and not math.isfinite(value):
+        return _UNFOLDABLE
+    if isinstance(value, Decimal) and not value.is_finite():
+        return _UNFOLDABLE
+    return value
+
+
+def _is_identity(constant: Node, value: int, operand: Node) -> bool:
+    """Return whether the constant is the given identity element for the operand."""
+    if not _is_number_constant(constant) or constant.value != value:
+        return False
+    # An int identity keeps the operand's type; a float one only keeps floats'.
+    return _is_number(operand) if type(constant.value) is int else _is_float(operand)
+
+
+def _optimize_binary_operation(node: BinaryOperation) -> Node:
+    left, right = optimize(node.left), optimize(node.right)
+    if isinstance(left, Constant) and isinstance(right, Constant):
+        value = _fold(_BINARY_OPERATORS[node.operator], left.value, right.value)
+        if value is not _UNFOLDABLE:
+            return Constant(value)
+    if node.operator in ('+', '-') and _is_identity(right, 0, left):
+        return left
+    if node.operator == '+' and _is_identity(left, 0, right):
+        return right
+    if node.operator in ('*', '/') and _is_identity(right, 1, left):
+        if node.operator == '*' or _is_float(left):
+            return left
+    if node.operator == '*' and _is_identity(left, 1, right):
+        return right
+    return BinaryOperation(node.operator, left, right)
+
+
+def _optimize_aggregate_macro(node: AggregateMacro) -> Node:
+    function = _AGGREGATE_FUNCTIONS[node.name]
+    # max() and min() keep the first of equal values, so runs of consecutive
+    # constants can be folded without changing which value is returned.
+    args: List[Node] = []
+    run: List[Node] = []
+    for arg in [optimize(arg) for arg in node.args] + [None]:
+        if arg is not None and _is_foldable_constant(arg):
+            run.append(arg)
+            continue
+        if len(run) > 1:
+            value = _fold(function, [constant.value for constant in run])
+            args.extend([Constant(value)] if value is not _UNFOLDABLE else run)
+        else:
+            args.extend(run)
+        run = []
+        if arg is not None:
+            args.append(arg)
+    # The max or min of a single value is the value itself.
+    if len(args) == 1:
+        return args[0]
+    return AggregateMacro(node.name, tuple(args))
+
+
+def _optimize_logical_operation(node: LogicalOperation) -> Node:
+    left, right = optimize(node.left), optimize(node.right)
+    if isinstance(left, Constant):
+        # The left-hand side decides whether the right-hand side is evaluated.
+        if bool(left.value) == (node.operator == 'and'):
+            return right
+        return left
+    if isinstance(right, Constant) and _is_boolean(left):
+        # `x and true` and `x or false` are x; the other combinations are
+        # constant, but x must still be evaluated (it may raise).
+        if right.value is (node.operator == 'and'):
+            return left
+    return LogicalOperation(node.operator, left, right)
+
+
+def _optimize_negation(node: Negation) -> Node:
+    operand = optimize(node.operand)
+    if isinstance(operand, Constant):
+        return Constant(not operand.value)
+    if isinstance(operand, Negation) and _is_boolean(operand.operand):
+        return operand.operand
+    return Negation(operand)
+
+
+def optimize(node: Node) -> Node:
+    """Return an equivalent, simplified expression tree."""
+    if isinstance(node, BinaryOperation):
+        return _optimize_binary_operation(node)
+    if isinstance(node, AggregateMacro):
+        return _optimize_aggregate_macro(node)
+    if isinstance(node, LogicalOperation):
+        return _optimize_logical_operation(node)
+    if isinstance(node, Negation):
+        return _optimize_negation(node)
+    return node
+
+
+def to_text(node: Node) -> str:
+    """Render an expression tree in the Cimbolic language (fully parenthesized)."""
+    if isinstance(node, Constant):
+        if node.value is None:
+            return 'null'
+        if isinstance(node.value, bool):
+            return 'true' if node.value else 'false'
+        if isinstance(node.value, str):
+            return f'"{node.value}"'
+        if isinstance(node.value, Decimal):
+            return str(node.value)
+        return repr(node.value)
+    if isinstance(node, NamedVariable):
+        return f'${node.name}'
+    if isinstance(node, AggregateMacro):
+        return f'{node.name}({", ".join(to_text(arg) for arg in node.args)})'
+    if isinstance(node, (BinaryOperation, LogicalOperation)):
+        return f'({to_text(node.left)} {node.operator} {to_text(node.right)})'
+    if isinstance(node, Negation):
+        return f'(not {to_text(node.operand)})'
+    raise TypeError(f'Unknown expression tree node: {node!r}')
@@ -0,0 +1,189 @@
+"""Parallel evaluation of variables over large batches of contexts.
+
+Pure-Python evaluation is bound to one core by the GIL. evaluate_parallel()
+splits the contexts into chunks and evaluates the chunks in a pool of worker
+processes. Each worker sets Django up and loads the variable registry once,
+before its first chunk, and then evaluates every context of every chunk it's
+given within an EvaluationSession, without querying the database again.
+Results are returned in the order of the contexts. Workers compute with the
+given numeric backend (see cimbolic.numeric), or else with the one current
+in the calling thread, in the context its settings give.
+
+evaluate_stream() evaluates an iterable of contexts (eg: read from a file)
+chunk by chunk, yielding a RowResult per context as the chunks complete, in
+order. Only a few chunks are read ahead of the results, so memory use stays
+bounded however many contexts there are, and an error is reported in the
+result of its context rather than raised.
+
+Contexts and values must be picklable, and the worker processes must be able
+to set Django up (ie: DJANGO_SETTINGS_MODULE must be set).
+"""
+
+# So that one may import * from this module.
+__all__ = [
+    'DEFAULT_CHUNK_SIZE',
+    'RowResult',
+    'evaluate_chunk',
+    'evaluate_parallel',
+    'evaluate_rows',
+    'evaluate_stream',
+]
+
+import itertools
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Deque, Dict, Iterable, Iterator, List, Mapping, NamedTuple, Optional, Sequence
+
+from .numeric import get_numeric_backend, numeric_backend
+from .registry import registry
+from .sessions import EvaluationSession
+
+
+# Number of contexts sent to a worker process at a time.
+DEFAULT_CHUNK_SIZE = 500
+
+# ID of the process in which _initialize_worker() last ran.
+_initialized_pid: Optional[int] = None
+
+
+def _initialize_worker():
+    """Set Django up in a worker process and load the variable registry."""
+    global _initialized_pid
+    import django
+    from django.apps import apps
+    from django.db import connections
+    if not apps.ready:
+        django.setup()
+    # Connections inherited from a forked parent mustn't be shared.
+    connections.close_all()
+    registry.load()
+    _initialized_pid = os.getpid()
+
+
+def _chunked(contexts: Sequence[Mapping[str, Any]], chunk_size: int) -> Iterator[List[Mapping[str, Any]]]:
+    for start in range(0, len(contexts), chunk_size):
+        yield list(contexts[start:start + chunk_size])
+
+
+def evaluate_chunk(
+        variable_names: Sequence[str],
+        contexts: Sequence[Mapping[str, Any]],
+        numeric: Optional[str] = None,
+) -> List[Dict[str, Any]]:
+    """Evaluate the named variables for each context in the current process (with the numeric backend)."""
+    variables = [registry.get_variable(name) for name in variable_names]
+    results = []
+    with numeric_backend(numeric or get_numeric_backend()):
+        for context in contexts:
+            with EvaluationSession(context):
+                results.append({var.name: var.to_value(context) for var in variables})
+    return results
+
+
+def _evaluate_chunk(args) -> List[Dict[str, Any]]:
+    # Executors only take an initializer from Python 3.7 on.
+    if _initialized_pid != os.getpid():
+        _initialize_worker()
+    return evaluate_chunk(*args)
+
+
+class RowResult(NamedTuple):
+    """Values of the variables evaluated for a context, and the first error raised, if any."""
+    values: Dict[str, Any]
+    error: Optional[str]
+
+
+def evaluate_rows(
+        variable_names: Sequence[str],
+        contexts: Sequence[Mapping[str, Any]],
+        numeric: Optional[str] = None,
+) -> List[RowResult]:
+    """Evaluate the named variables for each context in the current process, capturing errors.
+
+    Like evaluate_chunk(), each context is evaluated within an
+    EvaluationSession, so only the variables the selected formulae need are
+    evaluated. The values of the variables that failed are left out of their
+    RowResult.
+    """
+    variables = [registry.get_variable(name) for name in variable_names]
+    results = []
+    with numeric_backend(numeric or get_numeric_backend()):
+        for context in contexts:
+            values = {}
+            error = None
+            with EvaluationSession(context):
+                for var in variables:
+                    try:
+                        values[var.name] = var.to_value(context)
+                    except Exception as exc:
+                        error = error or f'{type(exc).__name__}: {exc}'
+            results.append(RowResult(values, error))
+    return results
+
+
+def _evaluate_rows(args) -> List[RowResult]:
+    if _initialized_pid != os.getpid():
+        _initialize_worker()
+    return evaluate_rows(*args)
+
+
+def evaluate_stream(
+        variable_names: Sequence[str],
+        contexts: Iterable[Mapping[str, Any]],
+        workers: int = 1,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        numeric: Optional[str] = None,
+) -> Iterator[RowResult]:
+    """Yield a RowResult for each context of the iterable, in order.
+
+    Contexts are evaluated a chunk at a time, in the current process if a
+    single worker is asked for, or else in a pool of worker processes with at
+    most two chunks per worker read ahead.
+    """
+    if chunk_size < 1:
+        raise ValueError('The chunk size must be a positive integer')
+    if workers < 1:
+        raise ValueError('The number of workers must be a positive integer')
+    variable_names = list(variable_names)
+    numeric = numeric or get_numeric_backend()
+    contexts = iter(contexts)
+    chunks = iter(lambda: list(itertools.islice(contexts, chunk_size)), [])
+    if workers == 1:
+        for chunk in chunks:
+            yield from evaluate_rows(variable_names, chunk, numeric)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending: Deque = deque()
+        for chunk in chunks:
+            pending.append(executor.submit(_evaluate_rows, (variable_names, chunk, numeric)))
+            if len(pending) >= workers * 2:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+def evaluate_parallel(
+        variable_names: Sequence[str],
+        contexts: Sequence[Mapping[str, Any]],
+        workers: Optional[int] = None,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        numeric: Optional[str] = None,
+) -> List[Dict[str, Any]]:
+    """Evaluate the named variables for each context in worker processes.
+
+    Return a list with a {variable name: value} dict for each context, in
+    the order of the contexts. The number of workers defaults to the number
+    of CPUs.
+    """
+    if chunk_size < 1:
+        raise ValueError('The chunk size must be a positive integer')
+    workers = workers or os.cpu_count() or 1
+    numeric = numeric or get_numeric_backend()
+    chunks = ((variable_names, chunk, numeric) for chunk in _chunked(contexts, chunk_size))
+    results: List[Dict[str, Any]] = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for chunk_results in executor.map(_evaluate_chunk, chunks):
+            results.extend(chunk_results)
+    return results
@@ -6,39 +6,102 @@ system variables, for example). Note that this module has two external
 dependencies. (1) PyParsing is used to define the grammar (tokenization).
 (2) Variable values are sourced from a Django model.
 
+The PyParsing grammar remains the definition of the Cimbolic language, but
+formulae are parsed by the equivalent, much faster hand-written parser of
+cimbolic.syntax. A condition or a rule is parsed only once: the parser turns
+its text into an immutable expression tree (see cimbolic.expressions), which
+is simplified (see cimbolic.optimization) and kept in a bounded LRU cache
+keyed by the text. Evaluation then walks that tree (or,
+with the codegen backend, calls a native Python function generated from it),
+asking a resolver for the values of the named variables it references.
+
+Formulae evaluated with a Decimal numeric backend (see cimbolic.numeric) are
+compiled into trees of their own, whose numbers (and resolved values) are
+Decimals. Those are parsed again (with Decimal literals) rather than derived
+from the float trees, since their folded float constants are rounded, and
+optimized at the precision of the current decimal context, which they're
+cached for.
+
 The code in this module aims to be maintainable by making extensive use of
 type hints, comments and docstrings. The code also aims to conform to PEP8,
 but fails. :)
 """
 
 # So that one may import * from this module.
-__all__ = ['Condition', 'Rule']
-
+__all__ = [
+    'CODEGEN_BACKEND',
+    'Condition',
+    'Rule',
+    'TREE_BACKEND',
+    'compile_condition',
+    'compile_condition_function',
+    'compile_decimal_condition',
+    'compile_decimal_rule',
+    'compile_rule',
+    'compile_rule_function',
+    'parse_condition',
+    'parse_rule',
+    'set_stored_trees',
+]
+
+import ast
+import asyncio
+import decimal
+import threading
 from decimal import Decimal
-from typing import Any, Callable, Dict, Optional, Union
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Union
 
 import pyparsing as pp
 
+from . import syntax
+from .codegen import CompiledExpression, to_function
+from .expressions import (
+    AggregateMacro,
+    Constant,
+    LogicalOperation,
+    NamedVariable,
+    Negation,
+    Node,
+    Resolver,
+    named_variables,
+)
+from .numeric import FLOAT, get_numeric_backend, is_entered, numeric_backend, to_decimal_tree
+from .optimization import optimize
+from .registry import registry
+from .sessions import get_current_session
+from .syntax import _build_tree
+from .tracing import VARIABLE, get_current_tracer
+
 
 # The following are custom type hints used in this module.
 # --------------------------------------------------------
 
 
-Numeric = Union[int, Decimal]
+Numeric = Union[int, float, Decimal]
 StrMapping = Dict[str, Any]
 Tokens = pp.ParseResults
 
 
-# The following are common functions used in this module.
-# -------------------------------------------------------
+# The following are common functions and constants used in this module.
+# ---------------------------------------------------------------------
 
 
-def _evaluator(tokens: Union[str, Tokens]) -> Union[bool, Numeric]:
-    """Evaluate a string or a ParseResult containing a reduced expression."""
-    if not isinstance(tokens, str):
-        tokens = ' '.join([str(tok) for tok in tokens])
-    result = eval(tokens)
-    return result
+# Maximum number of compiled conditions and rules (each) to keep in memory.
+COMPILE_CACHE_SIZE = 1024
+
+# Backends with which a compiled condition or rule can be evaluated. The tree
+# backend walks the expression tree, while the codegen backend calls a native
+# Python function generated from it (see cimbolic.codegen).
+TREE_BACKEND = 'tree'
+CODEGEN_BACKEND = 'codegen'
+BACKENDS = (TREE_BACKEND, CODEGEN_BACKEND)
+
+
+def get_default_backend() -> str:
+    """Return the backend set by the CIMBOLIC_BACKEND setting (or the default)."""
+    from django.conf import settings
+    return getattr(settings, 'CIMBOLIC_BACKEND', TREE_BACKEND)
 
 
 def _print_tokens(tokens: Tokens) -> Tokens:
@@ -56,7 +119,7 @@ def _print_tokens(tokens: Tokens) -> Tokens:
 _real_number_type_1 = pp.Combine(pp.Word(pp.nums) + pp.Optional('.' + pp.Word(pp.nums)))
 _real_number_type_2 = pp.Combine(pp.Optional(pp.Word(pp.nums)) + '.' + pp.Word(pp.nums))
 _real_number = pp.Combine(pp.Optional(pp.oneOf('+ -')) + (_real_number_type_1 | _real_number_type_2))
-_real_number.setParseAction(lambda toks: Decimal(toks[0]) if '.' in toks[0] else int(toks[0]))
+_real_number.setParseAction(lambda toks: Constant(float(toks[0]) if '.' in toks[0] else int(toks[0])))
 # ---
 
 # Named variable grammar ------------------------------------------------------
@@ -65,7 +128,7 @@ _named_variable = pp.Combine(
     + pp.Word(pp.alphas + '_', exact=1)
     + pp.Optional(pp.Word(pp.alphanums + '_'))
 )
-# See the ContextMixin class for a ParseAction to set dynamically.
+_named_variable.setParseAction(lambda toks: NamedVariable(toks[0]))
 # ---
 
 # Arithmetic operator grammar -------------------------------------------------
@@ -86,23 +149,22 @@ _aggregate_macro = (
 )
 
 
-def _aggregate_macro_evaluator(toks: Tokens) -> Numeric:
-    """Recursively evaluate the arguments to an aggregate macro."""
+def _aggregate_macro_to_node(toks: Tokens) -> AggregateMacro:
+    """Build the trees of the arguments to an aggregate macro."""
     macro_name, macro_args = tuple(toks)
-    sub_expression = ''
-    parsed_args = []
+    args = []
+    sub_expression: List[Any] = []
     for arg in macro_args:
         if arg != ',':
-            sub_expression += str(arg)
+            sub_expression.append(arg)
         else:
-            parsed_args.append(_evaluator(sub_expression))
-            sub_expression = ''
-    parsed_args.append(_evaluator(sub_expression))
-    result = _evaluator(f'{macro_name}({str(parsed_args)})')
-    return result
+            args.append(_build_tree(sub_expression))
+            sub_expression = []
+    args.append(_build_tree(sub_expression))
+    return AggregateMacro(macro_name, tuple(args))
 
 
-_aggregate_macro.setParseAction(_aggregate_macro_evaluator)
+_aggregate_macro.setParseAction(_aggregate_macro_to_node)
 # ---
 
 # Arithmetic term grammar -----------------------------------------------------
@@ -141,6 +203,7 @@ _allowed_chars_in_string = list(pp.printables)
 _allowed_chars_in_string.remove('"')
 _allowed_chars_in_string.append(' ')
 _quoted_string = pp.Combine('"' + pp.Word(''.join(_allowed_chars_in_string)) + '"')
+_quoted_string.setParseAction(lambda toks: Constant(ast.literal_eval(toks[0])))
 # ---
 
 # Conditional operator grammar ------------------------------------------------
@@ -157,9 +220,9 @@ _logical_negation_operator = pp.CaselessKeyword('not')
 # Boolean and null value grammar ----------------------------------------------
 _boolean_value = (
     pp.oneOf('true false', caseless=True)
-    .setParseAction(lambda toks: True if toks[0].upper() == 'TRUE' else False)
+    .setParseAction(lambda toks: Constant(True if toks[0].upper() == 'TRUE' else False))
 )
-_null = pp.CaselessLiteral('null').setParseAction(lambda toks: None)
+_null = pp.CaselessLiteral('null').setParseAction(lambda toks: Constant(None))
 # ---
 
 # Conditional expression grammar ----------------------------------------------
@@ -182,29 +245,247 @@ _conditional_expression <<= (
 # ---
 
 
+# The following functions compile conditions and rules into expression trees.
+# ---------------------------------------------------------------------------
+
+
+# PyParsing elements mutate some internal state while parsing (streamlining on
+# first use, and arity detection of ParseActions), which isn't safe to do from
+# several threads at once, so parsing with the grammar is serialized.
+_parse_lock = threading.Lock()
+
+# Expression trees compiled ahead of time (ie: stored with the formulae in the
+# database), by condition or rule text. They're used instead of parsing.
+_stored_conditions: Dict[str, Node] = {}
+_stored_rules: Dict[str, Node] = {}
+
+
+def set_stored_trees(conditions: Dict[str, Node], rules: Dict[str, Node]):
+    """Replace the expression trees to use instead of parsing conditions and rules."""
+    global _stored_conditions, _stored_rules
+    _stored_conditions = conditions
+    _stored_rules = rules
+
+
+def parse_condition(condition: str, decimal_numbers: bool = False) -> Node:
+    """Parse a condition into an expression tree (without any caching)."""
+    if condition.strip().upper() == 'NULL':
+        return Constant(True)
+    return syntax.parse_condition(condition, decimal_numbers)
+
+
+def parse_rule(rule: str, decimal_numbers: bool = False) -> Node:
+    """Parse a rule into an expression tree (without any caching)."""
+    return syntax.parse_rule(rule, decimal_numbers)
+
+
+def _pyparsing_parse_condition(condition: str) -> Node:
+    """Parse a condition with the PyParsing grammar (see the checkparser command)."""
+    if condition.strip().upper() == 'NULL':
+        return Constant(True)
+    with _parse_lock:
+        parse_results = _conditional_expression.parseString(condition)
+    return _build_tree(parse_results.asList())
+
+
+def _pyparsing_parse_rule(rule: str) -> Node:
+    """Parse a rule with the PyParsing grammar (see the checkparser command)."""
+    with _parse_lock:
+        parse_results = _arithmetic_expression.parseString(rule)
+    return _build_tree(parse_results.asList())
+
+
+@lru_cache(maxsize=COMPILE_CACHE_SIZE)
+def compile_condition(condition: str) -> Node:
+    """Return the (cached, optimized) expression tree of a condition, parsing it if needed."""
+    tree = _stored_conditions.get(condition)
+    if tree is not None:
+        return tree
+    return optimize(parse_condition(condition))
+
+
+@lru_cache(maxsize=COMPILE_CACHE_SIZE)
+def compile_rule(rule: str) -> Node:
+    """Return the (cached, optimized) expression tree of a rule, parsing it if needed."""
+    tree = _stored_rules.get(rule)
+    if tree is not None:
+        return tree
+    return optimize(parse_rule(rule))
+
+
+@lru_cache(maxsize=COMPILE_CACHE_SIZE)
+def compile_condition_function(condition: str) -> CompiledExpression:
+    """Compile a condition into a (cached) native Python function."""
+    return to_function(compile_condition(condition))
+
+
+@lru_cache(maxsize=COMPILE_CACHE_SIZE)
+def compile_rule_function(rule: str) -> CompiledExpression:
+    """Compile a rule into a (cached) native Python function."""
+    return to_function(compile_rule(rule))
+
+
+# The following compile formulae for the Decimal numeric backends. Their
+# trees are optimized at the precision of the current decimal context, so
+# they're cached by precision as well.
+
+
+@lru_cache(maxsize=COMPILE_CACHE_SIZE)
+def _compile_decimal_condition(condition: str, precision: int) -> Node:
+    return optimize(to_decimal_tree(parse_condition(condition, decimal_numbers=True)))
+
+
+@lru_cache(maxsize=COMPILE_CACHE_SIZE)
+def _compile_decimal_rule(rule: str, precision: int) -> Node:
+    return optimize(to_decimal_tree(parse_rule(rule, decimal_numbers=True)))
+
+
+@lru_cache(maxsize=COMPILE_CACHE_SIZE)
+def _compile_decimal_condition_function(condition: str, precision: int) -> CompiledExpression:
+    return to_function(_compile_decimal_condition(condition, precision))
+
+
+@lru_cache(maxsize=COMPILE_CACHE_SIZE)
+def _compile_decimal_rule_function(rule: str, precision: int) -> CompiledExpression:
+    return to_function(_compile_decimal_rule(rule, precision))
+
+
+def compile_decimal_condition(condition: str) -> Node:
+    """Return the (cached, optimized) expression tree of a condition for the Decimal numeric backends."""
+    return _compile_decimal_condition(condition, decimal.getcontext().prec)
+
+
+def compile_decimal_rule(rule: str) -> Node:
+    """Return the (cached, optimized) expression tree of a rule for the Decimal numeric backends."""
+    return _compile_decimal_rule(rule, decimal.getcontext().prec)
+
+
+def compile_decimal_condition_function(condition: str) -> CompiledExpression:
+    """Compile a condition into a (cached) native Python function for the Decimal numeric backends."""
+    return _compile_decimal_condition_function(condition, decimal.getcontext().prec)
+
+
+def compile_decimal_rule_function(rule: str) -> CompiledExpression:
+    """Compile a rule into a (cached) native Python function for the Decimal numeric backends."""
+    return _compile_decimal_rule_function(rule, decimal.getcontext().prec)
+
+
+# Compilers by backend, and by whether the numeric backend is a Decimal one.
+_CONDITION_COMPILERS = {
+    (TREE_BACKEND, False): compile_condition,
+    (CODEGEN_BACKEND, False): compile_condition_function,
+    (TREE_BACKEND, True): compile_decimal_condition,
+    (CODEGEN_BACKEND, True): compile_decimal_condition_function,
+}
+_RULE_COMPILERS = {
+    (TREE_BACKEND, False): compile_rule,
+    (CODEGEN_BACKEND, False): compile_rule_function,
+    (TREE_BACKEND, True): compile_decimal_rule,
+    (CODEGEN_BACKEND, True): compile_decimal_rule_function,
+}
+
+
+def get_condition_tree(condition: str) -> Node:
+    """Return the expression tree of a condition for the current numeric backend."""
+    if get_numeric_backend() == FLOAT:
+        return compile_condition(condition)
+    return compile_decimal_condition(condition)
+
+
+def get_rule_tree(rule: str) -> Node:
+    """Return the expression tree of a rule for the current numeric backend."""
+    if get_numeric_backend() == FLOAT:
+        return compile_rule(rule)
+    return compile_decimal_rule(rule)
+
+
 # The following mixin class is used to set the context where needed.
 # ------------------------------------------------------------------
 
 
 class ContextMixin:
-    """Mixin to set ParseActions for elements that need a dynamic context."""
-    def __init__(self, context: Optional[StrMapping] = None):
+    """Mixin to resolve named variables against a context.
+
+    The context is bound to the instance and handed to the compiled formula
+    as a resolver on every evaluation, so no state is shared between
+    evaluations: nested and concurrent ones (eg: in other threads) each see
+    their own context.
+
+    The numeric backend, if given, is entered (see cimbolic.numeric) for the
+    evaluation, including that of the variables it resolves; otherwise, the
+    current one is used.
+    """
+    def __init__(
+            self,
+            context: Optional[StrMapping] = None,
+            backend: Optional[str] = None,
+            numeric: Optional[str] = None,
+    ):
         self.context: StrMapping = context or {}
-
-    def get_named_variable_parse_action(self) -> Callable[[Tokens], Numeric]:
-        """Return a ParseAction callable for a named_variable token."""
-        def to_value(toks: Tokens) -> Numeric:
-            """Fetch the variable from the database and return its value."""
-            var_name: str = toks[0]
-            from cimbolic.models import Variable
-            try:
-                var = Variable.objects.get(name=var_name)
-            except Variable.DoesNotExist:
-                raise LookupError(f'Variable {var_name} not found in the database')
-            else:
-                value = var.to_value(self.context)
-                return value
-        return to_value
+        self.backend: str = backend or get_default_backend()
+        if self.backend not in BACKENDS:
+            raise ValueError(f'Unknown evaluation backend {self.backend!r} (choose from {BACKENDS})')
+        self.numeric: Optional[str] = numeric
+
+    def resolve_named_variable(self, var_name: str) -> Numeric:
+        """Fetch the variable from the registry and return its value."""
+        session = get_current_session()
+        if session is not None and var_name in session.values and session.applies_to(self.context):
+            tracer = get_current_tracer()
+            if tracer is not None:
+                with tracer.span(VARIABLE, var_name, cache_hit=True):
+                    return session.get(var_name)
+            return session.get(var_name)
+
+        from cimbolic.models import Variable
+        try:
+            var = registry.get_variable(var_name)
+        except Variable.DoesNotExist:
+            raise LookupError(f'Variable {var_name} not found in the database')
+        else:
+            value = var.to_value(self.context)
+            return value
+
+    async def aresolve_named_variable(self, var_name: str) -> Numeric:
+        """Asynchronously fetch the variable from the registry and return its value."""
+        session = get_current_session()
+        if session is not None and var_name in session.values and session.applies_to(self.context):
+            return session.get(var_name)
+
+        from cimbolic.models import Variable
+        try:
+            var = await registry.aget_variable(var_name)
+        except Variable.DoesNotExist:
+            raise LookupError(f'Variable {var_name} not found in the database')
+        else:
+            value = await var.ato_value(self.context)
+            return value
+
+    async def aresolve_named_variables(self, tree: Node) -> Resolver:
+        """Concurrently resolve every variable referenced in the tree.
+
+        Return a resolver that looks the resolved values up.
+        """
+        var_names = named_variables(tree)
+        values = await asyncio.gather(*[self.aresolve_named_variable(var_name) for var_name in var_names])
+        return dict(zip(var_names, values)).__getitem__
+
+    async def aevaluate_lazily(self, tree: Node) -> Any:
+        """Asynchronously evaluate a condition's tree, short-circuiting 'and' and 'or'.
+
+        The variables referenced by an operand of a logical operation are only
+        resolved if the operand is needed; those referenced by a comparison
+        are resolved concurrently.
+        """
+        if isinstance(tree, LogicalOperation):
+            left = await self.aevaluate_lazily(tree.left)
+            if bool(left) != (tree.operator == 'and'):
+                return left
+            return await self.aevaluate_lazily(tree.right)
+        if isinstance(tree, Negation):
+            return not await self.aevaluate_lazily(tree.operand)
+        resolve = await self.aresolve_named_variables(tree)
+        return tree.evaluate(resolve)
 
 
 # The following classes are the API to Cimbolic's parsing functionality.
@@ -213,32 +494,80 @@ class ContextMixin:
 
 class Condition(ContextMixin):
     """Encapsulation of a condition object."""
-    def __init__(self, condition: str, context: Optional[StrMapping] = None):
-        super().__init__(context)
+    def __init__(
+            self,
+            condition: str,
+            context: Optional[StrMapping] = None,
+            backend: Optional[str] = None,
+            numeric: Optional[str] = None,
+    ):
+        super().__init__(context, backend, numeric)
         self.condition: str = condition
 
-    def evaluate(self) -> bool:
-        """Parse self.condition and return a corresponding boolean value."""
-        if self.condition.strip().upper() == 'NULL':
-            return True
-        else:
-            _named_variable.setParseAction(self.get_named_variable_parse_action())
-            parse_results = _conditional_expression.parseString(self.condition)
-            _named_variable.setParseAction(None)
-            result: bool = _evaluator(parse_results)
-            return result
+    def evaluate(self, resolve: Optional[Resolver] = None) -> bool:
+        """Evaluate self.condition and return a corresponding boolean value.
+
+        Named variables are resolved with the given resolver, if any.
+        """
+        numeric = self.numeric or get_numeric_backend()
+        if not is_entered(numeric):
+            with numeric_backend(numeric):
+                return self.evaluate(resolve)
+        compiled = _CONDITION_COMPILERS[self.backend, numeric != FLOAT](self.condition)
+        result: bool = compiled.evaluate(resolve or self.resolve_named_variable)
+        return result
+
+    async def aevaluate(self) -> bool:
+        """Asynchronously evaluate self.condition and return a boolean value.
+
+        Like evaluate(), the operands of 'and' and 'or' are only evaluated
+        (and their variables resolved) if needed.
+        """
+        numeric = self.numeric or get_numeric_backend()
+        if not is_entered(numeric):
+            with numeric_backend(numeric):
+                return await self.aevaluate()
+        tree = get_condition_tree(self.condition)
+        if isinstance(tree, (LogicalOperation, Negation)):
+            return await self.aevaluate_lazily(tree)
+        compiled = _CONDITION_COMPILERS[self.backend, numeric != FLOAT](self.condition)
+        resolve = await self.aresolve_named_variables(tree)
+        result: bool = compiled.evaluate(resolve)
+        return result
 
 
 class Rule(ContextMixin):
     """Encapsulation of an arithmetic rule object."""
-    def __init__(self, rule: str, context: Optional[StrMapping] = None):
-        super().__init__(context)
+    def __init__(
+            self,
+            rule: str,
+            context: Optional[StrMapping] = None,
+            backend: Optional[str] = None,
+            numeric: Optional[str] = None,
+    ):
+        super().__init__(context, backend, numeric)
         self.rule: str = rule
 
-    def evaluate(self) -> Numeric:
-        """Parse self.rule and return a corresponding value."""
-        _named_variable.setParseAction(self.get_named_variable_parse_action())
-        parse_results = _arithmetic_expression.parseString(self.rule)
-        _named_variable.setParseAction(None)
-        result: Numeric = _evaluator(parse_results)
+    def evaluate(self, resolve: Optional[Resolver] = None) -> Numeric:
+        """Evaluate self.rule and return a corresponding value.
+
+        Named variables are resolved with the given resolver, if any.
+        """
+        numeric = self.numeric or get_numeric_backend()
+        if not is_entered(numeric):
+            with numeric_backend(numeric):
+                return self.evaluate(resolve)
+        compiled = _RULE_COMPILERS[self.backend, numeric != FLOAT](self.rule)
+        result: Numeric = compiled.evaluate(resolve or self.resolve_named_variable)
+        return result
+
+    async def aevaluate(self) -> Numeric:
+        """Asynchronously evaluate self.rule and return a corresponding value."""
+        numeric = self.numeric or get_numeric_backend()
+        if not is_entered(numeric):
+            with numeric_backend(numeric):
+                return await self.aevaluate()
+        compiled = _RULE_COMPILERS[self.backend, numeric != FLOAT](self.rule)
+        resolve = await self.aresolve_named_variables(get_rule_tree(self.rule))
+        result: Numeric = compiled.evaluate(resolve)
         return result
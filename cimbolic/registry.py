@@ -0,0 +1,310 @@
+"""In-process registry of the variables and formulae used during evaluation.
+
+Resolving a named variable used to cost a query for the variable and another
+for its formulae, at every level of recursion. The registry loads every
+active variable and all of their formulae (sorted by priority) in two
+queries, and serves evaluation from memory until it's invalidated.
+
+The registry is invalidated whenever a Variable or a Formula is saved or
+deleted (see cimbolic.signals). Changes that don't send those signals, such
+as QuerySet.update() calls, should be followed by a call to
+registry.invalidate().
+
+Changes made within a transaction are only seen by the thread making them
+until it commits: that thread evaluates with a snapshot of its own, read
+from the database and kept until the transaction ends, while the shared
+snapshot is only discarded once the transaction commits. If it's rolled
+back instead (or the savepoint in which the changes were made is), the
+thread's snapshot is thrown away with it.
+
+Each process (eg: every web server worker) loads its own registry. When the
+CIMBOLIC_REGISTRY_CACHE setting names one of Django's caches, the loaded
+rows are shared through it instead, under a version stamp:
+
+- a process loads the rows of the current stamp from the cache, and only
+  queries the database (and stores what it read) if they aren't there;
+- invalidating the registry bumps the stamp once the current transaction
+  commits (and not at all if it's rolled back), so that every process
+  reloads;
+- a process checks the stamp at most once every
+  CIMBOLIC_REGISTRY_CHECK_INTERVAL seconds (1 by default), so changes made
+  by other processes are seen within that interval.
+
+The cache has to be shared between the processes (eg: Memcached, Redis or
+the file-based cache) for the stamp to reach them.
+"""
+
+# So that one may import * from this module.
+__all__ = ['VariableRegistry', 'bump_version', 'get_shared_cache', 'get_version', 'registry']
+
+import asyncio
+import threading
+import time
+import weakref
+from typing import TYPE_CHECKING, Any, Dict, List, NamedTuple, Optional, Tuple
+
+from django.db import transaction
+
+if TYPE_CHECKING:
+    from .expressions import Node
+    from .models import Formula, Variable
+    from .selection import SelectionPlan
+
+
+# Keys of the version stamp and of the rows loaded for a stamp in the shared cache.
+VERSION_KEY = 'cimbolic:registry:version'
+ROWS_KEY = 'cimbolic:registry:rows:{}'
+
+# Default number of seconds between checks of the version stamp.
+DEFAULT_CHECK_INTERVAL = 1.0
+
+
+def get_shared_cache() -> Optional[Any]:
+    """Return the cache set by the CIMBOLIC_REGISTRY_CACHE setting, if any."""
+    from django.conf import settings
+    from django.core.cache import caches
+    alias = getattr(settings, 'CIMBOLIC_REGISTRY_CACHE', None)
+    return caches[alias] if alias else None
+
+
+def get_check_interval() -> float:
+    """Return the interval set by the CIMBOLIC_REGISTRY_CHECK_INTERVAL setting (or the default)."""
+    from django.conf import settings
+    return getattr(settings, 'CIMBOLIC_REGISTRY_CHECK_INTERVAL', DEFAULT_CHECK_INTERVAL)
+
+
+def get_version(cache: Any) -> int:
+    """Return the current version stamp, setting one if the cache has none."""
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        # Starting from the time keeps the stamp increasing if it was evicted.
+        cache.add(VERSION_KEY, int(time.time() * 1000), None)
+        version = cache.get(VERSION_KEY)
+    return version
+
+
+def bump_version(cache: Any) -> int:
+    """Increment the version stamp, so that every process reloads its registry."""
+    try:
+        return cache.incr(VERSION_KEY)
+    except ValueError:
+        # The stamp was evicted (or never set).
+        get_version(cache)
+        return cache.incr(VERSION_KEY)
+
+
+class _Snapshot(NamedTuple):
+    """The variables and formulae loaded by a registry at a point in time."""
+    variables: Dict[str, 'Variable']
+    formulae: Dict[int, List['Formula']]
+    # Selection plans of the formulae, built on first use.
+    plans: Dict[int, 'SelectionPlan']
+
+
+class VariableRegistry:
+    """Lazily loaded, in-memory index of active variables and their formulae."""
+    def __init__(self):
+        self._snapshot: Optional[_Snapshot] = None
+        self._generation = 0
+        self._lock = threading.Lock()
+        # The shared cache and the version stamp of the loaded snapshot, if
+        # any, and when to check the stamp next.
+        self._cache: Optional[Any] = None
+        self._version: Optional[int] = None
+        self._check_interval = DEFAULT_CHECK_INTERVAL
+        self._next_check = 0.0
+        # Weak references to the callbacks scheduled for when the current
+        # thread's transaction commits, one per change to the registry, and
+        # the snapshot of those changes.
+        self._local = threading.local()
+
+    @property
+    def is_loaded(self) -> bool:
+        return self._snapshot is not None
+
+    def _read_rows(self) -> Tuple[List['Variable'], List['Formula'], Dict[str, 'Node'], Dict[str, 'Node']]:
+        """Query the active variables and their formulae (sorted by priority).
+
+        Return them along with the expression trees stored with the formulae
+        (by condition and by rule), which spare parsing them.
+        """
+        from .models import Formula, Variable
+        variables = list(Variable.objects.filter(is_active=True))
+        formulae = list(Formula.objects.filter(variable__is_active=True).order_by('variable_id', 'priority'))
+        conditions: Dict[str, 'Node'] = {}
+        rules: Dict[str, 'Node'] = {}
+        for formula in formulae:
+            trees = formula.stored_trees()
+            if trees is not None:
+                conditions[formula.condition], rules[formula.rule] = trees
+        return variables, formulae, conditions, rules
+
+    @staticmethod
+    def _to_snapshot(rows: Tuple[List['Variable'], List['Formula'], Dict[str, 'Node'], Dict[str, 'Node']]) -> _Snapshot:
+        from .models import Formula
+        from .parsing import set_stored_trees
+        variable_list, formula_list, conditions, rules = rows
+        variables = {var.name: var for var in variable_list}
+        variables_by_pk = {var.pk: var for var in variables.values()}
+        formulae: Dict[int, List[Formula]] = {pk: [] for pk in variables_by_pk}
+        for formula in formula_list:
+            formula.variable = variables_by_pk[formula.variable_id]
+            formulae[formula.variable_id].append(formula)
+        set_stored_trees(conditions, rules)
+        return _Snapshot(variables, formulae, {})
+
+    def load(self) -> _Snapshot:
+        """(Re)load the active variables and their formulae.
+
+        They're read from the shared cache if there's one holding them for the
+        current version stamp, and from the database otherwise. Within a
+        transaction, they're always read from the database, and aren't shared.
+        """
+        generation = self._generation
+        cache = get_shared_cache()
+        version = None
+        rows = None
+        shares_rows = cache is not None and not transaction.get_connection().in_atomic_block
+        if cache is not None:
+            version = get_version(cache)
+        if shares_rows:
+            rows = cache.get(ROWS_KEY.format(version))
+        if rows is None:
+            rows = self._read_rows()
+            if shares_rows:
+                cache.set(ROWS_KEY.format(version), rows)
+        snapshot = self._to_snapshot(rows)
+        # Don't keep what was loaded if the registry got invalidated meanwhile.
+        if generation == self._generation:
+            self._snapshot = snapshot
+            self._cache = cache
+            self._version = version
+            self._check_interval = get_check_interval()
+            self._next_check = time.monotonic() + self._check_interval
+        return snapshot
+
+    def _is_outdated(self) -> bool:
+        """Return whether the version stamp changed, checking it at most once per interval."""
+        if self._cache is None or time.monotonic() < self._next_check:
+            return False
+        self._next_check = time.monotonic() + self._check_interval
+        return get_version(self._cache) != self._version
+
+    def _is_changed_in_transaction(self) -> bool:
+        """Return whether the current thread's transaction changed the registry (and is still open)."""
+        return bool(getattr(self._local, 'commits', None))
+
+    def snapshot(self) -> _Snapshot:
+        """Return the currently loaded snapshot, loading one if needed.
+
+        Within a transaction that changed the registry, that's the snapshot of
+        the current thread's changes.
+        """
+        if self._is_changed_in_transaction():
+            snapshot = getattr(self._local, 'snapshot', None)
+            if snapshot is None:
+                snapshot = self._local.snapshot = self._to_snapshot(self._read_rows())
+            return snapshot
+        snapshot = self._snapshot
+        if snapshot is not None and self._is_outdated():
+            self._discard()
+            snapshot = None
+        if snapshot is None:
+            with self._lock:
+                snapshot = self._snapshot or self.load()
+        return snapshot
+
+    async def asnapshot(self) -> _Snapshot:
+        """Return the currently loaded snapshot, loading one in a thread if needed."""
+        snapshot = self._snapshot
+        if snapshot is None or (self._cache is not None and time.monotonic() >= self._next_check):
+            loop = asyncio.get_event_loop()
+            snapshot = await loop.run_in_executor(None, self.snapshot)
+        return snapshot
+
+    def _discard(self):
+        self._generation += 1
+        self._snapshot = None
+
+    def invalidate(self):
+        """Discard the loaded snapshot so that the next lookup reloads it.
+
+        Within a transaction, only the current thread's snapshot is discarded
+        until the transaction commits: the shared one is then, and with a
+        shared cache, the version stamp is bumped as well, so that other
+        processes don't reload what they can't see yet. However many times
+        it's invalidated within a transaction, that only happens once.
+        """
+        local = self._local
+        local.snapshot = None
+        if not hasattr(local, 'commits'):
+            local.commits = []
+        cache = get_shared_cache()
+
+        def commit():
+            if not local.commits:
+                # Another change's callback did it.
+                return
+            local.commits = []
+            local.snapshot = None
+            if cache is not None:
+                bump_version(cache)
+            self._discard()
+
+        def dropped(ref: 'weakref.ref'):
+            # The callback was discarded without being called: the transaction
+            # (or the savepoint in which the change was made) was rolled back.
+            if ref in local.commits:
+                local.commits.remove(ref)
+                local.snapshot = None
+        # Only the transaction's list of callbacks holds on to the callback, so
+        # it's freed (in this thread) as soon as a rollback discards it.
+        local.commits.append(weakref.ref(commit, dropped))
+        transaction.on_commit(commit)
+
+    def get_variable(self, name: str) -> 'Variable':
+        """Return the active variable with the given name."""
+        try:
+            return self.snapshot().variables[name]
+        except KeyError:
+            from .models import Variable
+            raise Variable.DoesNotExist(f'Active variable ${name} not found')
+
+    async def aget_variable(self, name: str) -> 'Variable':
+        """Asynchronously return the active variable with the given name."""
+        await self.asnapshot()
+        return self.get_variable(name)
+
+    def get_formulae(self, variable: 'Variable') -> List['Formula']:
+        """Return the formulae of the variable sorted by priority."""
+        try:
+            return self.snapshot().formulae[variable.pk]
+        except KeyError:
+            # The variable is inactive or was created after the last load.
+            return list(variable.prioritized_formulae())
+
+    def get_selection_plan(self, variable: 'Variable') -> 'SelectionPlan':
+        """Return the selection plan of the variable's formulae (see cimbolic.selection)."""
+        from .selection import build_selection_plan
+        snapshot = self.snapshot()
+        plan = snapshot.plans.get(variable.pk)
+        if plan is None:
+            formulae = snapshot.formulae.get(variable.pk)
+            if formulae is None:
+                # The variable is inactive or was created after the last load.
+                return build_selection_plan(list(variable.prioritized_formulae()))
+            plan = snapshot.plans[variable.pk] = build_selection_plan(formulae)
+        return plan
+
+    async def aget_formulae(self, variable: 'Variable') -> List['Formula']:
+        """Asynchronously return the formulae of the variable sorted by priority."""
+        snapshot = await self.asnapshot()
+        try:
+            return snapshot.formulae[variable.pk]
+        except KeyError:
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(None, self.get_formulae, variable)
+
+
+# The registry shared by the whole process.
+registry = VariableRegistry()
@@ -0,0 +1,166 @@
+"""Selection of the formula that applies to a variable, by priority.
+
+A variable's value is given by the rule of its first formula (by priority)
+whose condition holds, which takes evaluating the conditions one by one.
+Variables with many formulae often test a single variable against a series
+of values (`$GRADE == 1`, `$GRADE == 2`, ...), so a selection plan splits
+the formulae into segments, in priority order:
+
+- runs of at least MIN_INDEXED_RUN consecutive formulae whose conditions
+  compare the same named variable for equality with a constant become an
+  index, a dict from the constants to the first formula comparing with each;
+  the variable is resolved once and the formula looked up;
+- every other formula is scanned like before.
+
+Since a run is only ever looked up at its place in the order, and equal
+constants (eg: 1, 1.0 and true) keep the formula of the highest priority, the
+formula selected is always the one a scan would've selected. Values that
+can't be hashed fall back to comparing with every constant of the run.
+
+The Decimal numeric backends (see cimbolic.numeric) compare Decimals, so each
+run is indexed again, on first use, by the constants of its Decimal trees at
+the current decimal precision. Should one of those not compare with a
+constant (eg: `$X == 1 / 3` only folds to a float), the run is scanned.
+"""
+
+# So that one may import * from this module.
+__all__ = [
+    'MIN_INDEXED_RUN',
+    'IndexedRun',
+    'SelectionPlan',
+    'build_selection_plan',
+    'select_formula',
+]
+
+import decimal
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, NamedTuple, Optional, Tuple, Union
+
+from .expressions import BinaryOperation, Constant, NamedVariable, Node, _to_decimal, _to_native
+from .numeric import FLOAT, get_numeric_backend
+from .parsing import ContextMixin, compile_condition, compile_decimal_condition
+from .tracing import annotate, get_current_tracer
+
+if TYPE_CHECKING:
+    from .models import Formula
+
+
+# Minimum number of consecutive equality conditions worth indexing.
+MIN_INDEXED_RUN = 4
+
+
+class IndexedRun(NamedTuple):
+    """Consecutive formulae whose conditions compare a variable with constants."""
+    name: str
+    formulae: Dict[Any, 'Formula']
+    scan: List[Tuple[Any, 'Formula']]
+    # Indexes for the Decimal numeric backends by decimal precision, built on
+    # first use (None where the run can't be indexed at that precision).
+    decimal_formulae: Dict[int, Optional[Dict[Any, 'Formula']]]
+
+
+# A plan is a list of formulae to scan and indexed runs, in priority order.
+SelectionPlan = List[Union['Formula', IndexedRun]]
+
+
+def _equality_key(tree: Node) -> Optional[Tuple[str, Any]]:
+    """Return the variable name and constant of a `$X == constant` condition."""
+    if not isinstance(tree, BinaryOperation) or tree.operator != '==':
+        return None
+    if isinstance(tree.left, NamedVariable) and isinstance(tree.right, Constant):
+        return tree.left.name, tree.right.value
+    if isinstance(tree.left, Constant) and isinstance(tree.right, NamedVariable):
+        return tree.right.name, tree.left.value
+    return None
+
+
+def _to_segment(run: List[Tuple[str, Any, 'Formula']]) -> List[Union['Formula', IndexedRun]]:
+    if len(run) < MIN_INDEXED_RUN:
+        return [formula for __, __, formula in run]
+    formulae: Dict[Any, 'Formula'] = {}
+    for __, constant, formula in run:
+        formulae.setdefault(constant, formula)
+    return [IndexedRun(run[0][0], formulae, [(constant, formula) for __, constant, formula in run], {})]
+
+
+def build_selection_plan(formulae: List['Formula']) -> SelectionPlan:
+    """Split formulae (sorted by priority) into formulae to scan and indexed runs."""
+    plan: SelectionPlan = []
+    run: List[Tuple[str, Any, 'Formula']] = []
+    for formula in formulae:
+        try:
+            key = _equality_key(compile_condition(formula.condition))
+        except Exception:
+            # It will fail again (as it should) when it's evaluated.
+            key = None
+        if key is not None and run and key[0] == run[0][0]:
+            run.append((key[0], key[1], formula))
+            continue
+        plan.extend(_to_segment(run))
+        run = [(key[0], key[1], formula)] if key is not None else []
+        if key is None:
+            plan.append(formula)
+    plan.extend(_to_segment(run))
+    return plan
+
+
+def _decimal_index(segment: IndexedRun) -> Optional[Dict[Any, 'Formula']]:
+    """Return the index of a run for the Decimal numeric backends, at the current precision."""
+    precision = decimal.getcontext().prec
+    try:
+        return segment.decimal_formulae[precision]
+    except KeyError:
+        pass
+    formulae: Optional[Dict[Any, 'Formula']] = {}
+    for __, formula in segment.scan:
+        try:
+            key = _equality_key(compile_decimal_condition(formula.condition))
+        except Exception:
+            key = None
+        if key is None or key[0] != segment.name:
+            formulae = None
+            break
+        formulae.setdefault(key[1], formula)
+    segment.decimal_formulae[precision] = formulae
+    return formulae
+
+
+def _lookup(formulae: Dict[Any, 'Formula'], value: Any) -> Optional['Formula']:
+    try:
+        return formulae.get(value)
+    except TypeError:
+        # The value is unhashable, so compare it with every constant (which
+        # are in priority order, and equal ones were left out).
+        for constant, formula in formulae.items():
+            if value == constant:
+                return formula
+        return None
+
+
+def select_formula(
+        plan: SelectionPlan,
+        context: Optional[Dict[str, Any]] = None,
+        resolve: Optional[Callable[[str], Any]] = None,
+) -> Optional['Formula']:
+    """Return the first formula of the plan whose condition holds, if any."""
+    for segment in plan:
+        if not isinstance(segment, IndexedRun):
+            if segment.condition_to_boolean(context, resolve):
+                return segment
+            continue
+        # Resolve the variable like evaluating the conditions would have.
+        if get_numeric_backend() == FLOAT:
+            formulae, to_value = segment.formulae, _to_native
+        else:
+            formulae, to_value = _decimal_index(segment), _to_decimal
+            if formulae is None:
+                for __, formula in segment.scan:
+                    if formula.condition_to_boolean(context, resolve):
+                        return formula
+                continue
+        resolver = resolve or ContextMixin(context).resolve_named_variable
+        formula = _lookup(formulae, to_value(resolver(segment.name)))
+        if formula is not None:
+            if get_current_tracer() is not None:
+                annotate(indexed=True)
+            return formula
+    return None
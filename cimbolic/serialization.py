@@ -0,0 +1,108 @@
+"""Compact serialization of compiled expression trees.
+
+Parsing a formula with the grammar is by far the slowest part of compiling
+it, and every new process used to parse every formula again on first use.
+A Formula therefore stores the serialized expression trees of its condition
+and rule alongside their text (see Formula.save), and the registry hands
+those to the parsing module when it loads, so that they're deserialized
+rather than parsed.
+
+A tree is serialized as compact JSON, each node being an array whose first
+element is a one-letter tag:
+
+    ["c", value]                     Constant
+    ["v", name]                      NamedVariable
+    ["m", name, [arg, ...]]          AggregateMacro
+    ["b", operator, left, right]     BinaryOperation
+    ["l", operator, left, right]     LogicalOperation
+    ["n", operand]                   Negation
+
+Loading a tree validates it: operators, macro names, variable names and
+constants must be those the grammar can produce, since the code generation
+backend turns trees into Python source (see cimbolic.codegen).
+
+FORMAT_VERSION must be incremented whenever this format, the grammar, the
+way trees are built from parsed tokens or the way they're optimized (see
+cimbolic.optimization) changes, so that stale stored forms are ignored (and
+can be rebuilt with the compileformulae command).
+"""
+
+# So that one may import * from this module.
+__all__ = ['FORMAT_VERSION', 'dump_tree', 'load_tree']
+
+import json
+import re
+from typing import Any
+
+from .expressions import (
+    _AGGREGATE_FUNCTIONS,
+    _BINARY_OPERATORS,
+    AggregateMacro,
+    BinaryOperation,
+    Constant,
+    LogicalOperation,
+    NamedVariable,
+    Negation,
+    Node,
+)
+
+
+# Version of the stored form of compiled formulae.
+FORMAT_VERSION = 2
+
+_LOGICAL_OPERATORS = ('and', 'or')
+_CONSTANT_TYPES = (type(None), bool, int, float, str)
+_name_regex = re.compile(r'[a-zA-Z_][a-zA-Z0-9_]*')
+
+
+def _to_data(node: Node) -> list:
+    if isinstance(node, Constant):
+        return ['c', node.value]
+    if isinstance(node, NamedVariable):
+        return ['v', node.name]
+    if isinstance(node, AggregateMacro):
+        return ['m', node.name, [_to_data(arg) for arg in node.args]]
+    if isinstance(node, BinaryOperation):
+        return ['b', node.operator, _to_data(node.left), _to_data(node.right)]
+    if isinstance(node, LogicalOperation):
+        return ['l', node.operator, _to_data(node.left), _to_data(node.right)]
+    if isinstance(node, Negation):
+        return ['n', _to_data(node.operand)]
+    raise TypeError(f'Unknown expression tree node: {node!r}')
+
+
+def _reject_constant(name: str):
+    raise ValueError(f'Invalid constant in a serialized expression tree: {name}')
+
+
+def _from_data(data: Any) -> Node:
+    if not isinstance(data, list) or not data:
+        raise ValueError(f'Invalid serialized expression tree node: {data!r}')
+    # The operator or name of the node, if any.
+    tag, label = data[0], data[1] if len(data) > 1 and isinstance(data[1], str) else None
+    if tag == 'c' and len(data) == 2 and isinstance(data[1], _CONSTANT_TYPES):
+        return Constant(data[1])
+    if tag == 'v' and len(data) == 2 and label is not None and _name_regex.fullmatch(label):
+        return NamedVariable(label)
+    if tag == 'm' and len(data) == 3 and label in _AGGREGATE_FUNCTIONS and isinstance(data[2], list):
+        return AggregateMacro(label, tuple(_from_data(arg) for arg in data[2]))
+    if tag == 'b' and len(data) == 4 and label in _BINARY_OPERATORS:
+        return BinaryOperation(label, _from_data(data[2]), _from_data(data[3]))
+    if tag == 'l' and len(data) == 4 and label in _LOGICAL_OPERATORS:
+        return LogicalOperation(label, _from_data(data[2]), _from_data(data[3]))
+    if tag == 'n' and len(data) == 2:
+        return Negation(_from_data(data[1]))
+    raise ValueError(f'Invalid serialized expression tree node: {data!r}')
+
+
+def dump_tree(node: Node) -> str:
+    """Serialize an expression tree into a compact JSON string."""
+    return json.dumps(_to_data(node), separators=(',', ':'))
+
+
+def load_tree(text: str) -> Node:
+    """Deserialize an expression tree serialized with dump_tree().
+
+    Raise a ValueError if the text isn't a valid serialized tree.
+    """
+    return _from_data(json.loads(text, parse_constant=_reject_constant))
@@ -0,0 +1,122 @@
+"""Evaluation sessions that memoize variable values for a single context.
+
+A variable referenced several times in a formula, or by several formulae down
+its dependency tree, would otherwise be looked up and evaluated once per
+reference. Within an EvaluationSession every variable is evaluated at most
+once for the session's context:
+
+    with EvaluationSession(context) as session:
+        basic = Variable.objects.get(name='BASIC').to_value(context)
+        net_pay = Variable.objects.get(name='NET_PAY').to_value(context)
+    print(session.hits, session.misses)
+
+The session used by Variable.to_value (and by the resolution of named
+variables during parsing) is the innermost one entered in the current
+execution context (a context variable, so each thread, and each asyncio task
+created while no session was entered, has its own), and only evaluations with
+a context equal to the session's are memoized. The context shouldn't be
+mutated while the session is open. Variable.ato_value uses the current
+session as well: the tasks it gathers to resolve the variables of a formula
+share it, and a variable that several of them need at once is evaluated once,
+the others awaiting that evaluation. Values are only memoized while the
+numeric backend (see cimbolic.numeric) that was current when the session was
+created is.
+"""
+
+# So that one may import * from this module.
+__all__ = ['EvaluationSession', 'get_current_session']
+
+import asyncio
+from contextvars import ContextVar, Token
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from .numeric import get_numeric_backend
+
+
+_current_session: 'ContextVar[Optional[EvaluationSession]]' = ContextVar('cimbolic_session', default=None)
+
+
+def get_current_session() -> Optional['EvaluationSession']:
+    """Return the innermost session entered in the current execution context, if any."""
+    return _current_session.get()
+
+
+class EvaluationSession:
+    """Memoization of variable values (by variable name) for a context."""
+    def __init__(self, context: Optional[Dict[str, Any]] = None):
+        self.context: Dict[str, Any] = context or {}
+        self.numeric: str = get_numeric_backend()
+        self.values: Dict[str, Any] = {}
+        self.hits = 0
+        self.misses = 0
+        # Futures of the values being evaluated asynchronously, by variable name.
+        self._pending: Dict[str, asyncio.Future] = {}
+        self._token: Optional[Token] = None
+
+    def __enter__(self) -> 'EvaluationSession':
+        self._token = _current_session.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        _current_session.reset(self._token)
+        self._token = None
+
+    def __repr__(self):
+        return f'<EvaluationSession: {len(self.values)} values, {self.hits} hits, {self.misses} misses>'
+
+    def applies_to(self, context: Optional[Dict[str, Any]]) -> bool:
+        """Return whether values evaluated with the context (and the current numeric backend) are memoized here."""
+        context = context or {}
+        return (context is self.context or context == self.context) and get_numeric_backend() == self.numeric
+
+    def get(self, name: str) -> Any:
+        """Return the memoized value of a variable, or raise a KeyError."""
+        value = self.values[name]
+        self.hits += 1
+        return value
+
+    def get_value(self, name: str, evaluate: Callable[[], Any]) -> Any:
+        """Return the memoized value of a variable, evaluating it if needed."""
+        if name in self.values:
+            return self.get(name)
+        self.misses += 1
+        value = evaluate()
+        self.values[name] = value
+        return value
+
+    async def aget_value(self, name: str, evaluate: Callable[[], Awaitable[Any]]) -> Any:
+        """Return the memoized value of a variable, awaiting its evaluation if needed.
+
+        If the variable is already being evaluated (by a concurrent task), that
+        evaluation is awaited rather than started again.
+        """
+        if name in self.values:
+            return self.get(name)
+        pending = self._pending.get(name)
+        if pending is not None:
+            self.hits += 1
+            return await asyncio.shield(pending)
+        self.misses += 1
+        future = asyncio.get_event_loop().create_future()
+        self._pending[name] = future
+        try:
+            value = await evaluate()
+        except BaseException as exc:
+            if isinstance(exc, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(exc)
+                # Mark the exception as retrieved, in case no other task awaits it.
+                future.exception()
+            raise
+        finally:
+            self._pending.pop(name, None)
+        self.values[name] = value
+        future.set_result(value)
+        return value
+
+    def clear(self):
+        """Forget the memoized values and reset the hit and miss counts."""
+        self.values.clear()
+        self.hits = 0
+        self.misses = 0
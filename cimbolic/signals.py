@@ -0,0 +1,23 @@
+from django.core.signals import setting_changed
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import Formula, Variable
+from .numeric import reset_default_numeric_backend
+from .registry import registry
+
+
+@receiver(post_save, sender=Variable)
+@receiver(post_delete, sender=Variable)
+@receiver(post_save, sender=Formula)
+@receiver(post_delete, sender=Formula)
+def invalidate_registry(sender, **kwargs):
+    """Invalidate the in-process registry when variables or formulae change."""
+    registry.invalidate()
+
+
+@receiver(setting_changed)
+def reset_numeric_backend(setting, **kwargs):
+    """Read the default numeric backend again when its setting changes (eg: in tests)."""
+    if setting == 'CIMBOLIC_NUMERIC_BACKEND':
+        reset_default_numeric_backend()
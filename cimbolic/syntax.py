@@ -0,0 +1,504 @@
+"""Hand-written tokenizer and parser for the Cimbolic language.
+
+The PyParsing grammar in cimbolic.parsing backtracks heavily: its
+alternatives re-parse the same prefixes over and over, and since it's
+left-recursive, a formula it doesn't accept exhausts the recursion limit. This
+module accepts the very same language in (roughly) linear time:
+
+- tokenize() splits a formula into tokens in a single pass over it;
+- arithmetic expressions are parsed by precedence climbing (a Pratt parser)
+  straight into expression trees;
+- conditions follow the alternatives of the grammar in the same order, but
+  each is parsed at most once at every position (the results are memoized),
+  and logical combinations are parsed in a loop rather than recursively.
+
+Where the grammar stops, so does the parser: trailing text that isn't part of
+the formula is ignored, a formula that doesn't parse raises a
+FormulaSyntaxError at the position the grammar would've reported, and one
+that would've exhausted the recursion limit raises a FormulaSyntaxError at
+the position where an operand was expected. The checkparser management
+command checks the two against each other.
+"""
+
+# So that one may import * from this module.
+__all__ = ['Token', 'parse_condition', 'parse_rule', 'tokenize']
+
+import ast
+import re
+from decimal import Decimal
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple, Union
+
+from .exceptions import FormulaSyntaxError
+from .expressions import (
+    AggregateMacro,
+    BinaryOperation,
+    Constant,
+    LogicalOperation,
+    NamedVariable,
+    Negation,
+    Node,
+)
+
+
+# The following are the tokens of the Cimbolic language.
+# -------------------------------------------------------
+
+
+class Token(NamedTuple):
+    """A token of a formula, with its start and end positions in the formula."""
+    kind: str
+    text: str
+    start: int
+    end: int
+
+
+NUMBER = 'NUMBER'
+VARIABLE = 'VARIABLE'
+LITERAL = 'LITERAL'
+NAME = 'NAME'
+STRING = 'STRING'
+OPERATOR = 'OPERATOR'
+ERROR = 'ERROR'
+END = 'END'
+
+# Boolean and null literals match case-insensitively even as the prefix of a
+# longer word (eg: 'nullify'), like the grammar's CaselessLiterals do, so they
+# come before names. Unsigned numbers only: whether a sign belongs to a number
+# depends on where it is (see _Parser.operand).
+_TOKEN_REGEX = re.compile(
+    r'''
+    [ \n\t\r]*
+    (?:
+        (?P<NUMBER>[0-9]+(?:\.[0-9]+)?|\.[0-9]+)
+      | (?P<VARIABLE>\$[A-Za-z_][A-Za-z0-9_]*)
+      | (?P<LITERAL>(?i:true|false|null))
+      | (?P<NAME>[A-Za-z_][A-Za-z0-9_]*)
+      | (?P<STRING>"[ !\#-~]+")
+      | (?P<OPERATOR>==|!=|<=|>=|[<>^*/%+\-(),])
+      | (?P<ERROR>.)
+    )?
+    ''',
+    re.ASCII | re.DOTALL | re.VERBOSE,
+)
+
+# Characters that may not surround a keyword (those of PyParsing's Keyword).
+_KEYWORD_CHARS = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789_$'
+# Characters allowed in a quoted string.
+_STRING_CHARS = frozenset(
+    ' !#$%&\'()*+,-./0123456789:;<=>?@ABCDEFGHIJKLMNOPQRSTUVWXYZ[\\]^_`abcdefghijklmnopqrstuvwxyz{|}~'
+)
+
+
+def tokenize(text: str) -> List[Token]:
+    """Split a formula into tokens, ending with an END token.
+
+    Characters that don't start any token become ERROR tokens, so that
+    tokenizing never fails; it's up to the parser to stop at them.
+    """
+    tokens: List[Token] = []
+    position = 0
+    length = len(text)
+    while True:
+        match = _TOKEN_REGEX.match(text, position)
+        kind = match.lastgroup
+        if kind is None:
+            tokens.append(Token(END, '', length, length))
+            return tokens
+        start, position = match.span(kind)
+        tokens.append(Token(kind, match.group(kind), start, position))
+
+
+# The following arranges operators and operands into expression trees.
+# --------------------------------------------------------------------
+
+
+# Arithmetic operators by ascending order of precedence. The precedence is
+# Python's, since parsed tokens used to be joined and passed to eval().
+_ARITHMETIC_OPERATOR_LEVELS = (
+    ('^',),
+    ('+', '-'),
+    ('*', '/', '%'),
+)
+_COMPARISON_OPERATORS = ('==', '!=', '<', '>', '<=', '>=')
+_EQUALITY_OPERATORS = ('==', '!=')
+
+# Binding power of every arithmetic operator, for precedence climbing.
+_BINDING_POWERS: Dict[str, int] = {
+    operator: level + 1
+    for level, operators in enumerate(_ARITHMETIC_OPERATOR_LEVELS)
+    for operator in operators
+}
+
+
+class _TreeBuilder:
+    """Recursive descent over a flat list of parsed tokens.
+
+    The grammar only validates the structure of a formula, leaving operands
+    as tree nodes and operators and parentheses as strings (see _Parser and
+    the ParseActions of cimbolic.parsing). This class arranges those into a
+    single expression tree.
+    """
+    def __init__(self, tokens: List[Any]):
+        self.tokens = tokens
+        self.position = 0
+
+    def peek(self) -> Optional[str]:
+        """Return the next token if it's an operator or a parenthesis."""
+        if self.position < len(self.tokens):
+            token = self.tokens[self.position]
+            if isinstance(token, str):
+                return token
+        return None
+
+    def take(self) -> Any:
+        """Consume and return the next token."""
+        try:
+            token = self.tokens[self.position]
+        except IndexError:
+            raise SyntaxError('Unexpected end of formula')
+        self.position += 1
+        return token
+
+    def build(self) -> Node:
+        node = self.disjunction()
+        if self.position != len(self.tokens):
+            raise SyntaxError(f'Unexpected token {self.tokens[self.position]!r}')
+        return node
+
+    def disjunction(self) -> Node:
+        node = self.conjunction()
+        while self.peek() == 'or':
+            self.take()
+            node = LogicalOperation('or', node, self.conjunction())
+        return node
+
+    def conjunction(self) -> Node:
+        node = self.negation()
+        while self.peek() == 'and':
+            self.take()
+            node = LogicalOperation('and', node, self.negation())
+        return node
+
+    def negation(self) -> Node:
+        if self.peek() == 'not':
+            self.take()
+            return Negation(self.negation())
+        return self.comparison()
+
+    def comparison(self) -> Node:
+        node = self.arithmetic(0)
+        if self.peek() in _COMPARISON_OPERATORS:
+            operator = self.take()
+            node = BinaryOperation(operator, node, self.arithmetic(0))
+        return node
+
+    def arithmetic(self, level: int) -> Node:
+        if level == len(_ARITHMETIC_OPERATOR_LEVELS):
+            return self.atom()
+        node = self.arithmetic(level + 1)
+        while self.peek() in _ARITHMETIC_OPERATOR_LEVELS[level]:
+            operator = self.take()
+            node = BinaryOperation(operator, node, self.arithmetic(level + 1))
+        return node
+
+    def atom(self) -> Node:
+        token = self.take()
+        if not isinstance(token, str):
+            return token
+        if token != '(':
+            raise SyntaxError(f'Unexpected token {token!r}')
+        node = self.disjunction()
+        if self.take() != ')':
+            raise SyntaxError("Expected ')'")
+        return node
+
+
+def _build_tree(tokens: List[Any]) -> Node:
+    """Build an expression tree from a flat list of parsed tokens."""
+    return _TreeBuilder(tokens).build()
+
+
+# The following parses formulae the way the PyParsing grammar does.
+# ----------------------------------------------------------------
+
+
+class _NoMatch(Exception):
+    """Raised when a part of the grammar doesn't match (and the parser backtracks)."""
+    def __init__(self, position: int):
+        super().__init__(position)
+        self.position = position
+
+
+# Flat tokens of a condition, as the grammar would've returned them (strings
+# for operators and parentheses, nodes for the rest). Nested lists are
+# flattened once parsing is over.
+_Items = List[Union[str, Node, list]]
+
+
+def _flatten(items: _Items) -> List[Union[str, Node]]:
+    flat: List[Union[str, Node]] = []
+    stack = [iter(items)]
+    while stack:
+        item = next(stack[-1], None)
+        if item is None:
+            stack.pop()
+        elif isinstance(item, list):
+            stack.append(iter(item))
+        else:
+            flat.append(item)
+    return flat
+
+
+def _first_match(*alternatives):
+    """Return the result of the first alternative that matches.
+
+    If none do, raise the failure that got the farthest (the first one, in
+    case of a tie), like PyParsing's MatchFirst.
+    """
+    farthest: Optional[_NoMatch] = None
+    for alternative in alternatives:
+        try:
+            return alternative()
+        except _NoMatch as exc:
+            if farthest is None or exc.position > farthest.position:
+                farthest = exc
+    raise farthest
+
+
+class _Parser:
+    """Parser of a single formula."""
+    def __init__(self, text: str):
+        # PyParsing expands tabs before parsing, which positions account for.
+        self.text = text.expandtabs()
+        self.tokens = tokenize(self.text)
+        self._expressions: Dict[int, Tuple[int, Node]] = {}
+        self._conditions: Dict[int, Union[Tuple[int, _Items], _NoMatch]] = {}
+
+    def error(self, index: int, message: str) -> FormulaSyntaxError:
+        return FormulaSyntaxError(message, self.tokens[index].start)
+
+    def is_adjacent(self, index: int) -> bool:
+        """Return whether a token is directly followed by the next one."""
+        return self.tokens[index].end == self.tokens[index + 1].start
+
+    def is_operator(self, index: int, *operators: str) -> bool:
+        token = self.tokens[index]
+        return token.kind == OPERATOR and token.text in operators
+
+    def is_keyword(self, index: int, *keywords: str) -> bool:
+        token = self.tokens[index]
+        if token.kind != NAME or token.text.lower() not in keywords:
+            return False
+        before = self.text[token.start - 1:token.start]
+        after = self.text[token.end:token.end + 1]
+        return (
+            (before == '' or before.upper() not in _KEYWORD_CHARS)
+            and (after == '' or after.upper() not in _KEYWORD_CHARS)
+        )
+
+    def expect(self, index: int, *operators: str) -> int:
+        """Match one of the operators (or parentheses), or fail."""
+        if not self.is_operator(index, *operators):
+            raise _NoMatch(self.tokens[index].start)
+        return index + 1
+
+    # Arithmetic expressions -------------------------------------------------
+    # The grammar accepts any chain of operands and arithmetic operators. Once
+    # it's started one, it never backtracks out of it: a missing operand (or
+    # closing parenthesis) sends it into an endless left recursion instead.
+
+    def expression(self, index: int) -> Tuple[int, Node]:
+        """Parse an arithmetic expression starting at the token."""
+        try:
+            return self._expressions[index]
+        except KeyError:
+            pass
+        result = self._expressions[index] = self.arithmetic(index, 0)
+        return result
+
+    def arithmetic(self, index: int, min_power: int) -> Tuple[int, Node]:
+        index, node = self.operand(index)
+        while True:
+            token = self.tokens[index]
+            power = _BINDING_POWERS.get(token.text) if token.kind == OPERATOR else None
+            if power is None or power <= min_power:
+                return index, node
+            index, right = self.arithmetic(index + 1, power)
+            node = BinaryOperation(token.text, node, right)
+
+    def operand(self, index: int) -> Tuple[int, Node]:
+        token = self.tokens[index]
+        if token.kind == NUMBER:
+            return index + 1, self.number(token.text)
+        if token.kind == VARIABLE:
+            return index + 1, NamedVariable(token.text[1:])
+        if self.is_operator(index, '+', '-') and self.tokens[index + 1].kind == NUMBER and self.is_adjacent(index):
+            return index + 2, self.number(token.text + self.tokens[index + 1].text)
+        is_macro = token.kind == NAME and token.text.lower() in ('max', 'min')
+        if is_macro and self.is_operator(index + 1, '(') and self.is_adjacent(index):
+            return self.aggregate_macro(index)
+        if self.is_operator(index, '('):
+            index, node = self.expression(index + 1)
+            if not self.is_operator(index, ')'):
+                raise self.error(index, "Expected an arithmetic operator or ')'")
+            return index + 1, node
+        raise self.error(index, "Expected a number, a named variable, an aggregate macro or '('")
+
+    @staticmethod
+    def number(text: str) -> Constant:
+        return Constant(float(text) if '.' in text else int(text))
+
+    def aggregate_macro(self, index: int) -> Tuple[int, AggregateMacro]:
+        name = self.tokens[index].text.lower()
+        index, arg = self.expression(index + 2)
+        args = [arg]
+        while self.is_operator(index, ','):
+            index, arg = self.expression(index + 1)
+            args.append(arg)
+        if not self.is_operator(index, ')'):
+            raise self.error(index, "Expected an arithmetic operator, ',' or ')'")
+        return index + 1, AggregateMacro(name, tuple(args))
+
+    # Conditions -------------------------------------------------------------
+
+    def condition(self, index: int) -> Tuple[int, _Items]:
+        """Parse a condition and its logical combinations, or fail."""
+        try:
+            result = self._conditions[index]
+        except KeyError:
+            try:
+                result = self.combination(index)
+            except _NoMatch as exc:
+                result = exc
+            self._conditions[index] = result
+        if isinstance(result, _NoMatch):
+            raise result
+        return result
+
+    def combination(self, index: int) -> Tuple[int, _Items]:
+        # In the grammar, the term after a logical operator is a whole
+        # condition, which takes any further combinations along with it.
+        # Parsing them in a loop gives the same tokens without the recursion.
+        index, items = self.term(index)
+        items = [items]
+        while self.is_keyword(index, 'and', 'or'):
+            try:
+                next_index, term_items = self.term(index + 1)
+            except _NoMatch:
+                break
+            items.append(self.tokens[index].text.lower())
+            items.append(term_items)
+            index = next_index
+        return index, items
+
+    def term(self, index: int) -> Tuple[int, _Items]:
+        """Parse a condition without its logical combinations, or fail."""
+        if self.is_keyword(index, 'not'):
+            # 'not' is only an alternative after both parenthesized ones, but
+            # those can't match a 'not'.
+            try:
+                index, items = self.term(index + 1)
+            except _NoMatch:
+                # The grammar falls back to comparing an arithmetic
+                # expression, which can't start with 'not'.
+                raise self.error(index, "Expected a number, a named variable, an aggregate macro or '('")
+            return index, ['not', items]
+        return _first_match(
+            lambda: self.negated_group(index),
+            lambda: self.group(index),
+            lambda: self.parenthesized_literal_comparison(index),
+            lambda: self.parenthesized_arithmetic_comparison(index),
+            lambda: self.literal_comparison(index),
+            lambda: self.arithmetic_comparison(index),
+        )
+
+    def negated_group(self, index: int) -> Tuple[int, _Items]:
+        index = self.expect(index, '(')
+        if not self.is_keyword(index, 'not'):
+            raise _NoMatch(self.tokens[index].start)
+        index, items = self.condition(index + 1)
+        index = self.expect(index, ')')
+        return index, ['(', 'not', items, ')']
+
+    def group(self, index: int) -> Tuple[int, _Items]:
+        index = self.expect(index, '(')
+        index, items = self.condition(index)
+        index = self.expect(index, ')')
+        return index, ['(', items, ')']
+
+    def parenthesized_literal_comparison(self, index: int) -> Tuple[int, _Items]:
+        index = self.expect(index, '(')
+        index, items = self.literal_comparison(index)
+        index = self.expect(index, ')')
+        return index, ['(', items, ')']
+
+    def parenthesized_arithmetic_comparison(self, index: int) -> Tuple[int, _Items]:
+        index = self.expect(index, '(')
+        index, items = self.arithmetic_comparison(index)
+        index = self.expect(index, ')')
+        return index, ['(', items, ')']
+
+    def literal_comparison(self, index: int) -> Tuple[int, _Items]:
+        index, left = self.expression(index)
+        index = self.expect(index, *_EQUALITY_OPERATORS)
+        operator = self.tokens[index - 1].text
+        index, right = self.literal(index)
+        return index, [left, operator, right]
+
+    def arithmetic_comparison(self, index: int) -> Tuple[int, _Items]:
+        index, left = self.expression(index)
+        index = self.expect(index, *_COMPARISON_OPERATORS)
+        operator = self.tokens[index - 1].text
+        index, right = self.expression(index)
+        return index, [left, operator, right]
+
+    def literal(self, index: int) -> Tuple[int, Constant]:
+        """Parse a quoted string, a boolean or null, or fail."""
+        token = self.tokens[index]
+        if token.kind == STRING:
+            return index + 1, Constant(ast.literal_eval(token.text))
+        if token.kind == LITERAL:
+            text = token.text.upper()
+            return index + 1, Constant(None if text == 'NULL' else text == 'TRUE')
+        if token.text == '"':
+            # An unterminated or empty string: the grammar fails after the
+            # characters it could've taken as the string's.
+            position = token.start + 1
+            while position < len(self.text) and self.text[position] in _STRING_CHARS:
+                position += 1
+            raise _NoMatch(position)
+        raise _NoMatch(token.start)
+
+
+class _DecimalParser(_Parser):
+    """Parser of a single formula that reads numbers as Decimals (exactly)."""
+    @staticmethod
+    def number(text: str) -> Constant:
+        return Constant(Decimal(text))
+
+
+def parse_rule(rule: str, decimal_numbers: bool = False) -> Node:
+    """Parse a rule into an expression tree.
+
+    Numbers are read as Decimals if decimal_numbers is set, and as ints and
+    floats otherwise. Raise a FormulaSyntaxError if the rule doesn't conform
+    to the grammar.
+    """
+    parser = (_DecimalParser if decimal_numbers else _Parser)(rule)
+    index, node = parser.expression(0)
+    return node
+
+
+def parse_condition(condition: str, decimal_numbers: bool = False) -> Node:
+    """Parse a condition into an expression tree.
+
+    Numbers are read as Decimals if decimal_numbers is set, and as ints and
+    floats otherwise. Raise a FormulaSyntaxError if the condition doesn't
+    conform to the grammar.
+    """
+    parser = (_DecimalParser if decimal_numbers else _Parser)(condition)
+    try:
+        index, items = parser.condition(0)
+    except _NoMatch as exc:
+        raise FormulaSyntaxError('Invalid condition', exc.position) from None
+    return _build_tree(_flatten(items))
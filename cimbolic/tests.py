@@ -0,0 +1,1268 @@
+"""Tests of the evaluation of variables.
+
+The tests are TransactionTestCases: formulae are evaluated in other threads
+(by a ThreadPoolExecutor, or by the executor of the asynchronous registry)
+and processes, whose database connections only see committed rows.
+"""
+import asyncio
+import decimal
+import json
+import os
+import random
+import tempfile
+import unittest
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO
+from typing import Dict
+from unittest import mock
+
+from django.core.management import CommandError, call_command
+from django.db import DatabaseError, transaction
+from django.db.models import QuerySet
+from django.test import TransactionTestCase, override_settings
+
+from . import SYSTEM_VARIABLES_FILE, caching, get_system_variables, reload_system_variables
+from .caching import CacheInfo, CachedCallable
+from .codegen import to_function
+from .exceptions import CircularDependencyError, VariableNotDefinedError, VariableNotFoundError
+from .expressions import AggregateMacro, BinaryOperation, Constant, LogicalOperation, NamedVariable, Negation
+from .graph import get_dependency_graph
+from .incremental import IncrementalEvaluator
+from .management.commands.checkparser import CONDITION, RULE, _PARSERS, _agree, _FormulaGenerator, _outcome
+from .management.commands.evaluate import read_csv
+from .models import Formula, Variable, get_all_context_keys, replace_formulae
+from .numeric import DECIMAL, FIXED, FLOAT, NUMERIC_BACKENDS, numeric_backend, to_decimal_tree
+from .optimization import optimize
+from .parallel import RowResult, evaluate_parallel, evaluate_stream
+from .parsing import (
+    compile_condition,
+    compile_condition_function,
+    compile_rule,
+    compile_rule_function,
+    parse_condition,
+    parse_rule,
+)
+from .registry import get_shared_cache, get_version, registry
+from .selection import IndexedRun, build_selection_plan, select_formula
+from .serialization import FORMAT_VERSION, dump_tree, load_tree
+from .sessions import EvaluationSession, get_current_session
+from .tracing import SpanRecorder, TimingAggregator
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class Rollback(Exception):
+    """Raised to roll a transaction back."""
+
+
+def rate(rate=None):
+    """System callable returning its argument."""
+    return rate
+
+
+def rank(rank=None):
+    """System callable returning its argument."""
+    return rank
+
+
+def grade(grade=None):
+    """System callable returning its argument."""
+    return grade
+
+
+def amount(amount=None):
+    """System callable returning its argument."""
+    return amount
+
+
+class ConcurrentEvaluationTests(TransactionTestCase):
+    """Concurrent evaluations with different contexts mustn't see each other's."""
+    def setUp(self):
+        patcher = mock.patch.dict(get_system_variables(), {'RATE': (rate, ['rate'])})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        Variable.objects.create(name='RATE', source=Variable.SYSTEM)
+        base = Variable.objects.create(name='BASE')
+        base.add_formula('NULL', '$RATE * 100', 100)
+        base.add_formula('$RATE > 5', '$RATE * 1000', 1)
+        net = Variable.objects.create(name='NET')
+        net.add_formula('NULL', '$BASE + $RATE + max($BASE, 250)', 100)
+        self.net = net
+
+    @staticmethod
+    def expected(value: int) -> int:
+        base = value * 1000 if value > 5 else value * 100
+        return base + value + max(base, 250)
+
+    def evaluate(self, index: int, value: int):
+        if index % 100 == 0:
+            # Force concurrent parsing.
+            compile_condition.cache_clear()
+            compile_rule.cache_clear()
+        context = {'rate': value}
+        with EvaluationSession(context) as session:
+            result = self.net.to_value(context)
+            self.assertIs(get_current_session(), session)
+        return result, session.values
+
+    def test_concurrent_sessions(self):
+        values = [random.randint(0, 10) for __ in range(3000)]
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            results = list(executor.map(self.evaluate, range(len(values)), values))
+        self.assertIsNone(get_current_session())
+        for value, (result, memoized) in zip(values, results):
+            self.assertEqual(result, self.expected(value))
+            self.assertEqual(memoized['RATE'], value)
+            self.assertEqual(memoized['NET'], result)
+
+
+class ShortCircuitTests(TransactionTestCase):
+    """Variables that a condition's `and`/`or` doesn't need mustn't be resolved."""
+    contexts = [
+        {'a': True, 'b': 20},
+        {'a': True, 'b': 5},
+        {'a': True, 'b': 5},
+        {'a': False, 'b': 20},
+        {'a': False, 'b': 5},
+    ]
+    values = [1, 1, 1, 1, 0]
+
+    def setUp(self):
+        self.calls = Counter()
+
+        def a(a=None):
+            self.calls['A'] += 1
+            return a
+
+        def b(b=None):
+            self.calls['B'] += 1
+            return b
+
+        patcher = mock.patch.dict(get_system_variables(), {'A': (a, ['a']), 'B': (b, ['b'])})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        Variable.objects.create(name='A', source=Variable.SYSTEM)
+        Variable.objects.create(name='B', source=Variable.SYSTEM)
+        self.var = Variable.objects.create(name='X')
+        self.var.add_formula('NULL', '0', 100)
+        self.var.add_formula('$A == true or $B > 10', '1', 1)
+
+    def assertSkippedResolutions(self, values):
+        self.assertEqual(list(values), self.values)
+        # $B is only needed where $A isn't true.
+        self.assertEqual(self.calls, {'A': 5, 'B': 2})
+
+    def test_to_value(self):
+        self.assertSkippedResolutions(self.var.to_value(context) for context in self.contexts)
+
+    def test_ato_value(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        values = [loop.run_until_complete(self.var.ato_value(context)) for context in self.contexts]
+        self.assertSkippedResolutions(values)
+
+    @unittest.skipIf(numpy is None, 'Batch evaluation requires NumPy')
+    def test_evaluate_batch(self):
+        self.assertSkippedResolutions(self.var.evaluate_batch(self.contexts))
+
+    def test_dependency_graph(self):
+        graph = get_dependency_graph()
+        self.assertSkippedResolutions(graph.evaluate(['X'], context)['X'] for context in self.contexts)
+
+
+class AsyncEvaluationTests(TransactionTestCase):
+    """ato_value must agree with to_value, and evaluate a shared dependency once per session."""
+    def setUp(self):
+        self.calls = Counter()
+
+        async def slow(rate=None):
+            self.calls['SLOW'] += 1
+            # Let the other tasks run while the value is pending.
+            await asyncio.sleep(0.01)
+            return rate
+
+        patcher = mock.patch.dict(get_system_variables(), {'RATE': (rate, ['rate']), 'SLOW': (slow, ['rate'])})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        self.run_async = loop.run_until_complete
+        Variable.objects.create(name='RATE', source=Variable.SYSTEM)
+        Variable.objects.create(name='SLOW', source=Variable.SYSTEM)
+        base = Variable.objects.create(name='BASE')
+        base.add_formula('NULL', '$RATE * 100', 100)
+        base.add_formula('$RATE > 5', '$RATE * 1000', 1)
+        self.net = Variable.objects.create(name='NET')
+        self.net.add_formula('NULL', '$BASE + $RATE + max($BASE, 250)', 100)
+        self.net.add_formula('$BASE >= 1000 and $RATE < 8', '$BASE / 4', 1)
+        Variable.objects.create(name='SHARED').add_formula('NULL', '$SLOW * 2', 1)
+        Variable.objects.create(name='LEFT').add_formula('NULL', '$SHARED + 1', 1)
+        Variable.objects.create(name='RIGHT').add_formula('NULL', '$SHARED * $SHARED', 1)
+        Variable.objects.create(name='TOTAL').add_formula('NULL', '$LEFT + $RIGHT + $SHARED', 1)
+
+    def test_matches_to_value(self):
+        for value in range(11):
+            context = {'rate': value}
+            with self.subTest(rate=value):
+                self.assertEqual(self.run_async(self.net.ato_value(context)), self.net.to_value(context))
+                self.assertEqual(
+                    self.run_async(self.net.ato_value(context, numeric=DECIMAL)),
+                    self.net.to_value(context, numeric=DECIMAL),
+                )
+
+    def test_gather_shares_dependency(self):
+        context = {'rate': 3}
+        names = ['TOTAL', 'LEFT', 'RIGHT', 'SHARED']
+        variables = [Variable.objects.get(name=name) for name in names]
+
+        async def gather():
+            return await asyncio.gather(*[var.ato_value(context) for var in variables])
+
+        with EvaluationSession(context) as session:
+            values = self.run_async(gather())
+        self.assertEqual(values, [7 + 36 + 6, 7, 36, 6])
+        self.assertEqual(self.calls['SLOW'], 1)
+        self.assertEqual(session.values['SHARED'], 6)
+        # Another session evaluates it again.
+        with EvaluationSession(context):
+            self.assertEqual(self.run_async(gather()), values)
+        self.assertEqual(self.calls['SLOW'], 2)
+
+
+@unittest.skipIf(numpy is None, 'Batch evaluation requires NumPy')
+class BatchEvaluationTests(TransactionTestCase):
+    """Batch evaluation must agree with evaluating each context with to_value."""
+    # Contexts selecting the default formula, either branch or none.
+    contexts = [{'rank': rank} for rank in (0, 3, 12, 20.5, -1, -2.5)]
+    # A context whose formula divides by zero.
+    failing_context = {'rank': -5}
+
+    def setUp(self):
+        patcher = mock.patch.dict(get_system_variables(), {'RANK': (rank, ['rank'])})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        Variable.objects.create(name='RANK', source=Variable.SYSTEM)
+        self.var = Variable.objects.create(name='PAY')
+        self.var.add_formula('NULL', '$RANK + 1', 100)
+        self.var.add_formula('$RANK > 10', '$RANK * 1.5', 1)
+        self.var.add_formula('$RANK < 0', '10 / ($RANK + 5)', 3)
+
+    def test_exact_mode(self):
+        for numeric in (FLOAT, DECIMAL):
+            with self.subTest(numeric=numeric):
+                expected = [self.var.to_value(context, numeric) for context in self.contexts]
+                values = list(self.var.evaluate_batch(self.contexts, numeric=numeric))
+                self.assertEqual(values, expected)
+                self.assertEqual([type(value) for value in values], [type(value) for value in expected])
+
+    def test_float_mode(self):
+        expected = [self.var.to_value(context) for context in self.contexts]
+        values = self.var.evaluate_batch(self.contexts, mode='float')
+        self.assertEqual(len(values), len(expected))
+        for value, expected_value in zip(values, expected):
+            self.assertAlmostEqual(value, expected_value)
+
+    def test_row_error(self):
+        contexts = self.contexts + [self.failing_context]
+        with self.assertRaises(ZeroDivisionError):
+            self.var.to_value(self.failing_context)
+        with self.assertRaises(ZeroDivisionError):
+            self.var.evaluate_batch(contexts)
+        with self.assertRaises(FloatingPointError):
+            self.var.evaluate_batch(contexts, mode='float')
+
+
+class RegistryTransactionTests(TransactionTestCase):
+    """Changes that were rolled back mustn't be evaluated afterwards."""
+    def create_variable(self):
+        Variable.objects.create(name='ROLLED').add_formula('NULL', '42', 1)
+        self.assertEqual(registry.get_variable('ROLLED').to_value({}), 42)
+
+    def test_rollback(self):
+        with self.assertRaises(Rollback), transaction.atomic():
+            self.create_variable()
+            raise Rollback
+        with self.assertRaises(Variable.DoesNotExist):
+            registry.get_variable('ROLLED')
+
+    def test_savepoint_rollback(self):
+        with transaction.atomic():
+            with self.assertRaises(Rollback), transaction.atomic():
+                self.create_variable()
+                raise Rollback
+            with self.assertRaises(Variable.DoesNotExist):
+                registry.get_variable('ROLLED')
+            Variable.objects.create(name='KEPT').add_formula('NULL', '1', 1)
+            self.assertEqual(registry.get_variable('KEPT').to_value({}), 1)
+        self.assertEqual(registry.get_variable('KEPT').to_value({}), 1)
+        with self.assertRaises(Variable.DoesNotExist):
+            registry.get_variable('ROLLED')
+
+    def test_savepoint_rollback_after_changes(self):
+        with transaction.atomic():
+            Variable.objects.create(name='KEPT').add_formula('NULL', '1', 1)
+            self.assertEqual(registry.get_variable('KEPT').to_value({}), 1)
+            with self.assertRaises(Rollback), transaction.atomic():
+                self.create_variable()
+                raise Rollback
+            self.assertEqual(registry.get_variable('KEPT').to_value({}), 1)
+            with self.assertRaises(Variable.DoesNotExist):
+                registry.get_variable('ROLLED')
+        self.assertEqual(registry.get_variable('KEPT').to_value({}), 1)
+        with self.assertRaises(Variable.DoesNotExist):
+            registry.get_variable('ROLLED')
+
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    CIMBOLIC_REGISTRY_CACHE='default',
+    CIMBOLIC_REGISTRY_CHECK_INTERVAL=0,
+)
+class SharedRegistryTransactionTests(RegistryTransactionTests):
+    """Likewise with a shared cache, whose version stamp is only bumped on commit."""
+    def setUp(self):
+        registry.invalidate()
+        self.version = get_version(get_shared_cache())
+
+    def test_rollback(self):
+        super().test_rollback()
+        self.assertEqual(get_version(get_shared_cache()), self.version)
+
+    def test_savepoint_rollback(self):
+        super().test_savepoint_rollback()
+        self.assertEqual(get_version(get_shared_cache()), self.version + 1)
+
+
+class XorTests(TransactionTestCase):
+    """`^` (xor) must work with each numeric backend."""
+    def setUp(self):
+        self.var = Variable.objects.create(name='XOR')
+        self.var.add_formula('NULL', '2 ^ 3', 1)
+
+    def test_integral_operands(self):
+        for numeric in NUMERIC_BACKENDS:
+            with self.subTest(numeric=numeric):
+                self.assertEqual(self.var.to_value({}, numeric), 1)
+
+    @unittest.skipIf(numpy is None, 'Batch evaluation requires NumPy')
+    def test_batch(self):
+        for numeric in NUMERIC_BACKENDS:
+            with self.subTest(numeric=numeric):
+                self.assertEqual(list(self.var.evaluate_batch([{}, {}], numeric=numeric)), [1, 1])
+
+    def test_fractional_operand(self):
+        var = Variable.objects.create(name='FRACTIONAL_XOR')
+        var.add_formula('NULL', '2.5 ^ 1', 1)
+        for numeric in (DECIMAL, FIXED):
+            with self.subTest(numeric=numeric), self.assertRaisesRegex(TypeError, "2.5 isn't an integer"):
+                var.to_value({}, numeric)
+
+
+@override_settings(CIMBOLIC_NUMERIC_BACKEND=DECIMAL)
+class DefaultNumericBackendTests(TransactionTestCase):
+    """Evaluations with the float backend must compute with floats whatever the default backend."""
+    def setUp(self):
+        self.x = Variable.objects.create(name='X')
+        self.x.add_formula('NULL', '0.1 + 0.2', 1)
+        self.y = Variable.objects.create(name='Y')
+        self.y.add_formula('NULL', '$X * 1', 1)
+
+    def test_default(self):
+        self.assertEqual(self.x.to_value({}), decimal.Decimal('0.3'))
+        self.assertEqual(self.y.to_value({}), decimal.Decimal('0.3'))
+
+    def test_to_value(self):
+        for var in (self.x, self.y):
+            with self.subTest(variable=var.name):
+                value = var.to_value({}, numeric=FLOAT)
+                self.assertIsInstance(value, float)
+                self.assertEqual(value, 0.1 + 0.2)
+
+    @unittest.skipIf(numpy is None, 'Batch evaluation requires NumPy')
+    def test_batch(self):
+        for var in (self.x, self.y):
+            with self.subTest(variable=var.name):
+                values = list(var.evaluate_batch([{}, {}], numeric=FLOAT))
+                self.assertEqual(values, [0.1 + 0.2] * 2)
+                self.assertTrue(all(isinstance(value, float) for value in values))
+
+
+class CompareNumericCommandTests(TransactionTestCase):
+    """comparenumeric must only compare the backends over active variables."""
+    def test_inactive_variable(self):
+        Variable.objects.create(name='ACTIVE').add_formula('NULL', '0.1 + 0.2', 1)
+        Variable.objects.create(name='INACTIVE', is_active=False).add_formula('NULL', '1', 1)
+        stdout = StringIO()
+        call_command('comparenumeric', 'ACTIVE', stdout=stdout)
+        self.assertIn('decimal', stdout.getvalue())
+        for name in ('INACTIVE', 'MISSING'):
+            with self.subTest(name=name), self.assertRaisesRegex(CommandError, rf'inactive variable \${name}'):
+                call_command('comparenumeric', 'ACTIVE', name, stdout=StringIO())
+
+
+class ReplaceFormulaeTests(TransactionTestCase):
+    """Formulae must be replaced in bulk, in a fixed number of queries."""
+    def test_replace_formulae(self):
+        Variable.objects.create(name='GRADE', source=Variable.SYSTEM)
+        var = Variable.objects.create(name='SALARY')
+        var.add_formula('NULL', '0', 100)
+        for priority in (1, 3, 5):
+            var.add_formula('$GRADE > 5', '1', priority)
+        formulae = [
+            {'condition': f'$GRADE == {grade}', 'rule': str(grade * 100), 'priority': grade}
+            for grade in range(1, 101)
+        ]
+        formulae.append({'rule': '0', 'priority': 101})
+        registry.snapshot()
+        # The transaction, the deletion and the bulk insert.
+        with self.assertNumQueries(3):
+            var.replace_formulae(formulae)
+        self.assertEqual(
+            [(formula.condition, formula.rule, formula.priority) for formula in var.prioritized_formulae()],
+            [(formula.get('condition', 'NULL'), formula['rule'], formula['priority']) for formula in formulae],
+        )
+        with mock.patch.dict(get_system_variables(), {'GRADE': (42, [])}):
+            self.assertEqual(var.to_value({}), 4200)
+
+    def test_many_existing_formulae(self):
+        variables = [Variable.objects.create(name=f'VAR_{index}') for index in range(3)]
+        old_formulae = [{'condition': f'{grade} > 0', 'rule': '1', 'priority': grade} for grade in range(1, 60)]
+        old_formulae.append({'rule': '0', 'priority': 60})
+        replace_formulae({var: old_formulae for var in variables})
+        self.assertEqual(Formula.objects.count(), 180)
+        registry.snapshot()
+        # The transaction, the deletion of the 180 formulae and the bulk insert.
+        with self.assertNumQueries(3):
+            replace_formulae({var: [{'rule': str(index), 'priority': 1}] for index, var in enumerate(variables)})
+        self.assertEqual(Formula.objects.count(), 3)
+        self.assertEqual([var.to_value({}) for var in variables], [0, 1, 2])
+
+
+class ImportExportTests(TransactionTestCase):
+    """Variables and formulae exported with exportvars must import back as they were."""
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'variables.jsonl')
+
+    @staticmethod
+    def dump():
+        variables = list(Variable.objects.order_by('name').values_list(
+            'name', 'description', 'source', 'related_data_type', 'related_data_path', 'is_active',
+        ))
+        formulae = list(Formula.objects.order_by('variable__name', 'priority').values_list(
+            'variable__name', 'condition', 'rule', 'priority', 'compiled_condition', 'compiled_rule',
+        ))
+        return variables, formulae
+
+    def write(self, *lines: str):
+        with open(self.path, 'w', encoding='utf-8') as f:
+            f.write(''.join(line + '\n' for line in lines))
+
+    def test_round_trip(self):
+        Variable.objects.create(name='GRADE', source=Variable.SYSTEM, description='Grade of the employee')
+        Variable.objects.create(name='UNUSED', is_active=False)
+        salary = Variable.objects.create(name='SALARY')
+        salary.add_formula('NULL', '$GRADE * 100', 100)
+        salary.add_formula('$GRADE > 5', '1000', 1)
+        bonus = Variable.objects.create(name='BONUS')
+        bonus.add_formula('NULL', '0', 2)
+        bonus.add_formula('$SALARY > 500 and $GRADE != 7', 'max($SALARY / 10, 50)', 1)
+        expected = self.dump()
+        stdout = StringIO()
+        call_command('exportvars', stdout=stdout)
+        self.assertEqual(len(stdout.getvalue().splitlines()), 4)
+        Variable.objects.all().delete()
+        with mock.patch('sys.stdin', StringIO(stdout.getvalue())):
+            call_command('importvars', '-', '--batch-size', '2', stdout=StringIO())
+        self.assertEqual(self.dump(), expected)
+
+    def test_invalid_input(self):
+        Variable.objects.create(name='KEPT').add_formula('NULL', '1', 1)
+        expected = self.dump()
+        valid_line = '{"name": "NEW", "formulae": [{"rule": "$KEPT + 1", "priority": 1}]}'
+        invalid_lines = {
+            'invalid JSON': '{"name": "A",',
+            'expected an object with a name': '{"formulae": []}',
+            'invalid variable': '{"name": "1NVALID"}',
+            'Default formula': '{"name": "A", "formulae": [{"condition": "$KEPT > 1", "rule": "1", "priority": 1}]}',
+            'duplicate priorities': (
+                '{"name": "A", "formulae": [{"rule": "1", "priority": 1}, '
+                '{"condition": "$KEPT > 1", "rule": "1", "priority": 1}]}'
+            ),
+            'circular dependency': '{"name": "KEPT", "formulae": [{"rule": "$NEW + 1", "priority": 1}]}',
+        }
+        for message, line in invalid_lines.items():
+            with self.subTest(message=message):
+                self.write(valid_line, line)
+                with self.assertRaisesRegex(CommandError, message):
+                    call_command('importvars', self.path, stdout=StringIO())
+                self.assertEqual(self.dump(), expected)
+
+
+class TracingTests(TransactionTestCase):
+    """Tracers must record the nested spans of an evaluation."""
+    context = {'rate': 2}
+
+    def setUp(self):
+        patcher = mock.patch.dict(get_system_variables(), {'RATE': (rate, ['rate'])})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        Variable.objects.create(name='RATE', source=Variable.SYSTEM)
+        base = Variable.objects.create(name='BASE')
+        base.add_formula('NULL', '$RATE * 100', 100)
+        base.add_formula('$RATE > 5', '$RATE * 1000', 1)
+        self.net = Variable.objects.create(name='NET')
+        self.net.add_formula('NULL', '$BASE + $RATE', 100)
+
+    @staticmethod
+    def tree(recorder: SpanRecorder, spans, *attributes: str) -> list:
+        """Return the spans as nested (kind, name, attributes, children) tuples."""
+        return [
+            (
+                span.kind,
+                span.name,
+                {key: span.attributes[key] for key in attributes if key in span.attributes},
+                TracingTests.tree(recorder, recorder.children.get(span, ()), *attributes),
+            )
+            for span in spans
+        ]
+
+    def test_nested_spans(self):
+        with SpanRecorder() as recorder:
+            self.assertEqual(self.net.to_value(self.context), 202)
+        rate_spans = ('variable', 'RATE', {}, [('system', 'RATE', {}, [])])
+        self.assertEqual(self.tree(recorder, recorder.roots, 'priority', 'result'), [
+            ('variable', 'NET', {'priority': 100}, [
+                ('condition', 'NET', {'priority': 100, 'result': True}, []),
+                ('rule', 'NET', {'priority': 100}, [
+                    ('variable', 'BASE', {'priority': 100}, [
+                        ('condition', 'BASE', {'priority': 1, 'result': False}, [rate_spans]),
+                        ('condition', 'BASE', {'priority': 100, 'result': True}, []),
+                        ('rule', 'BASE', {'priority': 100}, [rate_spans]),
+                    ]),
+                    rate_spans,
+                ]),
+            ]),
+        ])
+        for span in recorder.children[recorder.roots[0]]:
+            self.assertIs(span.parent, recorder.roots[0])
+            self.assertLessEqual(span.duration, recorder.roots[0].duration)
+
+    def test_cache_hits(self):
+        with SpanRecorder() as recorder, EvaluationSession(self.context):
+            self.net.to_value(self.context)
+        # Memoized values are served without evaluating anything.
+        rate_hit = ('variable', 'RATE', {'cache_hit': True}, [])
+        self.assertEqual(self.tree(recorder, recorder.roots, 'cache_hit'), [
+            ('variable', 'NET', {'cache_hit': False}, [
+                ('condition', 'NET', {}, []),
+                ('rule', 'NET', {}, [
+                    ('variable', 'BASE', {'cache_hit': False}, [
+                        ('condition', 'BASE', {}, [
+                            ('variable', 'RATE', {'cache_hit': False}, [('system', 'RATE', {}, [])]),
+                        ]),
+                        ('condition', 'BASE', {}, []),
+                        ('rule', 'BASE', {}, [rate_hit]),
+                    ]),
+                    rate_hit,
+                ]),
+            ]),
+        ])
+
+    def test_timing_aggregator(self):
+        with TimingAggregator() as aggregator, EvaluationSession(self.context):
+            self.net.to_value(self.context)
+        timings = aggregator.timings
+        self.assertEqual(
+            {name: (timing.calls, timing.cache_hits) for name, timing in timings.items()},
+            {'NET': (1, 0), 'BASE': (1, 0), 'RATE': (3, 2)},
+        )
+        # The self times of the variables add up to the cumulative time of the
+        # one evaluated, which includes that of the others.
+        self.assertAlmostEqual(sum(timing.self_time for timing in timings.values()), timings['NET'].cumulative)
+        self.assertLess(timings['BASE'].cumulative, timings['NET'].cumulative)
+        self.assertEqual(
+            [line.split()[0] for line in aggregator.report().splitlines()[1:]],
+            sorted(timings, key=lambda name: timings[name].self_time, reverse=True),
+        )
+
+    def test_concurrent_tasks(self):
+        base = Variable.objects.get(name='BASE')
+
+        async def trace(var: Variable) -> SpanRecorder:
+            with SpanRecorder() as recorder:
+                # Let the other task enter its tracer before evaluating.
+                await asyncio.sleep(0.01)
+                var.to_value(self.context)
+                await asyncio.sleep(0.01)
+            return recorder
+
+        async def trace_both():
+            return await asyncio.gather(trace(self.net), trace(base))
+
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        net_recorder, base_recorder = loop.run_until_complete(trace_both())
+        self.assertEqual([(span.kind, span.name) for span in net_recorder.roots], [('variable', 'NET')])
+        self.assertEqual([(span.kind, span.name) for span in base_recorder.roots], [('variable', 'BASE')])
+        # Each recorder has the whole tree of its own evaluation, and nothing else.
+        base_tree = self.tree(base_recorder, base_recorder.roots)
+        net_rule = self.tree(net_recorder, net_recorder.roots)[0][3][1]
+        self.assertEqual(net_rule[3][0], base_tree[0])
+
+
+class CachedCallableTests(unittest.TestCase):
+    """Cached system-sourced callables must keep their most recent results until they expire."""
+    def setUp(self):
+        self.calls = Counter()
+        self.now = 0.0
+
+    def lookup(self, employee_id=None, month=None):
+        self.calls[employee_id, month] += 1
+        return employee_id * 100 + month
+
+    def test_lru_eviction(self):
+        cached = CachedCallable(self.lookup, maxsize=2)
+        for employee_id, month in [(1, 1), (2, 1), (1, 1), (3, 1), (1, 1), (2, 1)]:
+            self.assertEqual(cached(employee_id=employee_id, month=month), employee_id * 100 + month)
+        # (2, 1) was the least recently used when (3, 1) came in.
+        self.assertEqual(self.calls, {(1, 1): 1, (2, 1): 2, (3, 1): 1})
+        self.assertEqual(cached.cache_info(), CacheInfo(hits=2, misses=4, maxsize=2, ttl=None, currsize=2))
+
+    def test_ttl_expiry(self):
+        cached = CachedCallable(self.lookup, ttl=10, clock=lambda: self.now)
+        cached(employee_id=1, month=1)
+        self.now = 10
+        cached(employee_id=1, month=1)
+        self.now = 10.5
+        cached(employee_id=1, month=1)
+        self.assertEqual(self.calls, {(1, 1): 2})
+        self.assertEqual(cached.cache_info(), CacheInfo(hits=1, misses=2, maxsize=128, ttl=10, currsize=1))
+
+    def test_unhashable_arguments(self):
+        cached = CachedCallable(lambda ids: sum(ids))
+        self.assertEqual([cached(ids=[1, 2]), cached(ids=[1, 2])], [3, 3])
+        self.assertEqual(cached.cache_info().currsize, 0)
+
+    def test_cache_clear(self):
+        cached = CachedCallable(self.lookup)
+        cached(employee_id=1, month=1)
+        cached(employee_id=2, month=1)
+        cached.cache_clear({'employee_id': 1, 'month': 1})
+        self.assertEqual(cached.cache_info(), CacheInfo(hits=0, misses=2, maxsize=128, ttl=None, currsize=1))
+        cached.cache_clear()
+        self.assertEqual(cached.cache_info(), CacheInfo(hits=0, misses=0, maxsize=128, ttl=None, currsize=0))
+
+    def test_system_variables(self):
+        cached = CachedCallable(self.lookup)
+        system_variables = {'LOOKUP': (cached, ['employee_id', 'month']), 'RATE': (rate, ['rate'])}
+        with mock.patch.dict(get_system_variables(), system_variables, clear=True):
+            cached(employee_id=1, month=1)
+            cached(employee_id=1, month=1)
+            self.assertEqual(caching.cache_info(), {'LOOKUP': CacheInfo(1, 1, 128, None, 1)})
+            caching.cache_clear('LOOKUP')
+            self.assertEqual(caching.cache_info(), {'LOOKUP': CacheInfo(0, 0, 128, None, 0)})
+            with self.assertRaises(VariableNotDefinedError):
+                caching.cache_clear('MISSING')
+
+
+class ContextKeysTests(TransactionTestCase):
+    """The context keys of variables must be those of the system callables they depend on."""
+    def setUp(self):
+        system_variables = {
+            'EMPLOYEE': (lambda employee_id: employee_id, ['employee_id']),
+            'PERIOD': (lambda employee_id, month: month, ['employee_id', 'month']),
+            'RATE': (12, []),
+        }
+        patcher = mock.patch.dict(get_system_variables(), system_variables)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        for name in system_variables:
+            Variable.objects.create(name=name, source=Variable.SYSTEM)
+        self.create_variable('BASE', '$EMPLOYEE * $RATE')
+        self.create_variable('NET', '$BASE + 1', '$PERIOD > 6')
+        self.create_variable('BROKEN', '$NET + $MISSING')
+        self.create_variable('INACTIVE', '$BASE', is_active=False)
+
+    @staticmethod
+    def create_variable(name: str, rule: str, condition: str = '$RATE > 0', is_active: bool = True) -> Variable:
+        var = Variable.objects.create(name=name, is_active=is_active)
+        var.add_formula('NULL', '0', 100)
+        var.add_formula(condition, rule, 1)
+        return var
+
+    def test_get_all_context_keys(self):
+        expected = {
+            'EMPLOYEE': ['employee_id'],
+            'PERIOD': ['employee_id', 'month'],
+            'RATE': [],
+            'BASE': ['employee_id'],
+            'NET': ['employee_id', 'month'],
+            'INACTIVE': ['employee_id'],
+        }
+        for name, keys in expected.items():
+            with self.subTest(name=name):
+                self.assertEqual(get_all_context_keys(Variable.objects.get(name=name)), keys)
+        with self.assertRaisesRegex(VariableNotFoundError, r'\$MISSING referenced by \$BROKEN'):
+            get_all_context_keys(Variable.objects.get(name='BROKEN'))
+
+    def test_all_context_keys(self):
+        graph = get_dependency_graph()
+        self.assertEqual(graph.all_context_keys(), {
+            'EMPLOYEE': {'employee_id'},
+            'PERIOD': {'employee_id', 'month'},
+            'RATE': set(),
+            'BASE': {'employee_id'},
+            'NET': {'employee_id', 'month'},
+            'BROKEN': {'employee_id', 'month'},
+        })
+        self.assertEqual(graph.missing_variables('BROKEN'), {'MISSING'})
+        self.assertEqual(graph.missing_variables('NET'), set())
+
+    def test_command(self):
+        stdout = StringIO()
+        call_command('contextkeys', '--all', '--union', stdout=stdout, no_color=True)
+        self.assertEqual(stdout.getvalue(), "- ['employee_id', 'month']\n")
+        stdout = StringIO()
+        call_command('contextkeys', 'BASE', '$NET', stdout=stdout, no_color=True)
+        self.assertEqual(stdout.getvalue(), "- $BASE: ['employee_id']\n- $NET: ['employee_id', 'month']\n")
+
+
+class SystemVariablesFileTests(unittest.TestCase):
+    """The system variables file must only be executed again once it changes."""
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, SYSTEM_VARIABLES_FILE)
+        self.write('1', 1_000_000_000)
+        # Read the project's file again once the setting is restored.
+        self.addCleanup(reload_system_variables)
+        settings_override = override_settings(BASE_DIR=directory.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def write(self, value: str, mtime_ns: int):
+        with open(self.path, 'w', encoding='utf-8') as f:
+            f.write(f'def lookup(arg=None):\n    return {value}\n\n\nsystem_variables = {{"LOOKUP": (lookup, [])}}\n')
+        os.utime(self.path, ns=(mtime_ns, mtime_ns))
+
+    def test_cached_until_changed(self):
+        system_variables = get_system_variables()
+        self.assertEqual(system_variables['LOOKUP'][0](), 1)
+        self.assertIs(get_system_variables(), system_variables)
+        self.write('2', 2_000_000_000)
+        self.assertEqual(get_system_variables()['LOOKUP'][0](), 2)
+        self.assertIs(get_system_variables(), get_system_variables())
+
+    def test_reload(self):
+        system_variables = get_system_variables()
+        # A change within the resolution of the modification time goes unnoticed.
+        self.write('3', 1_000_000_000)
+        self.assertIs(get_system_variables(), system_variables)
+        reloaded = reload_system_variables()
+        self.assertEqual(reloaded['LOOKUP'][0](), 3)
+        self.assertIs(get_system_variables(), reloaded)
+
+
+class ParallelEvaluationTests(TransactionTestCase):
+    """Parallel evaluation must return the results of the contexts in order."""
+    # The variables of cimbolic_vars.py, which worker processes load as well.
+    contexts = [{'arg': arg} for arg in (1, 2, 3, 2, 1, 1, 3)] + [{}]
+
+    def setUp(self):
+        Variable.objects.create(name='DUMMY_LOOKUP', source=Variable.SYSTEM)
+        Variable.objects.create(name='DUMMY_VAL', source=Variable.SYSTEM)
+        total = Variable.objects.create(name='TOTAL')
+        total.add_formula('NULL', '$DUMMY_LOOKUP + $DUMMY_VAL', 100)
+        total.add_formula('$DUMMY_LOOKUP == 0', '1 / $DUMMY_LOOKUP', 1)
+        Variable.objects.create(name='HALF').add_formula('NULL', '$DUMMY_VAL / 2', 1)
+
+    def expected(self, context):
+        try:
+            return RowResult({'HALF': 210.0, 'TOTAL': registry.get_variable('TOTAL').to_value(context)}, None)
+        except Exception as exc:
+            return RowResult({'HALF': 210.0}, f'{type(exc).__name__}: {exc}')
+
+    def test_evaluate_parallel(self):
+        # evaluate_parallel raises the first error, so only contexts that succeed.
+        contexts = [context for context in self.contexts if self.expected(context).error is None]
+        expected = [self.expected(context).values for context in contexts]
+        for workers in (1, 2):
+            with self.subTest(workers=workers):
+                self.assertEqual(evaluate_parallel(['HALF', 'TOTAL'], contexts, workers, chunk_size=2), expected)
+
+    def test_evaluate_stream(self):
+        expected = [self.expected(context) for context in self.contexts]
+        # Where the argument is 3 the lookup gives 0, and without it a KeyError.
+        errors = [result.error is not None for result in expected]
+        self.assertEqual(errors, [False, False, True, False, False, False, True, True])
+        for workers in (1, 2):
+            with self.subTest(workers=workers):
+                results = evaluate_stream(['HALF', 'TOTAL'], iter(self.contexts), workers, chunk_size=3)
+                self.assertEqual(list(results), expected)
+
+    def test_command(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'contexts.json')
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump([{'arg': 2}, {'arg': 1}], f)
+        stdout = StringIO()
+        call_command('evaluateparallel', 'TOTAL', '$HALF', '-c', path, '-w', '2', '--chunk-size', '1', stdout=stdout)
+        self.assertEqual(json.loads(stdout.getvalue()), [{'TOTAL': 440, 'HALF': 210.0}, {'TOTAL': 430, 'HALF': 210.0}])
+        with self.assertRaisesRegex(CommandError, r'Nonexistent or inactive variable \$MISSING'):
+            call_command('evaluateparallel', 'MISSING', '-c', path, stdout=StringIO())
+
+
+class ParserConformanceTests(unittest.TestCase):
+    """The hand-written parser must parse formulae like the PyParsing grammar does."""
+    def check(self, generate, count: int) -> Counter:
+        """Parse count random conditions and rules with both parsers, and return the outcomes."""
+        outcomes = Counter()
+        mismatches = []
+        for __ in range(count):
+            for kind in (CONDITION, RULE):
+                text = generate(kind)
+                reference_parse, parse = _PARSERS[kind]
+                expected, actual = _outcome(reference_parse, text), _outcome(parse, text)
+                outcomes[expected[0]] += 1
+                if not _agree(expected, actual):
+                    mismatches.append((kind, text, expected, actual))
+        self.assertEqual(mismatches, [])
+        return outcomes
+
+    def test_valid_formulae(self):
+        generator = _FormulaGenerator(seed=0, max_depth=4)
+        outcomes = self.check(lambda kind: generator.condition() if kind == CONDITION else generator.rule(), 1500)
+        self.assertEqual(outcomes, {'tree': 3000})
+
+    def test_mutated_formulae(self):
+        # The grammar takes long to recurse endlessly on many of these.
+        generator = _FormulaGenerator(seed=0, max_depth=4)
+        outcomes = self.check(lambda kind: generator.mutate(generator.generate(kind)), 100)
+        self.assertGreater(outcomes['syntax error'] + outcomes['recursion error'], 100)
+
+
+class CycleDetectionTests(TransactionTestCase):
+    """Saving a formula that makes a variable depend on itself must fail."""
+    def create_variable(self, name: str, rule: str = '1') -> Variable:
+        var = Variable.objects.create(name=name)
+        var.add_formula('NULL', rule, 100)
+        return var
+
+    def test_self_reference(self):
+        var = self.create_variable('A')
+        with self.assertRaises(CircularDependencyError):
+            var.add_formula('$A > 1', '2', 1)
+
+    def test_indirect_cycle(self):
+        a = self.create_variable('A')
+        self.create_variable('B', '$C * 2')
+        self.create_variable('C', '$A + 1')
+        with self.assertRaisesRegex(CircularDependencyError, r'\$A -> \$B -> \$C -> \$A'):
+            a.add_formula('$B > 1', '2', 1)
+
+    def test_inactive_variable(self):
+        a = self.create_variable('A')
+        inactive = self.create_variable('INACTIVE', '$A + 1')
+        inactive.is_active = False
+        inactive.save()
+        # Inactive variables aren't evaluated, so they don't close a cycle.
+        a.add_formula('$INACTIVE > 1', '2', 1)
+        self.assertEqual(a.formulae.count(), 2)
+
+
+class DependencyGraphTests(TransactionTestCase):
+    """The dependency graph must evaluate chains deeper than the recursion limit."""
+    depth = 400
+
+    def setUp(self):
+        patcher = mock.patch.dict(get_system_variables(), {'AMOUNT': (amount, ['amount'])})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        Variable.objects.create(name='AMOUNT', source=Variable.SYSTEM)
+        # $V0 = $AMOUNT, and $Vi = $V(i-1) + 1.
+        variables = [Variable.objects.create(name=f'V{i}') for i in range(self.depth)]
+        replace_formulae({
+            variable: [{'rule': f'$V{i - 1} + 1' if i else '$AMOUNT', 'priority': 1}]
+            for i, variable in enumerate(variables)
+        })
+
+    def test_deep_chain(self):
+        name = f'V{self.depth - 1}'
+        values = get_dependency_graph().evaluate([name], {'amount': 1})
+        self.assertEqual(values, {name: self.depth})
+
+
+class IncrementalEvaluationTests(TransactionTestCase):
+    """Incremental evaluation must only recompute the variables depending on changed keys."""
+    def setUp(self):
+        self.calls = Counter()
+
+        def system_callable(key):
+            def function(**kwargs):
+                self.calls[key] += 1
+                return kwargs[key]
+            return function, [key]
+
+        patcher = mock.patch.dict(get_system_variables(), {key.upper(): system_callable(key) for key in 'abc'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        for name in 'ABC':
+            Variable.objects.create(name=name, source=Variable.SYSTEM)
+        Variable.objects.create(name='X').add_formula('NULL', '$A * 2', 1)
+        Variable.objects.create(name='Y').add_formula('NULL', '$B + 1', 1)
+        Variable.objects.create(name='Z').add_formula('NULL', '$X + $Y', 1)
+        w = Variable.objects.create(name='W')
+        w.add_formula('NULL', '0', 100)
+        w.add_formula('$A > 10', '$C', 1)
+        self.evaluator = IncrementalEvaluator(['Z', 'W'])
+
+    def assertEvaluates(self, context, recomputed: int, reused: int, calls: Dict[str, int]):
+        self.calls.clear()
+        values = self.evaluator.evaluate(context)
+        self.assertEqual((self.evaluator.recomputed, self.evaluator.reused), (recomputed, reused))
+        self.assertEqual(self.calls, calls)
+        self.assertEqual(values, {name: registry.get_variable(name).to_value(context) for name in ('Z', 'W')})
+
+    def test_changed_keys(self):
+        # $C is only needed where $A > 10.
+        self.assertEvaluates({'a': 1, 'b': 1}, 6, 0, {'a': 1, 'b': 1})
+        # $B, $Y and $Z depend on b; $A, $X and $W are reused.
+        self.assertEvaluates({'a': 1, 'b': 2}, 3, 3, {'b': 1})
+        # Only the values of $B and $Y are reused, and $C is computed at last.
+        self.assertEvaluates({'a': 20, 'b': 2, 'c': 5}, 5, 2, {'a': 1, 'c': 1})
+
+    def test_unchanged_context(self):
+        self.assertEvaluates({'a': 1, 'b': 1}, 6, 0, {'a': 1, 'b': 1})
+        self.assertEvaluates({'a': 1, 'b': 1}, 0, 6, {})
+
+
+class SelectionTests(TransactionTestCase):
+    """Indexed formula selection must select the formula a scan would."""
+    conditions = [
+        # A run with equal constants and a string.
+        '$GRADE == 1', '$GRADE == 2.5', '$GRADE == 0.1 * 3', '$GRADE == "x"', '$GRADE == true',
+        '$GRADE == 1.0', '$GRADE == 7', '$GRADE == 0.30',
+        '$GRADE > 100',
+        # A run that only compares with constants under the float backend.
+        '$GRADE == 11', '$GRADE == 12', '$GRADE == 1 / 3', '$GRADE == 13', '$GRADE == 14',
+    ]
+    values = [1, 2.5, 0.3, '"x"', True, False, 7, 1 / 3, 11, 14, 13, 101, [1], None, 99]
+
+    def setUp(self):
+        patcher = mock.patch.dict(get_system_variables(), {'GRADE': (grade, ['grade'])})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        Variable.objects.create(name='GRADE', source=Variable.SYSTEM)
+        var = Variable.objects.create(name='BONUS')
+        var.add_formula('NULL', '-1', 100)
+        for index, condition in enumerate(self.conditions):
+            var.add_formula(condition, str(index), index + 1)
+        self.formulae = list(var.prioritized_formulae())
+        self.plan = build_selection_plan(self.formulae)
+
+    def scan(self, context):
+        for formula in self.formulae:
+            if formula.condition_to_boolean(context):
+                return formula
+        return None
+
+    @staticmethod
+    def outcome(select, context):
+        """Return the formula selected, or the type of the exception raised (eg: comparing None with 100)."""
+        try:
+            return select(context)
+        except Exception as exc:
+            return type(exc)
+
+    def test_plan(self):
+        self.assertEqual([type(segment) for segment in self.plan], [IndexedRun, type(self.formulae[0])] * 2)
+
+    def test_select_formula(self):
+        for numeric in NUMERIC_BACKENDS:
+            for value in self.values:
+                context = {'grade': value}
+                with self.subTest(numeric=numeric, value=value), numeric_backend(numeric):
+                    self.assertEqual(
+                        self.outcome(lambda context: select_formula(self.plan, context), context),
+                        self.outcome(self.scan, context),
+                    )
+        decimal_indexes = [segment.decimal_formulae for segment in self.plan if isinstance(segment, IndexedRun)]
+        self.assertIsNotNone(next(iter(decimal_indexes[0].values())))
+        # $GRADE == 1 / 3 doesn't compare with a Decimal constant.
+        self.assertIsNone(next(iter(decimal_indexes[1].values())))
+
+
+class StoredTreeTests(TransactionTestCase):
+    """Formulae must store their compiled trees, and stale ones must be parsed again."""
+    condition = 'not ($A > 2 and $B != null) or $C == "x"'
+    rule = 'max($A * 1.5, $B, -2) / ($C - 0.5)'
+
+    def setUp(self):
+        var = Variable.objects.create(name='STORED')
+        var.add_formula('NULL', '1', 100)
+        self.formula = var.add_formula(self.condition, self.rule, 1)
+        self.addCleanup(self.clear_compile_caches)
+
+    @staticmethod
+    def clear_compile_caches():
+        for function in (compile_condition, compile_rule, compile_condition_function, compile_rule_function):
+            function.cache_clear()
+
+    def test_dump_and_load(self):
+        tree = LogicalOperation(
+            'or', Negation(Constant(None)), BinaryOperation('==', NamedVariable('A'), Constant('x')),
+        )
+        for node in (tree, AggregateMacro('max', (Constant(1.5), Constant(True), NamedVariable('B')))):
+            self.assertEqual(load_tree(dump_tree(node)), node)
+
+    def test_round_trip(self):
+        formula = Formula.objects.get(pk=self.formula.pk)
+        self.assertEqual(formula.compiled_format_version, FORMAT_VERSION)
+        self.assertEqual(formula.stored_trees(), (compile_condition(self.condition), compile_rule(self.rule)))
+
+    def test_registry_uses_stored_trees(self):
+        registry.invalidate()
+        registry.snapshot()
+        self.clear_compile_caches()
+        with mock.patch('cimbolic.syntax.parse_condition') as parse_condition_mock, \
+                mock.patch('cimbolic.syntax.parse_rule') as parse_rule_mock:
+            compile_condition(self.condition)
+            compile_rule(self.rule)
+        parse_condition_mock.assert_not_called()
+        parse_rule_mock.assert_not_called()
+
+    def test_stale_format_version(self):
+        # A stale stored tree is ignored, even though it would load.
+        Formula.objects.filter(pk=self.formula.pk).update(
+            compiled_rule=dump_tree(Constant(999)),
+            compiled_format_version=FORMAT_VERSION - 1,
+        )
+        registry.invalidate()
+        formula = Formula.objects.get(pk=self.formula.pk)
+        self.assertIsNone(formula.stored_trees())
+        registry.snapshot()
+        self.clear_compile_caches()
+        self.assertEqual(compile_condition(self.condition), optimize(parse_condition(self.condition)))
+        self.assertEqual(compile_rule(self.rule), optimize(parse_rule(self.rule)))
+
+    def test_tampered_trees(self):
+        # The code generation backend would otherwise execute these.
+        tampered = [
+            '["b","+ __import__(\'os\').getpid() +",["c",1],["c",2]]',
+            '["l","or __import__(\'os\') or",["c",true],["c",false]]',
+            '["m","__import__",[["c","os"]]]',
+            '["v",1]',
+            '["v","A) + (1"]',
+            '["c",[1]]',
+            '["c",NaN]',
+            '["n",["c",1],["c",2]]',
+            '["x",1]',
+            '[]',
+        ]
+        for text in tampered:
+            with self.subTest(text=text), self.assertRaises(ValueError):
+                load_tree(text)
+        Formula.objects.filter(pk=self.formula.pk).update(compiled_rule=tampered[0])
+        registry.invalidate()
+        self.assertIsNone(Formula.objects.get(pk=self.formula.pk).stored_trees())
+        registry.snapshot()
+        self.clear_compile_caches()
+        self.assertEqual(compile_rule(self.rule), optimize(parse_rule(self.rule)))
+
+
+class OptimizationTests(unittest.TestCase):
+    """Optimized trees must evaluate like the trees they were optimized from."""
+    # Values of the variables of the random formulae, by context.
+    contexts = [
+        {'A': 2, 'B': -3.5, 'basic': 0, 'X_1': 7, '_y': 0.1},
+        {'A': 0, 'B': 1, 'basic': 12.25, 'X_1': -1, '_y': 3},
+    ]
+
+    @staticmethod
+    def outcome(tree, values):
+        try:
+            value = tree.evaluate(values.__getitem__)
+        except Exception as exc:
+            return type(exc)
+        return type(value), value
+
+    def check(self, parse, to_values, count: int = 1500, evaluation_context=None) -> int:
+        """Compare random formulae with their optimized trees, and return how many were changed.
+
+        The trees are evaluated in the given decimal context, if any.
+        """
+        generator = _FormulaGenerator(seed=0, max_depth=4)
+        optimized = 0
+        for __ in range(count):
+            for kind, text in ((CONDITION, generator.condition()), (RULE, generator.rule())):
+                tree = parse(kind, text)
+                optimized_tree = optimize(tree)
+                optimized += optimized_tree != tree
+                for context in self.contexts:
+                    values = to_values(context)
+                    with decimal.localcontext(evaluation_context):
+                        outcomes = self.outcome(optimized_tree, values), self.outcome(tree, values)
+                    self.assertEqual(*outcomes, f'{kind} {text!r}')
+        return optimized
+
+    def test_float_trees(self):
+        def parse(kind, text):
+            return parse_condition(text) if kind == CONDITION else parse_rule(text)
+        self.assertGreater(self.check(parse, dict), 500)
+
+    def test_decimal_trees(self):
+        def parse(kind, text):
+            tree = parse_condition(text, True) if kind == CONDITION else parse_rule(text, True)
+            return to_decimal_tree(tree)
+
+        def to_values(context):
+            return {name: to_decimal_tree(Constant(value)).value for name, value in context.items()}
+
+        # Decimal trees are compiled once per precision, and may be evaluated
+        # with another rounding, so folding must be exact.
+        for precision in (28, 5, 2):
+            with self.subTest(precision=precision), decimal.localcontext() as context:
+                context.prec = precision
+                context.rounding = decimal.ROUND_UP
+                evaluation_context = decimal.Context(prec=precision, rounding=decimal.ROUND_DOWN)
+                self.assertGreater(self.check(parse, to_values, 500, evaluation_context), 100)
+
+
+class CodegenTests(unittest.TestCase):
+    """Generated functions must evaluate like the trees they were generated from."""
+    contexts = OptimizationTests.contexts
+
+    @staticmethod
+    def outcome(evaluate, values):
+        try:
+            value = evaluate(values.__getitem__)
+        except Exception as exc:
+            return type(exc)
+        return type(value), value
+
+    def check(self, parse, to_values):
+        generator = _FormulaGenerator(seed=1, max_depth=4)
+        for __ in range(500):
+            for kind, text in ((CONDITION, generator.condition()), (RULE, generator.rule())):
+                tree = optimize(parse(kind, text))
+                function = to_function(tree)
+                for context in self.contexts:
+                    values = to_values(context)
+                    outcomes = self.outcome(function.evaluate, values), self.outcome(tree.evaluate, values)
+                    self.assertEqual(*outcomes, f'{kind} {text!r}: {function.source}')
+
+    def test_float_trees(self):
+        self.check(lambda kind, text: parse_condition(text) if kind == CONDITION else parse_rule(text), dict)
+
+    def test_decimal_trees(self):
+        def parse(kind, text):
+            return to_decimal_tree(parse_condition(text, True) if kind == CONDITION else parse_rule(text, True))
+
+        def to_values(context):
+            return {name: to_decimal_tree(Constant(value)).value for name, value in context.items()}
+        self.check(parse, to_values)
+
+    def test_injected_code(self):
+        nodes = [
+            BinaryOperation('+ __import__("os").getpid() +', Constant(1), Constant(2)),
+            LogicalOperation('or __import__("os") or', Constant(True), Constant(False)),
+            AggregateMacro('__import__', (Constant('os'),)),
+            Constant(compile('1', '', 'eval')),
+        ]
+        for node in nodes:
+            with self.subTest(node=node), self.assertRaises(ValueError):
+                to_function(node)
+
+
+class LoadVarsTests(TransactionTestCase):
+    """The loadvars command must sync the system-sourced variables in one transaction."""
+    def setUp(self):
+        patcher = mock.patch.dict(
+            get_system_variables(), {'SYS_NEW': (1, []), 'SYS_INACTIVE': (2, [])}, clear=True,
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        Variable.objects.create(name='SYS_INACTIVE', source=Variable.SYSTEM, is_active=False)
+        Variable.objects.create(name='SYS_OLD', source=Variable.SYSTEM)
+
+    def states(self):
+        return dict(Variable.objects.values_list('name', 'is_active'))
+
+    def test_load(self):
+        call_command('loadvars', stdout=StringIO())
+        self.assertEqual(self.states(), {'SYS_NEW': True, 'SYS_INACTIVE': True, 'SYS_OLD': False})
+
+    def test_dry_run(self):
+        stdout = StringIO()
+        call_command('loadvars', dry_run=True, stdout=stdout)
+        self.assertEqual(self.states(), {'SYS_INACTIVE': False, 'SYS_OLD': True})
+        self.assertIn('would be loaded or activated: $SYS_NEW, $SYS_INACTIVE', stdout.getvalue())
+        self.assertIn('would be marked as inactive: $SYS_OLD', stdout.getvalue())
+
+    def test_rollback(self):
+        # Creating the new variable is rolled back when updating the others fails.
+        with mock.patch.object(QuerySet, 'bulk_update', side_effect=DatabaseError), \
+                self.assertRaises(DatabaseError):
+            call_command('loadvars', stdout=StringIO())
+        self.assertEqual(self.states(), {'SYS_INACTIVE': False, 'SYS_OLD': True})
+
+
+class EvaluateCommandTests(TransactionTestCase):
+    """The evaluate command must write each context with its values."""
+    def setUp(self):
+        patcher = mock.patch.dict(get_system_variables(), {'AMOUNT': (amount, ['amount'])})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        Variable.objects.create(name='AMOUNT', source=Variable.SYSTEM)
+        Variable.objects.create(name='DOUBLE').add_formula('NULL', '$AMOUNT * 2', 1)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def evaluate(self, input_text: str, extension: str, *args) -> str:
+        input_path = os.path.join(self.directory, f'input.{extension}')
+        with open(input_path, 'w', encoding='utf-8') as f:
+            f.write(input_text)
+        stdout = StringIO()
+        call_command('evaluate', 'DOUBLE', '-i', input_path, *args, stdout=stdout, verbosity=0)
+        return stdout.getvalue()
+
+    def test_csv(self):
+        output = self.evaluate('id,amount\n007,1.5\n1e5,2\n', 'csv')
+        self.assertEqual(output, 'id,amount,DOUBLE\n007,1.5,3.0\n1e5,2,4\n')
+
+    def test_jsonl(self):
+        output = self.evaluate('{"amount": 2}\n\n{"amount": 0.25, "id": "x"}\n', 'jsonl')
+        self.assertEqual(
+            [json.loads(line) for line in output.splitlines()],
+            [{'amount': 2, 'DOUBLE': 4}, {'amount': 0.25, 'id': 'x', 'DOUBLE': 0.5}],
+        )
+
+    def test_error_column(self):
+        input_text = 'id,amount\n1,2\n2,\n'
+        with self.assertRaisesRegex(CommandError, 'Context 2: KeyError'):
+            self.evaluate(input_text, 'csv')
+        output = self.evaluate(input_text, 'csv', '--error-column')
+        self.assertEqual(
+            output.splitlines(),
+            ['id,amount,DOUBLE,error', '1,2,4,', "2,,,KeyError: 'Missing argument amount to callable amount'"],
+        )
+
+    def test_unwritable_output(self):
+        with self.assertRaisesRegex(CommandError, "Can't write the results"):
+            self.evaluate('{}\n', 'jsonl', '-o', os.path.join(self.directory, 'missing', 'output.jsonl'))
+
+    def test_number_parsing(self):
+        fields, rows = read_csv(StringIO('a,b,c,d,e,f,g\n007,1e5,nan,inf,-12,0.5,-0\n'))
+        self.assertEqual(fields, list('abcdefg'))
+        self.assertEqual(
+            [(value, type(value)) for value in next(rows).values()],
+            [('007', str), ('1e5', str), ('nan', str), ('inf', str), (-12, int), (0.5, float), (0, int)],
+        )
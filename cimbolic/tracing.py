@@ -0,0 +1,227 @@
+"""Tracing of evaluations, to find out where the time goes.
+
+While a tracer is installed, the evaluation of a variable records a span for
+every variable it evaluates (Variable.to_value, including values served from
+an EvaluationSession), every condition and rule (Formula.condition_to_boolean
+and Formula.rule_to_value) and every system-sourced callable it calls. Spans
+nest like the evaluations do, and carry their wall time and a few attributes:
+the priority of the formula that matched, whether the value was memoized,
+and the exception, if any.
+
+    with TimingAggregator() as aggregator:
+        Variable.objects.get(name='NET_PAY').to_value(context)
+    aggregator.print_report()
+
+A tracer receives spans through its on_start and on_end methods, which
+subclasses override. Two tracers are built in: SpanRecorder keeps the tree
+of spans, and TimingAggregator sums up the cumulative and self time of every
+variable. The tracer used is the innermost one entered in the current
+execution context (a context variable, like EvaluationSession, so concurrent
+asyncio tasks entering tracers of their own don't record each other's
+spans); without one, evaluation only pays for looking it up. The
+asynchronous API and evaluation in other processes aren't traced.
+"""
+
+# So that one may import * from this module.
+__all__ = [
+    'CONDITION',
+    'RULE',
+    'SYSTEM',
+    'VARIABLE',
+    'Span',
+    'SpanRecorder',
+    'TimingAggregator',
+    'Tracer',
+    'annotate',
+    'get_current_tracer',
+]
+
+import sys
+import threading
+import time
+from contextvars import ContextVar, Token
+from typing import Any, Dict, List, Optional, TextIO
+
+
+# Kinds of spans.
+VARIABLE = 'variable'
+CONDITION = 'condition'
+RULE = 'rule'
+SYSTEM = 'system'
+
+
+_current_tracer: 'ContextVar[Optional[Tracer]]' = ContextVar('cimbolic_tracer', default=None)
+
+# Number of tracers entered in any execution context, so that looking the current tracer
+# up costs next to nothing when none is.
+_entered_tracers = 0
+_entered_tracers_lock = threading.Lock()
+
+
+def get_current_tracer() -> Optional['Tracer']:
+    """Return the innermost tracer entered in the current execution context, if any."""
+    if not _entered_tracers:
+        return None
+    return _current_tracer.get()
+
+
+def annotate(**attributes: Any):
+    """Set attributes of the current span of the current tracer, if any."""
+    tracer = get_current_tracer()
+    if tracer is not None and tracer.stack:
+        tracer.stack[-1].attributes.update(attributes)
+
+
+class Span:
+    """A timed step of an evaluation, which is also its own context manager."""
+    __slots__ = ('tracer', 'kind', 'name', 'parent', 'attributes', 'start', 'end')
+
+    def __init__(self, tracer: 'Tracer', kind: str, name: str, attributes: Dict[str, Any]):
+        self.tracer = tracer
+        self.kind = kind
+        self.name = name
+        self.parent: Optional[Span] = tracer.stack[-1] if tracer.stack else None
+        self.attributes = attributes
+        self.start = 0.0
+        self.end: Optional[float] = None
+
+    def __enter__(self) -> 'Span':
+        self.tracer.stack.append(self)
+        self.tracer.on_start(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.end = time.perf_counter()
+        if exc_type is not None:
+            self.attributes['error'] = exc_type.__name__
+        self.tracer.stack.pop()
+        self.tracer.on_end(self)
+
+    def __repr__(self):
+        return f'<Span: {self.kind} {self.name} {self.duration * 1000:.3f} ms {self.attributes}>'
+
+    @property
+    def duration(self) -> float:
+        """Return the wall time of the span (in seconds), so far if it's still open."""
+        end = self.end if self.end is not None else time.perf_counter()
+        return end - self.start
+
+
+class Tracer:
+    """Base class of tracers, notified of the start and end of every span."""
+    def __init__(self):
+        self.stack: List[Span] = []
+        self._token: Optional[Token] = None
+
+    def __enter__(self) -> 'Tracer':
+        global _entered_tracers
+        self._token = _current_tracer.set(self)
+        with _entered_tracers_lock:
+            _entered_tracers += 1
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        global _entered_tracers
+        with _entered_tracers_lock:
+            _entered_tracers -= 1
+        _current_tracer.reset(self._token)
+        self._token = None
+
+    def span(self, kind: str, name: str, **attributes: Any) -> Span:
+        """Return a span to enter around a step of an evaluation."""
+        return Span(self, kind, name, attributes)
+
+    def on_start(self, span: Span):
+        """Handle the start of a span (nothing by default)."""
+
+    def on_end(self, span: Span):
+        """Handle the end of a span (nothing by default)."""
+
+
+class SpanRecorder(Tracer):
+    """Tracer that keeps the tree of the spans it's notified of."""
+    def __init__(self):
+        super().__init__()
+        self.roots: List[Span] = []
+        self.children: Dict[Span, List[Span]] = {}
+
+    def on_end(self, span: Span):
+        if span.parent is None:
+            self.roots.append(span)
+        else:
+            self.children.setdefault(span.parent, []).append(span)
+
+    def format_tree(self) -> str:
+        """Return the recorded spans as an indented tree, one per line."""
+        lines: List[str] = []
+
+        def add(span: Span, depth: int):
+            attributes = ''.join(f' {key}={value}' for key, value in span.attributes.items())
+            lines.append(f'{"  " * depth}{span.kind} {span.name}: {span.duration * 1000:.3f} ms{attributes}')
+            for child in self.children.get(span, ()):
+                add(child, depth + 1)
+        for root in self.roots:
+            add(root, 0)
+        return '\n'.join(lines)
+
+
+class _VariableTiming:
+    """Accumulated timing of a variable's spans."""
+    __slots__ = ('calls', 'cache_hits', 'cumulative', 'self_time')
+
+    def __init__(self):
+        self.calls = 0
+        self.cache_hits = 0
+        self.cumulative = 0.0
+        self.self_time = 0.0
+
+
+class TimingAggregator(Tracer):
+    """Tracer that sums up the cumulative and self time of every variable.
+
+    The cumulative time of a variable includes the variables it depends on;
+    its self time doesn't (its conditions, rules and system-sourced callables
+    count, though). A variable evaluated within itself (only possible through
+    different contexts) has its cumulative time counted once per evaluation.
+    """
+    def __init__(self):
+        super().__init__()
+        self.timings: Dict[str, _VariableTiming] = {}
+        # The time spent in the variables nested in each open variable span.
+        self._nested_times: List[float] = []
+
+    def on_start(self, span: Span):
+        if span.kind == VARIABLE:
+            self._nested_times.append(0.0)
+
+    def on_end(self, span: Span):
+        if span.kind != VARIABLE:
+            return
+        nested_time = self._nested_times.pop()
+        duration = span.duration
+        if self._nested_times:
+            self._nested_times[-1] += duration
+        timing = self.timings.get(span.name)
+        if timing is None:
+            timing = self.timings[span.name] = _VariableTiming()
+        timing.calls += 1
+        if span.attributes.get('cache_hit'):
+            timing.cache_hits += 1
+        timing.cumulative += duration
+        timing.self_time += duration - nested_time
+
+    def report(self) -> str:
+        """Return a table of the variables' timings, by decreasing self time."""
+        lines = [f'{"variable":<32}{"calls":>8}{"cache hits":>12}{"cumulative (ms)":>18}{"self (ms)":>12}']
+        timings = sorted(self.timings.items(), key=lambda item: item[1].self_time, reverse=True)
+        for name, timing in timings:
+            lines.append(
+                f'{name:<32}{timing.calls:>8}{timing.cache_hits:>12}'
+                f'{timing.cumulative * 1000:>18.3f}{timing.self_time * 1000:>12.3f}'
+            )
+        return '\n'.join(lines)
+
+    def print_report(self, file: Optional[TextIO] = None):
+        """Print the table of the variables' timings (to stdout by default)."""
+        print(self.report(), file=file or sys.stdout)
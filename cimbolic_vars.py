@@ -9,6 +9,10 @@ While the keys of the dictionary are the variables' names, the value is a tuple
 whose first item is the action (value or callable) that results in a value
 being substituted for the variable, and whose second item is a list of argument
 names (as strings) that a callable may take. The latter can be an empty list.
+
+A pure callable (whose result only depends on its arguments) can be declared
+cacheable with a dict of cache options as a third item: its results are then
+cached by their arguments, keeping up to 'maxsize' of them for 'ttl' seconds.
 """
 
 
@@ -17,7 +21,13 @@ def dummy_function(arg=None, another_arg=None):
     return arg and another_arg
 
 
+def dummy_lookup(arg=None):
+    """Dummy pure callable, like a lookup in a table."""
+    return {1: 10, 2: 20}.get(arg, 0)
+
+
 system_variables = {
     'DUMMY_VAR': (dummy_function, ['arg', 'another_arg']),
     'DUMMY_VAL': (420, []),
+    'DUMMY_LOOKUP': (dummy_lookup, ['arg'], {'maxsize': 256, 'ttl': 60}),
 }
@@ -9,6 +9,9 @@ env = environ.Env(DEBUG=(bool, True))
 BASE_DIR = root_dir()
 
 DATABASES = {'default': env.db()}
+if DATABASES['default']['ENGINE'] == 'django.db.backends.sqlite3':
+    # The worker processes of cimbolic.parallel can't see an in-memory test database.
+    DATABASES['default']['TEST'] = {'NAME': root_dir('test_db.sqlite3')}
 
 DEBUG = env('DEBUG')
 
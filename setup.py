@@ -37,7 +37,8 @@ setup(
     packages=find_packages(),
     py_modules=['cimbolic_vars'],
     python_requires='>=3.6',
-    install_requires=['pyparsing >=2.4'],
+    install_requires=['pyparsing >=2.4', 'contextvars >=2.4; python_version < "3.7"'],
+    extras_require={'batch': ['numpy >=1.16']},
     package_data={'cimbolic': ['management/commands/*']},
     zip_safe=False,
     project_urls={